@@ -0,0 +1,596 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Array backed annotation index. The nested interval trees built by GtfReader follow Python pointers through three
+    levels (gene, transcript, element) for every peak. Here the elements of each chromosome strand are flattened into
+    sorted NumPy arrays, the gene and transcript ids are interned into integer codes, and a whole vector of positions
+    is answered with a few np.searchsorted calls.
+    Elements are sorted by start and max_ends holds the running maximum of element ends. For a position p, every
+    element containing p lies in the slice [searchsorted(max_ends, p, "left"), searchsorted(starts, p, "right")),
+    the elements of that slice only need a final end >= p check. Optionally a BinTable cuts a partition into fixed
+    windows, mapping a position to the short list of elements of its window, see StrandIndex.binned.
+    An index can be saved into a directory of .npy files (the arrays of all partitions concatenated) and loaded back
+    memory-mapped, see AnnotationIndex.save and AnnotationIndex.load. LazyAnnotationIndex builds the partitions of a
+    chromosome only when it is first looked up.
+"""
+import json
+import os
+import threading
+import numpy as np
+
+# the arrays stored for every partition, in the argument order of StrandIndex
+PARTITION_ARRAYS = ("starts", "ends", "elements", "transcripts", "genes", "max_ends")
+
+
+def expand_ranges(low, high):
+    """
+    expand the half open ranges [low[i], high[i]) into flat (range index, position) pairs without a Python loop.
+    :param low: range starts, type numpy array
+    :param high: range ends, type numpy array
+    :return: range index and position of every element in the ranges, type numpy array
+    """
+    counts = np.maximum(high - low, 0)
+    query = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    hit = np.arange(counts.sum()) - np.repeat(offsets - low, counts)
+    return query, hit
+
+
+def unique_positions(*columns):
+    """
+    find the distinct rows of the query columns, so that each distinct query is searched once.
+    :param columns: query columns of the same length, type numpy array
+    :return: the distinct rows sorted by the first column (then the second ...), type tuple of numpy array, and the
+             position of each query among them, type numpy array
+    """
+    if len(columns) == 1:
+        unique, inverse = np.unique(columns[0], return_inverse=True)
+        return (unique, ), inverse.reshape(-1)
+    order = np.lexsort(columns[::-1])
+    first = np.ones(len(order), dtype=bool)
+    for column in columns:
+        sorted_column = column[order]
+        first[1:] &= sorted_column[1:] == sorted_column[:-1]
+    first = ~first
+    first[:1] = True
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    return tuple(column[order[first]] for column in columns), inverse
+
+
+class StrandIndex:
+    """
+    flattened elements of one strand of a chromosome.
+    """
+    def __init__(self, starts, ends, elements, transcripts, genes, max_ends=None):
+        """
+        :param starts: element starts, type numpy array
+        :param ends: element ends, type numpy array
+        :param elements: element name codes, type numpy array
+        :param transcripts: transcript id codes, type numpy array
+        :param genes: gene id codes, type numpy array
+        :param max_ends: running maximum of ends. When it is None the arrays are sorted and max_ends is computed,
+                         otherwise the arrays are taken as already sorted (e.g. loaded from cache).
+        """
+        if max_ends is None:
+            order = np.lexsort((ends, starts))
+            starts, ends = np.asarray(starts, dtype=np.int64)[order], np.asarray(ends, dtype=np.int64)[order]
+            elements = np.asarray(elements, dtype=np.int16)[order]
+            transcripts = np.asarray(transcripts, dtype=np.int32)[order]
+            genes = np.asarray(genes, dtype=np.int32)[order]
+            max_ends = np.maximum.accumulate(ends) if len(ends) else ends.copy()
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+        self.elements = elements
+        self.transcripts = transcripts
+        self.genes = genes
+        # the whole range covered by this strand, the same as gtf_tree[chr][strand]["interval"]
+        self.interval = (int(starts[0]), int(max_ends[-1])) if len(starts) else None
+        # the BinTable built by binned
+        self.bins = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def transcript_elements(self):
+        """
+        the transcript -> element hierarchy of this partition as offset arrays. The elements of the transcript
+        transcript_codes[i] are the rows element_rows[offsets[i]: offsets[i + 1]] of this partition.
+        :return: transcript_codes, offsets, element_rows, type numpy array
+        """
+        element_rows = np.argsort(self.transcripts, kind="stable")
+        transcript_codes, offsets = np.unique(self.transcripts[element_rows], return_index=True)
+        offsets = np.append(offsets, len(element_rows))
+        return transcript_codes, offsets, element_rows
+
+    def search(self, positions):
+        """
+        find all the elements which contain the positions (closed interval).
+        :param positions: query positions, type numpy array
+        :return: the index of the query position and the index of the element for every hit
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        return self.overlap(positions, positions)
+
+    def overlap(self, starts, ends):
+        """
+        find all the elements which overlap the query intervals [starts, ends] (closed intervals). An element overlaps
+        a query when it starts before the query end and ends after the query start.
+        :param starts: query starts, type numpy array
+        :param ends: query ends, type numpy array
+        :return: the index of the query and the index of the element for every hit
+        """
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        low = np.searchsorted(self.max_ends, starts, side="left")
+        high = np.searchsorted(self.starts, ends, side="right")
+        query, hit = expand_ranges(low, high)
+        keep = self.ends[hit] >= starts[query]
+        return query[keep], hit[keep]
+
+    def sweep(self, starts, ends, block_size=4096):
+        """
+        the same as overlap, as a sweep-line merge join for queries sorted by start. The queries are taken block by
+        block and a cursor walks forward through the elements: the elements whose running max end lies before the
+        start of a block can not overlap any later query, so each block only searches the window of elements between
+        the cursor and its last end. Both sides are thus read once in order. Unsorted queries fall back to overlap.
+        :param starts: query starts, type numpy array
+        :param ends: query ends, type numpy array
+        :param block_size: the number of queries searched at a time
+        :return: see overlap
+        """
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        if len(starts) <= block_size or (starts[1:] < starts[:-1]).any():
+            return self.overlap(starts, ends)
+        queries, hits = [], []
+        cursor = 0
+        for first in range(0, len(starts), block_size):
+            block_starts, block_ends = starts[first: first + block_size], ends[first: first + block_size]
+            cursor += int(np.searchsorted(self.max_ends[cursor:], block_starts[0], side="left"))
+            stop = cursor + int(np.searchsorted(self.starts[cursor:], block_ends.max(), side="right"))
+            low = cursor + np.searchsorted(self.max_ends[cursor: stop], block_starts, side="left")
+            high = cursor + np.searchsorted(self.starts[cursor: stop], block_ends, side="right")
+            query, hit = expand_ranges(low, high)
+            keep = self.ends[hit] >= block_starts[query]
+            queries.append(query[keep] + first)
+            hits.append(hit[keep])
+        return np.concatenate(queries), np.concatenate(hits)
+
+    def binned(self, bin_size):
+        """
+        the BinTable of this partition with windows of bin_size bases, built on the first call and kept for the
+        following ones.
+        :param bin_size: window size in bases
+        :return: BinTable object
+        """
+        bins = self.bins
+        if bins is None or bins.bin_size != bin_size:
+            bins = self.bins = BinTable(self, bin_size)
+        return bins
+
+
+class BinTable:
+    """
+    fixed window lookup table of a StrandIndex. The strand interval is cut into windows of bin_size bases, window b
+    covers [origin + b * bin_size, origin + (b + 1) * bin_size). The rows of the elements overlapping window b are
+    rows[offsets[b]: offsets[b + 1]] (CSR layout, ascending rows), and the bit b of bitmap is set when the window
+    holds any element, so that a position in an intergenic window is rejected by one bit test. A position is mapped
+    to its window by a division and only the elements of the window are checked, instead of the binary searches
+    and the max_ends window of StrandIndex.overlap.
+    An element is listed in every window it overlaps: smaller windows give shorter candidate lists and reject more
+    intergenic positions, but cost more offsets and more repeated rows, see nbytes and entries.
+    """
+    def __init__(self, partition, bin_size):
+        """
+        :param partition: StrandIndex object
+        :param bin_size: window size in bases
+        """
+        assert bin_size > 0
+        self.partition = partition
+        self.bin_size = bin_size
+        self.origin = partition.interval[0] if len(partition) else 0
+        bin_num = (partition.interval[1] - self.origin) // bin_size + 1 if len(partition) else 0
+        first, last = self.bin_of(partition.starts), self.bin_of(partition.ends)
+        # entry e lists element rows[e] in window bins[e], the entries of an element are consecutive
+        element_rows, bins = expand_ranges(first, last + 1)
+        order = np.argsort(bins, kind="stable")
+        self.rows = element_rows[order].astype(np.int32 if len(partition) < 2 ** 31 else np.int64)
+        self.offsets = np.zeros(bin_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(bins, minlength=bin_num), out=self.offsets[1:])
+        self.bitmap = np.packbits(self.offsets[1:] > self.offsets[:-1], bitorder="little")
+
+    @property
+    def bin_num(self):
+        return len(self.offsets) - 1
+
+    @property
+    def entries(self):
+        """
+        the number of (window, element) entries, the elements spanning several windows are counted once per window.
+        """
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.offsets.nbytes + self.bitmap.nbytes
+
+    def bin_of(self, positions):
+        """
+        :param positions: positions inside the strand interval, type numpy array
+        :return: the window of each position, type numpy array
+        """
+        return (np.asarray(positions, dtype=np.int64) - self.origin) // self.bin_size
+
+    def occupied(self, positions):
+        """
+        :param positions: query positions, type numpy array
+        :return: whether the window of each position holds an element, False outside the strand interval
+        """
+        windows = self.bin_of(positions)
+        inside = (windows >= 0) & (windows < self.bin_num)
+        windows = np.where(inside, windows, 0)
+        return inside & (self.bitmap[windows >> 3] >> (windows & 7) & 1).astype(bool)
+
+    def lookup(self, position):
+        """
+        the elements containing one position, without the array overhead of search.
+        :param position: query position, type int
+        :return: the index of the elements in the StrandIndex, type numpy array
+        """
+        window = (int(position) - self.origin) // self.bin_size
+        if not 0 <= window < self.bin_num or not self.bitmap[window >> 3] >> (window & 7) & 1:
+            return self.rows[:0]
+        rows = self.rows[self.offsets[window]: self.offsets[window + 1]]
+        return rows[(self.partition.starts[rows] <= position) & (self.partition.ends[rows] >= position)]
+
+    def search(self, positions):
+        """
+        the same as StrandIndex.search. The positions in an empty window are dropped by the bitmap, the others take
+        the elements of their window.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        windows = self.bin_of(positions)
+        candidates = np.flatnonzero((windows >= 0) & (windows < self.bin_num))
+        windows = windows[candidates]
+        occupied = (self.bitmap[windows >> 3] >> (windows & 7) & 1).astype(bool)
+        candidates, windows = candidates[occupied], windows[occupied]
+        query, entry = expand_ranges(self.offsets[windows], self.offsets[windows + 1])
+        query, hit = candidates[query], self.rows[entry]
+        keep = (self.partition.starts[hit] <= positions[query]) & (self.partition.ends[hit] >= positions[query])
+        return query[keep], hit[keep].astype(np.int64)
+
+    def overlap(self, starts, ends):
+        """
+        the same as StrandIndex.overlap: the hits come ordered by query, then by element row. A query spanning several
+        windows takes the elements of each window, an element is kept in the window of the query start or in the
+        window where the element itself starts, so that it is reported once.
+        :param starts: query starts, type numpy array
+        :param ends: query ends, type numpy array
+        :return: the index of the query and the index of the element in the StrandIndex for every hit
+        """
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        if starts is ends or np.array_equal(starts, ends):
+            return self.search(starts)
+        partition = self.partition
+        # the windows of each query clipped to the table, a query outside of the strand interval covers none
+        first = np.maximum(self.bin_of(starts), 0)
+        last = np.minimum(self.bin_of(ends), self.bin_num - 1)
+        window_query, window = expand_ranges(first, last + 1)
+        query, entry = expand_ranges(self.offsets[window], self.offsets[window + 1])
+        hit = self.rows[entry].astype(np.int64)
+        window, query = window[query], window_query[query]
+        unique = (window == first[query]) | (self.bin_of(partition.starts[hit]) == window)
+        query, hit = query[unique], hit[unique]
+        order = np.lexsort((hit, query))
+        query, hit = query[order], hit[order]
+        keep = (partition.starts[hit] <= ends[query]) & (partition.ends[hit] >= starts[query])
+        return query[keep], hit[keep]
+
+
+class AnnotationIndex:
+    """
+    the flattened annotation of a GTF file, one StrandIndex for each (chromosome, strand).
+    """
+    def __init__(self, element_names, gene_ids, transcript_ids, partitions):
+        """
+        :param element_names: element names, the code of an element is its position in this list
+        :param gene_ids: gene ids, indexed by gene code, type numpy array
+        :param transcript_ids: transcript ids, indexed by transcript code, type numpy array
+        :param partitions: StrandIndex of each chromosome strand, type dict with (chr, strand) keys
+        """
+        self.element_names = list(element_names)
+        self.gene_ids = gene_ids
+        self.transcript_ids = transcript_ids
+        self.partitions = partitions
+
+    def get(self, chr_num, strand):
+        """
+        :return: the StrandIndex of the chromosome strand, None if the GTF file has no element there
+        """
+        return self.partitions.get((chr_num, strand))
+
+    def hierarchy(self):
+        """
+        the gene -> transcript hierarchy as offset arrays. The transcripts of gene g are
+        gene_transcripts[gene_offsets[g]: gene_offsets[g + 1]], the elements of a transcript are given by
+        StrandIndex.transcript_elements.
+        :return: gene_offsets, gene_transcripts, type numpy array
+        """
+        transcript_genes = np.zeros(len(self.transcript_ids), dtype=np.int32)
+        for partition in self.partitions.values():
+            transcript_genes[partition.transcripts] = partition.genes
+        gene_transcripts = np.argsort(transcript_genes, kind="stable").astype(np.int32)
+        gene_offsets = np.searchsorted(transcript_genes[gene_transcripts], np.arange(len(self.gene_ids) + 1))
+        return gene_offsets, gene_transcripts
+
+    def search(self, chr_num, strand, positions):
+        """
+        find all the elements which contain the positions on a chromosome strand.
+        :return: the index of the query position and the index of the element in the StrandIndex for every hit
+        """
+        partition = self.get(chr_num, strand)
+        if partition is None:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        return partition.search(positions)
+
+    @classmethod
+    def from_records(cls, records, element_names):
+        """
+        build the index from element records.
+        :param records: iterable of (chr, strand, gene_id, transcript_id, element, start, end)
+        :param element_names: the elements which need to be indexed, type list
+        :return: AnnotationIndex object
+        """
+        element_code = {name: code for code, name in enumerate(element_names)}
+        gene_code, transcript_code = {}, {}
+        columns = {}
+        for chr_num, strand, gene_id, transcript_id, element, start, end in records:
+            key = (chr_num, strand)
+            if key not in columns:
+                columns[key] = ([], [], [], [], [])
+            starts, ends, elements, transcripts, genes = columns[key]
+            starts.append(start)
+            ends.append(end)
+            elements.append(element_code[element])
+            transcripts.append(transcript_code.setdefault(transcript_id, len(transcript_code)))
+            genes.append(gene_code.setdefault(gene_id, len(gene_code)))
+
+        partitions = {key: StrandIndex(*column) for key, column in columns.items()}
+        gene_ids = np.array(list(gene_code), dtype=str)
+        transcript_ids = np.array(list(transcript_code), dtype=str)
+        return cls(element_names, gene_ids, transcript_ids, partitions)
+
+    @classmethod
+    def merge(cls, indexes):
+        """
+        merge indexes built from different parts of the same GTF file (see GtfReader.build_index with workers). The
+        gene and transcript codes of each index are shifted behind the codes of the indexes before it, partitions of
+        the same chromosome strand are concatenated and sorted again.
+        :param indexes: AnnotationIndex objects with the same element names
+        :return: AnnotationIndex object
+        """
+        gene_offset, transcript_offset = 0, 0
+        columns = {}
+        for annotation_index in indexes:
+            for key, partition in annotation_index.partitions.items():
+                columns.setdefault(key, []).append((partition.starts, partition.ends, partition.elements,
+                                                    partition.transcripts + transcript_offset,
+                                                    partition.genes + gene_offset, partition.max_ends))
+            gene_offset += len(annotation_index.gene_ids)
+            transcript_offset += len(annotation_index.transcript_ids)
+
+        partitions = {}
+        for key, parts in columns.items():
+            if len(parts) == 1:
+                partitions[key] = StrandIndex(*parts[0])
+            else:
+                partitions[key] = StrandIndex(*(np.concatenate(column) for column in list(zip(*parts))[:5]))
+        gene_ids = np.concatenate([annotation_index.gene_ids for annotation_index in indexes])
+        transcript_ids = np.concatenate([annotation_index.transcript_ids for annotation_index in indexes])
+        return cls(indexes[0].element_names, gene_ids, transcript_ids, partitions)
+
+    def update(self, records, remove_ids=()):
+        """
+        apply a delta to the index: the transcripts and genes whose id is in remove_ids are removed, and the transcripts
+        in records replace the transcripts with the same transcript_id (an upsert). Only the partitions with removed or
+        new elements are rebuilt, the other partitions (possibly memory-mapped) are shared with this index, and the new
+        ids are appended behind the existing ones. The codes of the delta ids are still found by a scan of the id
+        arrays and the removed rows by a lookup of the element codes of every partition, so an update costs one
+        vectorized pass over the annotation on top of the rebuilt partitions: about 100 ms for a few transcripts on a
+        GENCODE-sized index (250k transcripts, 1.6M elements), most of it in the scan of the transcript ids.
+        :param records: iterable of (chr, strand, gene_id, transcript_id, element, start, end), e.g. parsed from a
+                        delta GTF file
+        :param remove_ids: transcript ids or gene ids to remove
+        :return: AnnotationIndex object
+        """
+        records = list(records)
+        delta_transcripts = list(dict.fromkeys(record[3] for record in records))
+        delta_genes = list(dict.fromkeys(record[2] for record in records))
+        remove_ids = list(remove_ids)
+        removed_transcripts = np.flatnonzero(np.isin(self.transcript_ids, delta_transcripts + remove_ids))
+        removed_genes = np.flatnonzero(np.isin(self.gene_ids, remove_ids))
+
+        # existing genes and upserted transcripts keep their codes, new ids are appended
+        gene_code = {str(self.gene_ids[i]): i for i in np.flatnonzero(np.isin(self.gene_ids, delta_genes))[::-1]}
+        transcript_code = {str(self.transcript_ids[i]): i for i in removed_transcripts[::-1]}
+        removed_gene_codes = set(removed_genes.tolist())
+        new_gene_ids, new_transcript_ids = [], []
+        for gene_id in delta_genes:
+            if gene_id not in gene_code or gene_code[gene_id] in removed_gene_codes:
+                gene_code[gene_id] = len(self.gene_ids) + len(new_gene_ids)
+                new_gene_ids.append(gene_id)
+        for transcript_id in delta_transcripts:
+            if transcript_id not in transcript_code:
+                transcript_code[transcript_id] = len(self.transcript_ids) + len(new_transcript_ids)
+                new_transcript_ids.append(transcript_id)
+
+        element_code = {name: code for code, name in enumerate(self.element_names)}
+        columns = {}
+        for chr_num, strand, gene_id, transcript_id, element, start, end in records:
+            column = columns.setdefault((chr_num, strand), ([], [], [], [], []))
+            for values, value in zip(column, (start, end, element_code[element], transcript_code[transcript_id],
+                                              gene_code[gene_id])):
+                values.append(value)
+
+        removed = None
+        if len(removed_transcripts) or len(removed_genes):
+            # flags indexed by code, looked up with the codes of the elements of each partition
+            removed, removed_gene = np.zeros(len(self.transcript_ids), dtype=bool), np.zeros(len(self.gene_ids),
+                                                                                             dtype=bool)
+            removed[removed_transcripts], removed_gene[removed_genes] = True, True
+        partitions = {}
+        for key in list(self.partitions) + [key for key in columns if key not in self.partitions]:
+            partition = self.partitions.get(key)
+            new_column = columns.get(key, ([], [], [], [], []))
+            keep = None
+            if partition is not None:
+                if removed is not None:
+                    keep = ~(removed[partition.transcripts] | removed_gene[partition.genes])
+                if (keep is None or keep.all()) and not new_column[0]:
+                    partitions[key] = partition
+                    continue
+                if keep is None:
+                    keep = slice(None)
+            parts = [] if partition is None else [(partition.starts[keep], partition.ends[keep],
+                                                   partition.elements[keep], partition.transcripts[keep],
+                                                   partition.genes[keep])]
+            parts.append(new_column)
+            merged = StrandIndex(*(np.concatenate([np.asarray(values) for values in column]) for column in zip(*parts)))
+            if len(merged):
+                partitions[key] = merged
+        gene_ids, transcript_ids = self.gene_ids, self.transcript_ids
+        if new_gene_ids:
+            gene_ids = np.concatenate([gene_ids, np.array(new_gene_ids, dtype=str)])
+        if new_transcript_ids:
+            transcript_ids = np.concatenate([transcript_ids, np.array(new_transcript_ids, dtype=str)])
+        return AnnotationIndex(self.element_names, gene_ids, transcript_ids, partitions)
+
+    @classmethod
+    def from_gtf_tree(cls, gtf_tree, element_names):
+        """
+        flatten the interval trees built by GtfReader.load_gtf.
+        :param gtf_tree: GtfReader.gtf_tree
+        :param element_names: the elements which need to be indexed, type list
+        :return: AnnotationIndex object
+        """
+        def records():
+            for chr_num, strands in gtf_tree.items():
+                for strand, strand_tree in strands.items():
+                    gene_tree = strand_tree["gene_tree"]
+                    for gene in gene_tree.inorder():
+                        for transcript in gene.compose.inorder():
+                            for element in transcript.compose.inorder():
+                                yield (chr_num, strand, gene.name, transcript.name, element.name,
+                                       element.interval_start, element.interval_end)
+
+        return cls.from_records(records(), element_names)
+
+    def save(self, path):
+        """
+        save the index into a directory, the arrays of all partitions are concatenated into one .npy file per array and
+        meta.json records the slice of each partition.
+        :param path: the directory, created if not exists
+        :return:
+        """
+        os.makedirs(path, exist_ok=True)
+        keys = list(self.partitions.keys())
+        meta = {"element_names": self.element_names, "partitions": []}
+        offset = 0
+        for chr_num, strand in keys:
+            length = len(self.partitions[(chr_num, strand)])
+            meta["partitions"].append([chr_num, strand, offset, length])
+            offset += length
+        for name in PARTITION_ARRAYS:
+            arrays = [getattr(self.partitions[key], name) for key in keys]
+            np.save(os.path.join(path, name + ".npy"), np.concatenate(arrays) if arrays else np.empty(0, np.int64))
+        np.save(os.path.join(path, "gene_ids.npy"), self.gene_ids)
+        np.save(os.path.join(path, "transcript_ids.npy"), self.transcript_ids)
+        # meta.json is written at last, a directory without it is an incomplete cache
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return None
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        load an index saved by AnnotationIndex.save.
+        :param path: the directory of the saved index
+        :param mmap_mode: passed to numpy.load, the arrays are memory-mapped by default and the partitions are views of
+                          the mapped files. None reads the arrays into memory.
+        :return: AnnotationIndex object
+        """
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in PARTITION_ARRAYS}
+        partitions = {}
+        for chr_num, strand, offset, length in meta["partitions"]:
+            partitions[(chr_num, strand)] = StrandIndex(*(arrays[name][offset: offset + length]
+                                                          for name in PARTITION_ARRAYS))
+        gene_ids = np.load(os.path.join(path, "gene_ids.npy"))
+        transcript_ids = np.load(os.path.join(path, "transcript_ids.npy"))
+        return cls(meta["element_names"], gene_ids, transcript_ids, partitions)
+
+
+class LazyAnnotationIndex(AnnotationIndex):
+    """
+    an AnnotationIndex whose partitions are built chromosome by chromosome, the first time get is called for the
+    chromosome, see GtfReader.load_index with lazy. partitions, gene_ids and transcript_ids hold the chromosomes
+    loaded so far, load_all loads the others.
+    """
+    def __init__(self, element_names, chromosomes, loader):
+        """
+        :param element_names: element names, the code of an element is its position in this list
+        :param chromosomes: the chromosomes which can be loaded
+        :param loader: function building the AnnotationIndex of one chromosome
+        """
+        super(LazyAnnotationIndex, self).__init__(element_names, np.empty(0, dtype=str), np.empty(0, dtype=str), {})
+        self.chromosomes = set(chromosomes)
+        self.loader = loader
+        # the mapping service looks up chromosomes from several threads
+        self.lock = threading.Lock()
+
+    def get(self, chr_num, strand):
+        if chr_num in self.chromosomes:
+            with self.lock:
+                if chr_num in self.chromosomes:
+                    self.load_chromosome(chr_num)
+        return self.partitions.get((chr_num, strand))
+
+    def load_chromosome(self, chr_num):
+        """
+        build the partitions of one chromosome, its gene and transcript codes are appended behind the loaded ones.
+        """
+        chromosome = self.loader(chr_num)
+        for key, partition in chromosome.partitions.items():
+            partition.transcripts += len(self.transcript_ids)
+            partition.genes += len(self.gene_ids)
+            self.partitions[key] = partition
+        self.gene_ids = np.concatenate([self.gene_ids, chromosome.gene_ids])
+        self.transcript_ids = np.concatenate([self.transcript_ids, chromosome.transcript_ids])
+        self.chromosomes.discard(chr_num)
+        return None
+
+    def load_all(self):
+        """
+        load the chromosomes which have not been looked up yet.
+        :return: self
+        """
+        with self.lock:
+            for chr_num in sorted(self.chromosomes):
+                self.load_chromosome(chr_num)
+        return self
+
+    def hierarchy(self):
+        self.load_all()
+        return super(LazyAnnotationIndex, self).hierarchy()
+
+    def update(self, records, remove_ids=()):
+        self.load_all()
+        return super(LazyAnnotationIndex, self).update(records, remove_ids)
+
+    def save(self, path):
+        self.load_all()
+        return super(LazyAnnotationIndex, self).save(path)
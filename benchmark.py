@@ -0,0 +1,292 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Benchmark of the peak mapping pipeline on synthetic data.
+    generate_gtf writes a GTF file with multi-isoform genes (isoforms share and skip exons, genes on the two strands
+    overlap, records of negative strand transcripts are listed in descending order as Ensembl does), generate_bed
+    writes BED6 or BED12 peaks spread uniformly over the chromosomes. Every stage of the pipeline is timed on its own,
+    optionally with its peak memory (tracemalloc, in a second run as tracing slows Python code down), and the result
+    is written as JSON so that runs of different versions can be compared.
+    usage: python benchmark.py --genes 2000 --peaks 100000 --output bench.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ELEMENT_PRIORITY = {"stop_codon": 1, "three_prime_utr": 2, "CDS": 3, "five_prime_utr": 4}
+ELEMENT_DISTANCE = {"stop_codon": 200, "three_prime_utr": 200, "CDS": 100, "five_prime_utr": 0}
+
+
+def generate_gtf(gtf_file, chromosomes=4, genes=2000, max_isoforms=4, seed=0):
+    """
+    write a synthetic GTF file.
+    :param gtf_file: output path
+    :param chromosomes: the number of chromosomes
+    :param genes: the number of genes on each chromosome
+    :param max_isoforms: the largest number of transcripts of a gene
+    :param seed: random seed
+    :return: the length of the chromosomes
+    """
+    rand = random.Random(seed)
+    gene_num = 0
+    chromosome_length = 0
+    with open(gtf_file, "w") as f:
+        f.write("#!genome-build synthetic\n")
+        for chr_index in range(1, chromosomes + 1):
+            chr_num = "chr%d" % chr_index
+            position = rand.randint(1000, 10000)
+            for _ in range(genes):
+                gene_num += 1
+                strand = rand.choice("+-")
+                gene_id = "ENSG%011d.%d" % (gene_num, rand.randint(1, 20))
+                # exons of the gene, isoforms are built from a subset of them
+                exons, exon_start = [], position
+                for _ in range(rand.randint(2, 12)):
+                    exon_end = exon_start + rand.randint(50, 600)
+                    exons.append((exon_start, exon_end))
+                    exon_start = exon_end + rand.randint(100, 5000)
+                transcripts = []
+                for isoform in range(rand.randint(1, max_isoforms)):
+                    kept = [exon for exon in exons if rand.random() > 0.25] or exons[:1]
+                    transcripts.append(("ENST%011d.%d" % (gene_num * 10 + isoform, rand.randint(1, 9)), kept))
+                gene_end = exons[-1][1]
+                f.write(gtf_line(chr_num, "gene", exons[0][0], gene_end, strand, gene_id, None))
+                for transcript_id, kept in transcripts:
+                    for line in transcript_lines(chr_num, strand, gene_id, transcript_id, kept, rand):
+                        f.write(line)
+                # genes overlap now and then, usually on the other strand
+                position = gene_end + (rand.randint(-3000, 0) if rand.random() < 0.1 else rand.randint(500, 20000))
+                position = max(position, exons[0][0] + 1)
+            chromosome_length = max(chromosome_length, position)
+    return chromosome_length
+
+
+def transcript_lines(chr_num, strand, gene_id, transcript_id, exons, rand):
+    """
+    the records of one transcript: transcript, exon, five_prime_utr, CDS, stop_codon and three_prime_utr. Elements
+    are placed on the spliced transcript and split over the exons they span.
+    """
+    length = sum(end - start + 1 for start, end in exons)
+    # spliced positions in the direction of transcription
+    cds_from = rand.randint(0, length // 4)
+    stop_from = max(rand.randint(length // 2, length - 4), cds_from + 3)
+    parts = (("five_prime_utr", 0, cds_from), ("CDS", cds_from, stop_from), ("stop_codon", stop_from, stop_from + 3),
+             ("three_prime_utr", stop_from + 3, length))
+    ordered_exons = exons if strand == "+" else exons[::-1]
+    records = [("exon", start, end) for start, end in ordered_exons]
+    for feature, low, high in parts:
+        offset = 0
+        for start, end in ordered_exons:
+            size = end - start + 1
+            part_low, part_high = max(low, offset), min(high, offset + size)
+            if part_low < part_high:
+                if strand == "+":
+                    records.append((feature, start + part_low - offset, start + part_high - offset - 1))
+                else:
+                    records.append((feature, end - (part_high - offset - 1), end - (part_low - offset)))
+            offset += size
+    records.sort(key=lambda record: record[1], reverse=(strand == "-"))
+    records.insert(0, ("transcript", exons[0][0], exons[-1][1]))
+    return [gtf_line(chr_num, feature, start, end, strand, gene_id, transcript_id)
+            for feature, start, end in records]
+
+
+def gtf_line(chr_num, feature, start, end, strand, gene_id, transcript_id):
+    attributes = 'gene_id "%s";' % gene_id
+    if transcript_id is not None:
+        attributes += ' transcript_id "%s";' % transcript_id
+    attributes += ' gene_biotype "protein_coding";'
+    return "\t".join([chr_num, "synthetic", feature, str(start), str(end), ".", strand, ".", attributes]) + "\n"
+
+
+def generate_bed(bed_file, chromosome_length, chromosomes=4, peaks=100000, block_fraction=0.3, bed12=True, seed=1):
+    """
+    write synthetic peaks sorted by chromosome and start.
+    :param bed_file: output path
+    :param chromosome_length: peaks are placed in [0, chromosome_length)
+    :param chromosomes: the number of chromosomes
+    :param peaks: the number of peaks
+    :param block_fraction: the fraction of spliced peaks (several blocks), BED12 only
+    :param bed12: write BED12 records, otherwise BED6
+    :param seed: random seed
+    :return:
+    """
+    rand = random.Random(seed)
+    records = []
+    for i in range(peaks):
+        chr_index = rand.randint(1, chromosomes)
+        start = rand.randrange(0, chromosome_length)
+        if bed12 and rand.random() < block_fraction:
+            sizes = [rand.randint(20, 150) for _ in range(rand.randint(2, 4))]
+            offsets = [0]
+            for size in sizes[:-1]:
+                offsets.append(offsets[-1] + size + rand.randint(50, 2000))
+        else:
+            sizes, offsets = [rand.randint(50, 400)], [0]
+        records.append((chr_index, start, start + offsets[-1] + sizes[-1], rand.choice("+-"), sizes, offsets, i))
+    records.sort()
+    with open(bed_file, "w") as f:
+        for chr_index, start, end, strand, sizes, offsets, i in records:
+            fields = ["chr%d" % chr_index, str(start), str(end), "peak%d" % i, "0", strand]
+            if bed12:
+                fields += [str(start), str(end), "0", str(len(sizes)), ",".join(map(str, sizes)) + ",",
+                           ",".join(map(str, offsets))]
+            f.write("\t".join(fields) + "\n")
+    return None
+
+
+def measure(setup, run, repeat=1, memory=False):
+    """
+    time a stage. setup prepares the input (not timed), run is the stage itself.
+    :return: dict of the best time of the repeats, and the peak memory of one more run when memory is True
+    """
+    seconds = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(*args)
+        seconds.append(time.perf_counter() - start)
+    result = {"seconds": min(seconds), "repeat": repeat}
+    if memory:
+        args = setup()
+        gc.collect()
+        tracemalloc.start()
+        run(*args)
+        result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmark(workdir, chromosomes=4, genes=2000, peaks=100000, bed12=True, queries=100000, repeat=1,
+                  memory=False, seed=0, bin_sizes=(256, 1024, 4096)):
+    """
+    generate the data into workdir and benchmark every stage.
+    :return: benchmark report, type dict
+    """
+    from gtf_handler import GtfReader
+    from interval_tree import IntervalTree
+    from tree_node import ElementNode
+    from peak_reader import PeakReader
+    from peak_mapping import PeakMapper
+    from handle_peak_loc import deduplicate
+    import numpy as np
+
+    gtf_file, bed_file = os.path.join(workdir, "synthetic.gtf"), os.path.join(workdir, "synthetic.bed")
+    chromosome_length = generate_gtf(gtf_file, chromosomes, genes, seed=seed)
+    generate_bed(bed_file, chromosome_length, chromosomes, peaks, bed12=bed12, seed=seed + 1)
+    with open(gtf_file) as f:
+        gtf_lines = sum(1 for _ in f)
+
+    report = {"python": platform.python_version(), "platform": platform.platform(),
+              "params": {"chromosomes": chromosomes, "genes": genes, "peaks": peaks, "bed12": bed12,
+                         "queries": queries, "repeat": repeat, "seed": seed, "gtf_lines": gtf_lines},
+              "stages": {}}
+    stages = report["stages"]
+
+    def record(name, setup, run, **extra):
+        stages[name] = measure(setup, run, repeat, memory)
+        stages[name].update(extra)
+        print("%-24s %8.3fs" % (name, stages[name]["seconds"]), file=sys.stderr)
+
+    record("gtf_load", lambda: (GtfReader(gtf_file, ELEMENT_PRIORITY), ), lambda gr: gr.load_gtf(),
+           lines=gtf_lines)
+    record("gtf_build_index", lambda: (GtfReader(gtf_file, ELEMENT_PRIORITY), ), lambda gr: gr.build_index(),
+           lines=gtf_lines)
+
+    rand = random.Random(seed)
+    intervals = sorted((s, s + rand.randint(1, 2000))
+                       for s in (rand.randrange(chromosome_length) for _ in range(queries)))
+    points = [rand.randrange(chromosome_length) for _ in range(queries)]
+
+    def insert(tree, nodes):
+        for node in nodes:
+            tree.insert_interval(tree, node)
+
+    record("interval_tree_insert", lambda: (IntervalTree(), [ElementNode(i, "CDS") for i in intervals]), insert,
+           nodes=queries)
+    record("interval_tree_bulk_build", lambda: ([ElementNode(i, "CDS") for i in intervals], ),
+           IntervalTree.from_sorted, nodes=queries)
+    tree = IntervalTree.from_sorted([ElementNode(i, "CDS") for i in intervals])
+    record("interval_tree_search", lambda: (), lambda: [tree.search(tree.root, p) for p in points], queries=queries)
+
+    record("peak_info", lambda: (PeakReader(bed_file), ), lambda pr: pr.peak_info(), peaks=peaks)
+
+    pr = PeakReader(bed_file)
+    pr.peak_info()
+    tree_mapper = PeakMapper(gtf_file, ELEMENT_PRIORITY, ELEMENT_DISTANCE, bed_file, backend="tree")
+    gtf_tree = tree_mapper.build_gtf_tree()
+    array_mapper = PeakMapper(gtf_file, ELEMENT_PRIORITY, ELEMENT_DISTANCE, bed_file, backend="array")
+    annotation_index = array_mapper.build_gtf_tree()
+    record("peak_mapping_tree", lambda: (gtf_tree, pr.peaks.copy()), tree_mapper.peak_mapping, peaks=peaks)
+    record("peak_mapping_array", lambda: (annotation_index, pr.peaks.copy()), array_mapper.peak_mapping,
+           peaks=peaks)
+
+    # the bin table trades memory for shorter candidate lists, each window size is timed with the size of its table
+    point_array = np.array(points, dtype=np.int64)
+    positions = [(partition, point_array) for partition in annotation_index.partitions.values()]
+    record("index_search", lambda: (), lambda: [partition.search(p) for partition, p in positions],
+           queries=sum(len(p) for _, p in positions))
+    for bin_size in bin_sizes:
+        tables = [partition.binned(bin_size) for partition in annotation_index.partitions.values()]
+        record("bin_search_%d" % bin_size, lambda: (), lambda: [partition.bins.search(p) for partition, p in positions],
+               queries=sum(len(p) for _, p in positions), bin_table_mb=sum(t.nbytes for t in tables) / 2 ** 20,
+               bin_entries=sum(t.entries for t in tables))
+        binned_mapper = PeakMapper(gtf_file, ELEMENT_PRIORITY, ELEMENT_DISTANCE, bed_file, backend="array",
+                                   bin_size=bin_size)
+        record("peak_mapping_array_bin_%d" % bin_size, lambda: (annotation_index, pr.peaks.copy()),
+               binned_mapper.peak_mapping, peaks=peaks)
+
+    mapped = array_mapper.peak_mapping(annotation_index, pr.peaks.copy())
+    record("dedup", lambda: (mapped.copy(), ELEMENT_PRIORITY, "element_name"), deduplicate, records=len(mapped))
+
+    try:
+        from draw_fig import PeakVisulizer
+    except ImportError as e:
+        stages["get_distribution"] = {"skipped": "cannot import draw_fig: %s" % e}
+        print("%-24s skipped (%s)" % ("get_distribution", e), file=sys.stderr)
+    else:
+        locations = mapped["location"].to_numpy()
+        record("get_distribution", lambda: (locations, ), PeakVisulizer.get_distribution, records=len(locations))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark", description="benchmark the peak mapping pipeline on "
+                                                                   "synthetic data")
+    parser.add_argument("--chromosomes", type=int, default=4, help="number of chromosomes")
+    parser.add_argument("--genes", type=int, default=2000, help="number of genes on each chromosome")
+    parser.add_argument("--peaks", type=int, default=100000, help="number of peaks")
+    parser.add_argument("--bed6", action="store_true", help="generate BED6 peaks instead of BED12")
+    parser.add_argument("--queries", type=int, default=100000, help="number of intervals and searches for the "
+                                                                    "interval tree stages")
+    parser.add_argument("--repeat", type=int, default=1, help="run each stage this many times, the best is reported")
+    parser.add_argument("--memory", action="store_true", help="also measure the peak memory of each stage")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--bin-sizes", type=int, nargs="*", default=[256, 1024, 4096],
+                        help="window sizes of the bin table stages")
+    parser.add_argument("--workdir", type=str, default=None, help="directory of the generated files, a temporary "
+                                                                  "directory by default")
+    parser.add_argument("-o", "--output", type=str, default=None, help="JSON report path, stdout by default")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = args.workdir or tmp_dir
+        os.makedirs(workdir, exist_ok=True)
+        result = run_benchmark(workdir, args.chromosomes, args.genes, args.peaks, not args.bed6, args.queries,
+                               args.repeat, args.memory, args.seed, args.bin_sizes)
+    if args.output is None:
+        print(json.dumps(result, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,270 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Command line entry point of the peak mapper, with the subcommands
+        map     map peak files on the genome elements (peak_mapping)
+        index   build the cached annotation index of a GTF file, so that later map runs only memory-map it
+        dedup   keep the record with the highest element priority of each peak of a peak location file
+        plot    plot the peak distribution of a peak location file or of its histogram sidecar
+    Workflow managers start the tool once per sample, so the start up time counts: this module only imports the
+    standard library, the modules of a subcommand (pandas, numpy, matplotlib ...) are imported when it runs. With
+    --report the seconds from the start of the interpreter to the first mapped peak are recorded as the "startup"
+    counter.
+    Element priorities and distances are given as a JSON object or as key=value pairs separated by commas, e.g.
+    -p stop_codon=1,three_prime_utr=2,CDS=3,five_prime_utr=4
+"""
+import argparse
+import json
+import sys
+import time
+import warnings
+from contextlib import nullcontext
+
+# the time the interpreter has spent before this module was imported is added by startup_seconds
+STARTED = time.perf_counter()
+
+
+def startup_seconds():
+    """
+    :return: the seconds since the interpreter started (the import of this module on platforms without
+             /proc/self/stat)
+    """
+    try:
+        import os
+        with open("/proc/self/stat", "r") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - STARTED
+
+
+def record_startup(mapper):
+    """
+    the mapped_hook of PeakMapper with --report: the start up time ends with the first chunk of peaks mapped.
+    :param mapper: PeakMapper object
+    """
+    if "startup" not in mapper.instrument.counters:
+        mapper.instrument.count("startup", startup_seconds())
+    return None
+
+
+def mapping_argument(text):
+    """
+    parse a JSON object, or key=value pairs separated by commas, into a dict of numbers.
+    :param text: command line value
+    :return: type dict
+    """
+    text = text.strip()
+    if text.startswith("{"):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError("invalid JSON object: %s" % e)
+    mapping = {}
+    for pair in filter(None, (pair.strip() for pair in text.split(","))):
+        key, sep, value = pair.partition("=")
+        if not sep or not key.strip():
+            raise argparse.ArgumentTypeError("expected key=value, got %r" % pair)
+        try:
+            mapping[key.strip()] = json.loads(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("the value of %s is not a number: %r" % (key.strip(), value))
+    return mapping
+
+
+def add_annotation_arguments(parser, distance=True):
+    parser.add_argument("-g", "--gtf", action="store", type=str, required=True, help="file path of GTF format file")
+    parser.add_argument("-p", "--priority", action="store", type=mapping_argument, required=True,
+                        help="element priorities, a JSON object or key=value pairs. Key is element, value represent "
+                             "priority.")
+    if distance:
+        parser.add_argument("-d", "--distance", action="store", type=mapping_argument, required=True,
+                            help="the offset of each element for figuring, a JSON object or key=value pairs")
+    parser.add_argument("-c", "--cache-dir", action="store", type=str, default=None,
+                        help="directory where the annotation index is cached between runs")
+    parser.add_argument("-w", "--workers", action="store", type=int, default=1,
+                        help="number of processes used to build the index and to map the peaks")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="peak_mapper", description="map the merip-seq, medip-seq peaks on genome "
+                                                                     "elements")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    map_parser = subparsers.add_parser("map", help="map peak files on the genome elements")
+    add_annotation_arguments(map_parser)
+    map_parser.add_argument("-pk", "--peak", action="store", type=str, nargs="+", required=True,
+                            help="file path of BED format peak file. Several files or glob patterns map the samples "
+                                 "in batch against one loaded annotation, see --output-dir")
+    map_parser.add_argument("-o", "--output", action="store", type=str, default=None,
+                            help="file path of output file")
+    map_parser.add_argument("--output-dir", action="store", type=str, default=None,
+                            help="batch mode: write one result per peak file and summary.tsv into this directory")
+    map_parser.add_argument("--output-format", action="store", choices=("tsv", "parquet", "feather"), default="tsv",
+                            help="format of the files written into --output-dir; the format of -o/--output follows "
+                                 "its extension (.parquet, .feather, otherwise TSV)")
+    map_parser.add_argument("-b", "--backend", action="store", choices=("tree", "array"), default="array",
+                            help="search the interval trees or the array index")
+    map_parser.add_argument("-s", "--chunk-size", action="store", type=int, default=None,
+                            help="stream the peak file in chunks of this many peaks, keeping memory flat")
+    map_parser.add_argument("--report", action="store", type=str, default=None,
+                            help="write stage timings and search counters of the run into this JSON file")
+    map_parser.add_argument("--memory", action="store_true",
+                            help="also record the peak memory of each stage in the --report file (slower)")
+    map_parser.add_argument("--profile", action="store", type=str, default=None,
+                            help="profile the run with cProfile and dump the statistics into this file")
+    map_parser.add_argument("--histogram", action="store", type=str, default=None,
+                            help="write the metagene histograms of the mapped peaks into this JSON file, for plot")
+    map_parser.add_argument("--dedup", action="store_true",
+                            help="keep only the record with the highest element priority of each peak")
+    map_parser.add_argument("--overlap", action="store", choices=("center", "interval"), default="center",
+                            help="match the elements containing the peak center, or overlapping any part of the "
+                                 "peak (backend array only)")
+    map_parser.add_argument("--delta-gtf", action="store", type=str, default=None,
+                            help="GTF file of transcripts added to the annotation, replacing those with the same id")
+    map_parser.add_argument("--remove-id", action="append", default=[],
+                            help="transcript id or gene id removed from the annotation, may be repeated")
+    map_parser.add_argument("--hits", action="store", choices=("best", "all"), default="best",
+                            help="write the best element of each peak, or every element it matches with the "
+                                 "transcript and gene ids (backend array only)")
+    map_parser.add_argument("--lazy", action="store_true",
+                            help="build the annotation of a chromosome only when a peak is mapped on it")
+    map_parser.add_argument("--cache-size", action="store", type=int, default=100000,
+                            help="the number of peak positions whose result is cached by the tree backend, 0 to "
+                                 "disable")
+    map_parser.add_argument("--bin-size", action="store", type=int, default=None,
+                            help="look the peaks up in a table of fixed windows of this many bases (backend array "
+                                 "only); smaller windows are faster and larger, see the bin counters of --report")
+    map_parser.set_defaults(run=run_map)
+
+    index_parser = subparsers.add_parser("index", help="build the cached annotation index of a GTF file")
+    add_annotation_arguments(index_parser, distance=False)
+    index_parser.add_argument("--hash", action="store_true",
+                              help="key the cache on the SHA1 of the GTF content instead of its size and mtime")
+    index_parser.set_defaults(run=run_index)
+
+    dedup_parser = subparsers.add_parser("dedup", help="keep the best record of each peak of a peak location file")
+    dedup_parser.add_argument("input", action="store", type=str,
+                              help="peak location file written by map, TSV, Parquet or Feather")
+    dedup_parser.add_argument("-o", "--output", action="store", type=str, required=True,
+                              help="file path of output file, the format follows its extension")
+    dedup_parser.add_argument("-p", "--priority", action="store", type=mapping_argument, required=True,
+                              help="element priorities, a JSON object or key=value pairs")
+    dedup_parser.add_argument("-s", "--chunk-size", action="store", type=int, default=1000000,
+                              help="the number of records held in memory at a time")
+    dedup_parser.set_defaults(run=run_dedup)
+
+    plot_parser = subparsers.add_parser("plot", help="plot the peak distribution on the metagene")
+    plot_parser.add_argument("input", action="store", type=str,
+                             help="peak location file written by map, or its histogram sidecar (.json)")
+    plot_parser.add_argument("-o", "--output", action="store", type=str, default="peak.png",
+                             help="file path of the figure")
+    plot_parser.add_argument("--bandwidth", action="store", type=str, default=None,
+                             help="a fixed bandwidth, or silverman / scott; chosen by cross validation if not given")
+    plot_parser.add_argument("--bandwidth-range", action="store", type=float, nargs=2, default=(1.0, 6.0),
+                             help="the bandwidths tried by cross validation")
+    plot_parser.add_argument("--bandwidth-steps", action="store", type=int, default=500,
+                             help="the number of bandwidths tried by cross validation")
+    plot_parser.add_argument("--bins", action="store", type=int, default=300, help="bin number of the histogram")
+    plot_parser.set_defaults(run=run_plot)
+    return parser
+
+
+def run_map(parser, args):
+    import glob
+    from instrumentation import Instrumentation, instrument_stage
+    from peak_mapping import PeakMapper
+    from table_io import write_table
+
+    peak_files = [f for pattern in args.peak for f in (sorted(glob.glob(pattern)) if glob.has_magic(pattern)
+                                                       else [pattern])]
+    batch = len(peak_files) != 1 or args.output_dir is not None
+    if batch and args.output_dir is None:
+        parser.error("--output-dir is required to map several peak files")
+    if not batch and args.output is None:
+        parser.error("-o/--output is required to map one peak file")
+    if args.memory and args.report is None:
+        parser.error("--memory records the peak memory into the report, it requires --report")
+
+    instrument = Instrumentation(memory=args.memory) if args.report else None
+    pm = PeakMapper(args.gtf, args.priority, args.distance, peak_files[0] if peak_files else None, backend=args.backend,
+                    cache_dir=args.cache_dir, workers=args.workers, instrument=instrument,
+                    histogram=args.histogram is not None, dedup=args.dedup, overlap=args.overlap,
+                    delta_gtf=args.delta_gtf, remove_ids=args.remove_id, cache_size=args.cache_size,
+                    lazy=args.lazy, hits=args.hits, bin_size=args.bin_size,
+                    mapped_hook=record_startup if instrument is not None else None)
+    with Instrumentation.profile(args.profile) if args.profile else nullcontext():
+        tree = pm.build_gtf_tree()
+        if batch:
+            pm.map_samples(tree, peak_files, args.output_dir, args.chunk_size, args.output_format)
+        elif args.chunk_size:
+            pm.stream_mapping(tree, args.output, args.chunk_size)
+        else:
+            peak = pm.load_peak_data()
+            peak = pm.peak_mapping(tree, peak)
+            with instrument_stage(instrument, "write_output"):
+                write_table(peak, args.output)
+    if args.histogram:
+        pm.histogram.save(args.histogram)
+    if instrument is not None:
+        instrument.write_json(args.report)
+    return 0
+
+
+def run_index(parser, args):
+    from gtf_handler import GtfReader
+
+    if args.cache_dir is None:
+        parser.error("-c/--cache-dir is required to build the index")
+    gr = GtfReader(args.gtf, args.priority, cache_dir=args.cache_dir, cache_hash=args.hash, workers=args.workers)
+    annotation_index = gr.load_index()
+    elements = sum(len(partition) for partition in annotation_index.partitions.values())
+    print("%s\t%d partitions\t%d elements" % (gr.cache_path(), len(annotation_index.partitions), elements))
+    return 0
+
+
+def run_dedup(parser, args):
+    from handle_peak_loc import external_deduplicate
+    from table_io import TableWriter, infer_types
+
+    with TableWriter(args.output) as writer:
+        for peaks in external_deduplicate(args.input, args.priority, chunk_size=args.chunk_size):
+            writer.write(peaks if writer.format == "tsv" else infer_types(peaks))
+    return 0
+
+
+def run_plot(parser, args):
+    from draw_fig import PeakVisulizer
+
+    bandwidth = args.bandwidth
+    if bandwidth is not None and bandwidth not in ("silverman", "scott"):
+        bandwidth = float(bandwidth)
+    if args.input.endswith(".json"):
+        pv = PeakVisulizer(None, args.input)
+        location, weights = pv.peak_histogram()
+    else:
+        pv = PeakVisulizer(args.input)
+        location, weights = pv.peak_location(), None
+    kde_data, kde_bandwidth = pv.get_distribution(location, tuple(args.bandwidth_range), args.bandwidth_steps,
+                                                  bandwidth=bandwidth, weights=weights)
+    pv.visulize(kde_data, kde_bandwidth, location, args.bins, weights=weights, output=args.output)
+    return 0
+
+
+def main(argv=None):
+    """
+    :param argv: the command line arguments without the program name, sys.argv[1:] if None
+    :return: exit status
+    """
+    warnings.filterwarnings("ignore")
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    return args.run(parser, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,59 +1,185 @@
 # -*- coding:utf-8 -*-
-import pandas as pd
 import numpy as np
+from metagene import MetageneHistogram
+from table_io import read_column
 import matplotlib
 matplotlib.use("Agg")
 from matplotlib import pyplot as plt
-from sklearn.neighbors import KernelDensity
-from sklearn.grid_search import GridSearchCV
 import warnings
+import os
 
 
 class PeakVisulizer:
     """
     visulize the peak distribution for the peak calling result.
     """
-    def __init__(self, peak_location_file):
+    def __init__(self, peak_location_file, histogram_file=None):
         """
         :param peak_location_file: the output result of PeakMapper
+        :param histogram_file: the metagene histogram sidecar written by PeakMapper (option --histogram)
         """
         self.peak_file = peak_location_file
+        self.histogram_file = histogram_file
 
     def peak_location(self):
-        peak_loc = pd.read_csv(self.peak_file, sep="\t", usecols=[7])
-        peak_loc = peak_loc.values.flatten()
-        return peak_loc
+        """
+        read the location column of the peak location file (TSV, Parquet or Feather, see table_io).
+        """
+        return read_column(self.peak_file, "location")
+
+    def peak_histogram(self, element=None):
+        """
+        read the peak locations from the histogram sidecar instead of the whole peak location file.
+        :param element: the element whose histogram is used, None for all the peaks
+        :return: bin centers and peak counts of the bins, type numpy array
+        """
+        metagene = MetageneHistogram.load(self.histogram_file)
+        edges = metagene.edges
+        counts = metagene.total if element is None else metagene.counts[metagene.element_names.index(element)]
+        return (edges[:-1] + edges[1:]) / 2, counts.astype(np.float64)
 
     @staticmethod
-    def get_distribution(peak_loc_data, bandwidth_test_range=(0.1, 1.0), test_step=30, cv_num=10):
+    def get_distribution(peak_loc_data, bandwidth_test_range=(0.1, 1.0), test_step=30, cv_num=10, bandwidth=None,
+                         weights=None):
         """
         use guassian kernel density function to fit the peak location data and got its contiunous distribution.
+        The data is linearly binned on a fine grid and the density is computed by FFT convolution, so the cost does
+        not depend on the number of peaks after binning.
         :param peak_loc_data: the peak location data from the peak location file, type numpy array
         :param bandwidth_test_range: the value range of bandwidth, type list or tuple
         :param test_step: the bandwidth range will be equally splited into pieces
-        :param cv_num: the cross validation number for grid search cross validation
+        :param cv_num: the cross validation number for the likelihood cross validation of the bandwidths
+        :param bandwidth: a fixed bandwidth, or "silverman" / "scott" for the rule of thumb. None to choose the
+                          bandwidth in bandwidth_test_range by cross validation
+        :param weights: the number of peaks at each value of peak_loc_data, e.g. the counts of peak_histogram. The
+                        bandwidth is then chosen by leave-one-out likelihood cross validation, as the peaks of a
+                        histogram have no order to split folds on
         :return:
         """
         bins = np.array(list(range(0, 301)))
-        # use grid search to find the kernel density estimator with best "bandwidth" param
-        low_limit, high_limit = bandwidth_test_range
-        grid = GridSearchCV(KernelDensity(), param_grid={"bandwidth": np.linspace(low_limit, high_limit, test_step)}, cv=cv_num)
-        grid.fit(peak_loc_data[:, None])
-        best_banwidth = grid.best_params_
-        kde = grid.best_estimator_
-        pdf = np.exp(kde.score_samples(bins[:, None]))
+        peak_loc_data = np.asarray(peak_loc_data, dtype=np.float64).ravel()
+        weighted = weights is not None
+        weights = np.ones(len(peak_loc_data)) if weights is None else np.asarray(weights, dtype=np.float64).ravel()
+        finite = np.isfinite(peak_loc_data) & (weights > 0)
+        peak_loc_data, weights = peak_loc_data[finite], weights[finite]
+        if not len(peak_loc_data):
+            raise ValueError("no peak location to fit the distribution on")
+        peak_num = weights.sum()
+        if isinstance(bandwidth, str):
+            bandwidth = PeakVisulizer.rule_of_thumb(peak_loc_data, bandwidth, weights)
+        if bandwidth is not None:
+            bandwidths = np.array([bandwidth], dtype=np.float64)
+        else:
+            low_limit, high_limit = bandwidth_test_range
+            bandwidths = np.linspace(low_limit, high_limit, test_step)
+        if not (bandwidths > 0).all():
+            raise ValueError("the bandwidth must be positive, got %s" % bandwidths[~(bandwidths > 0)][0])
+
+        # the grid step divides the bins step and is small enough for the smallest bandwidth
+        grid_step = 1.0 / np.ceil(4.0 / min(bandwidths.min(), 4.0))
+        pad = 5 * bandwidths.max()
+        grid_start = np.floor(min(bins[0], peak_loc_data.min()) - pad)
+        grid_end = max(bins[-1], peak_loc_data.max()) + pad
+        grid_size = int(np.ceil((grid_end - grid_start) / grid_step)) + 2
+        position = (peak_loc_data - grid_start) / grid_step
+
+        if bandwidth is None and not weighted:
+            # k fold likelihood cross validation on the binned data, the folds are consecutive as in sklearn KFold
+            folds = np.arange(len(position)) * cv_num // len(position)
+            fold_counts = PeakVisulizer.linear_binning(position, grid_size, folds, cv_num)
+            counts = fold_counts.sum(axis=0)
+            fold_sizes = np.bincount(folds, minlength=cv_num)
+            scores = np.zeros(len(bandwidths))
+            for fold in range(cv_num):
+                train = PeakVisulizer.gaussian_smooth(counts - fold_counts[fold], bandwidths, grid_step)
+                train /= len(position) - fold_sizes[fold]
+                scores += (np.log(np.maximum(train, 1e-300)) * fold_counts[fold]).sum(axis=1)
+            bandwidth = bandwidths[np.argmax(scores)]
+        else:
+            counts = PeakVisulizer.linear_binning(position, grid_size, np.zeros(len(position), dtype=np.int64), 1,
+                                                  weights)[0]
+        if bandwidth is None:
+            # leave-one-out: remove the kernel of the peak itself from the density at its own position
+            smooth = PeakVisulizer.gaussian_smooth(counts, bandwidths, grid_step)
+            smooth -= 1 / (bandwidths[:, None] * np.sqrt(2 * np.pi))
+            scores = (np.log(np.maximum(smooth / (peak_num - 1), 1e-300)) * counts).sum(axis=1)
+            bandwidth = bandwidths[np.argmax(scores)]
+
+        pdf = PeakVisulizer.gaussian_smooth(counts, np.array([bandwidth]), grid_step)[0] / peak_num
+        pdf = np.maximum(pdf, 0.0)
+        pdf = pdf[np.rint((bins - grid_start) / grid_step).astype(np.int64)]
         pdf = pdf.tolist()
         kde_plots = np.array(list(zip(bins, pdf)))
 
-        return kde_plots, best_banwidth
+        return kde_plots, {"bandwidth": float(bandwidth)}
+
+    @staticmethod
+    def linear_binning(position, grid_size, groups, group_num, weights=None):
+        """
+        share the weight of each point between its two neighbour grid points.
+        :param position: the positions of the points in grid steps, type numpy array
+        :param grid_size: the number of grid points
+        :param groups: the group (fold) of each point, type numpy array
+        :param group_num: the number of groups
+        :param weights: the weight of each point, 1 if None
+        :return: the counts of each group on the grid, type numpy array of shape (group_num, grid_size)
+        """
+        left = np.floor(position).astype(np.int64)
+        weight = position - left
+        total = np.ones(len(position)) if weights is None else weights
+        index = groups * grid_size + left
+        counts = np.bincount(index, weights=total * (1.0 - weight), minlength=group_num * grid_size)
+        counts += np.bincount(index + 1, weights=total * weight, minlength=group_num * grid_size)
+        return counts.reshape(group_num, grid_size)
+
+    @staticmethod
+    def gaussian_smooth(counts, bandwidths, grid_step):
+        """
+        convolve the binned counts with a gaussian kernel of each bandwidth by FFT.
+        :param counts: binned counts, type numpy array
+        :param bandwidths: type numpy array
+        :param grid_step: the distance between two grid points
+        :return: sum of the kernels on each grid point for each bandwidth, type numpy array of shape
+                 (len(bandwidths), len(counts))
+        """
+        size = len(counts)
+        freq = np.fft.rfftfreq(size, d=grid_step)
+        kernel = np.exp(-0.5 * (2 * np.pi * freq[None, :] * bandwidths[:, None]) ** 2)
+        return np.fft.irfft(np.fft.rfft(counts)[None, :] * kernel, n=size, axis=1) / grid_step
+
+    @staticmethod
+    def rule_of_thumb(peak_loc_data, rule="silverman", weights=None):
+        """
+        :param peak_loc_data: type numpy array
+        :param rule: "silverman" or "scott"
+        :param weights: the number of peaks at each value of peak_loc_data, 1 if None
+        :return: bandwidth
+        """
+        weighted = weights is not None
+        weights = np.ones(len(peak_loc_data)) if weights is None else weights
+        n = weights.sum()
+        mean = np.average(peak_loc_data, weights=weights)
+        std = np.sqrt(np.sum(weights * (peak_loc_data - mean) ** 2) / (n - 1))
+        order = np.argsort(peak_loc_data)
+        cum_weights = np.cumsum(weights[order])
+        quartiles = peak_loc_data[order][np.searchsorted(cum_weights, [0.75 * n, 0.25 * n])]
+        iqr = quartiles[0] - quartiles[1]
+        if rule == "silverman":
+            spread = min(std, iqr / 1.34) if iqr > 0 else std
+            return 0.9 * spread * n ** (-0.2)
+        if rule == "scott":
+            return 1.06 * std * n ** (-0.2)
+        raise ValueError("unknown bandwidth rule %s" % rule)
 
     @staticmethod
-    def visulize(kde_plots, kde_bandwidth, real_plots, bins_num):
+    def visulize(kde_plots, kde_bandwidth, real_plots, bins_num, weights=None, output="peak.png"):
         """
         :param kde_plots: plots got from kernel density function
         :param kde_bandwidth: the bandwidth parameter of KDE function
         :param real_plots: the real data
         :param bins_num: bin number for hist plot
+        :param weights: the number of peaks at each value of real_plots, when they are the bin centers of a histogram
+        :param output: file path of the figure
         :return:
         """
         x = np.array([i[0] for i in kde_plots])
@@ -62,18 +188,23 @@ class PeakVisulizer:
         ax = fig.add_subplot(1, 1, 1)
         ax.plot(x, y, color="blue", alpha=0.5, label="peak distribut with bw = %s" % kde_bandwidth["bandwidth"])
         # use hist plot to judge the kde function effect
-        ax.hist(real_plots, bins_num, fc="gray", histtype="stepfilled", alpha=0.3, normed=True,
+        ax.hist(real_plots, bins_num, weights=weights, fc="gray", histtype="stepfilled", alpha=0.3, density=True,
                 label="hist plot of real data")
         ax.set_xlim(0, 300)
         ax.set_ylim(0, 0.012)
         ax.legend(loc="upper left")
-        plt.savefig("peak.png")
+        plt.savefig(output)
+        plt.close(fig)
 
 
 if __name__ == "__main__":
     warnings.filterwarnings("ignore")
-    pv = PeakVisulizer(r"/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/reference_files/peak_loc.tsv")
-    loca_data = pv.peak_location()
-    kde_data, bandwidth = pv.get_distribution(loca_data, (1.0, 6.0), test_step=500)
-    pv.visulize(kde_data, bandwidth, loca_data, 300)
+    reference_dir = r"/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/reference_files"
+    pv = PeakVisulizer(os.path.join(reference_dir, "peak_loc.tsv"), os.path.join(reference_dir, "peak_loc.hist.json"))
+    if os.path.isfile(pv.histogram_file):
+        loca_data, peak_counts = pv.peak_histogram()
+    else:
+        loca_data, peak_counts = pv.peak_location(), None
+    kde_data, bandwidth = pv.get_distribution(loca_data, (1.0, 6.0), test_step=500, weights=peak_counts)
+    pv.visulize(kde_data, bandwidth, loca_data, 300, weights=peak_counts)
 
@@ -11,116 +11,658 @@ Description:
 """
 from tree_node import GeneNode, TranscriptNode, ElementNode
 from interval_tree import IntervalTree
-import re
+from annotation_index import AnnotationIndex, LazyAnnotationIndex
+from instrumentation import instrument_stage
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import hashlib
+import io
+import json
 import os
+import shutil
+import sys
+import tempfile
+import threading
 
 
 class GtfReader:
     """
     extract useful informations from GTF files and build interval tree for each gene.
     """
-    def __init__(self, gtf_file, element_priority):
+    def __init__(self, gtf_file, element_priority, cache_dir=None, cache_hash=False, workers=1, instrument=None,
+                 lazy=False):
         """
         :param gtf_file: the path of GTF file, type string.
         :param element_priority: the element which need to be extracted from the file with its priority. The smaller
                                  value, the higher priority, type dict.
+        :param cache_dir: the directory where load_index keeps the built AnnotationIndex, None for no cache.
+        :param cache_hash: key the cache on the SHA1 of the GTF content instead of its size and modification time.
+        :param workers: the number of processes used by build_index, chromosomes are indexed in parallel when > 1.
+        :param instrument: Instrumentation object recording the stages of load_index, None to disable.
+        :param lazy: build the trees (load_gtf) or the index (load_index without cache_dir) of a chromosome only when
+                     it is first looked up, from its byte ranges in the GTF file. Ignored for gzipped GTF files.
         """
         self.gtf_file = gtf_file
+        self.workers = workers
+        self.instrument = instrument
+        self.cache_dir = cache_dir
+        self.cache_hash = cache_hash
+        self.lazy = lazy and not gtf_file.endswith(".gz")
+        # the byte ranges of each chromosome, read by chromosome_ranges
+        self.ranges = {}
         self.element_priority = element_priority
         self.target_element = self.element_priority.keys()
-        self.gene_pattern = re.compile(r"gene_id \"([A-Z]+[0-9]+)\"")
-        self.trans_pattern = re.compile(r"transcript_id \"([A-Z]+[0-9]+)\"")
         self.gtf_tree = {}
+        # gene_id -> (chr, strand, GeneNode) and transcript_id -> (GeneNode, TranscriptNode), built on the first update
+        self.gene_nodes = None
+        self.transcript_nodes = None
 
-    def load_gtf(self):
-        # get total line numer of the gtf file
-        total_line = os.popen("wc -l %s" % self.gtf_file)
-        total_line = int(re.sub(self.gtf_file, "", total_line.read()))
-        with open(self.gtf_file, "r") as f:
-            pre_chr, pre_gene, pre_trans = None, None, None
-            trans_node_list, trans_interval_list = [], []
-            element_interval_list, element_node_list = [], []
-            positive_strand_gene_node_list, negative_strand_gene_node_list = [], []
-            positive_strand_gene_interval_list, negative_strand_gene_interval_list = [], []
-            pre_strand = None
-            cur_line = 0
-            for line in f:
-                cur_line += 1
-                if line.startswith("#"):
-                    continue
-                info = line.split("\t")
-                # obtain the element name
-                element = info[2]
-                if element not in self.target_element:
-                    continue
-
-                chr_num, strand = info[0], info[6]
-                if chr_num not in self.gtf_tree.keys():
-                    self.gtf_tree[chr_num] = {}
-
-                cur_trans = re.findall(self.trans_pattern, info[8])[0]
-                if (cur_trans != pre_trans and pre_trans is not None) or cur_line == total_line:
-                    # when transcript change, build the element interval tree and append it into trans_list,
-                    # element_list will be clear simutaneously
-                    element_tree = GtfReader.build_tree(element_node_list)
-                    interval = (min(element_interval_list)[0], max(i[1] for i in element_interval_list))
-                    transcript_node = TranscriptNode(interval, pre_trans, elements=element_tree)
-                    trans_node_list.append(transcript_node)
-                    trans_interval_list.append(interval)
-                    element_interval_list.clear()
-                    element_node_list.clear()
-
-                element_start, element_end = int(info[3]), int(info[4])
-                element_node = ElementNode((element_start, element_end), element)
-                element_interval_list.append((element_start, element_end))
-                element_node_list.append(element_node)
-
-                cur_gene = re.findall(self.gene_pattern, info[8])[0]
-                if (cur_gene != pre_gene and pre_gene is not None) or cur_line == total_line:
-                    # when genge change, build the transcript interval tree and append it into gene_list,
-                    # transcript_list will be clear simutaneously
-                    transcript_tree = GtfReader.build_tree(trans_node_list)
-                    interval = (min(trans_interval_list)[0], max(i[1] for i in trans_interval_list))
-                    gene_node = GeneNode(interval, pre_gene, transcripts=transcript_tree)
-                    if pre_strand == "+":
-                        positive_strand_gene_node_list.append(gene_node)
-                        positive_strand_gene_interval_list.append(interval)
+    def open_gtf(self):
+        """
+        open the GTF file in text mode, files ending with ".gz" are decompressed on the fly.
+        """
+        if self.gtf_file.endswith(".gz"):
+            return gzip.open(self.gtf_file, "rt")
+        return open(self.gtf_file, "r")
+
+    def records(self, byte_range=None):
+        """
+        parse the GTF file in one pass. Records are filtered on the feature column before any attribute is parsed.
+        :param byte_range: (start, end) byte offsets, only the lines in this range of an uncompressed GTF are parsed
+        :return: generator of (chr, strand, gene_id, transcript_id, element, element_start, element_end) in file order
+        """
+        if byte_range is None:
+            with self.open_gtf() as f:
+                yield from self.parse_lines(f)
+        else:
+            with open(self.gtf_file, "rb") as f:
+                f.seek(byte_range[0])
+                lines = io.StringIO(f.read(byte_range[1] - byte_range[0]).decode("utf-8"))
+            yield from self.parse_lines(lines)
+
+    def parse_lines(self, lines):
+        """
+        :param lines: GTF lines, type iterable of string
+        :return: see records, a ValueError is raised for a record of a target element without gene_id or transcript_id
+        """
+        # ids and names are interned, so that all the records of a gene/transcript/element share one string object
+        target_element = {element: sys.intern(element) for element in self.target_element}
+        attribute = GtfReader.attribute
+        intern = sys.intern
+        for line in lines:
+            if line.startswith("#"):
+                continue
+            info = line.split("\t", 8)
+            if len(info) < 9 or info[2] not in target_element:
+                continue
+            attributes = info[8]
+            gene_id, transcript_id = attribute(attributes, "gene_id"), attribute(attributes, "transcript_id")
+            if gene_id is None or transcript_id is None:
+                raise ValueError("GTF record without gene_id or transcript_id: %r" % line.rstrip("\n"))
+            yield (intern(info[0]), intern(info[6]), intern(gene_id), intern(transcript_id), target_element[info[2]],
+                   int(info[3]), int(info[4]))
+
+    def chromosome_offsets(self, chunk_size=1 << 23):
+        """
+        pre-scan an uncompressed GTF file for the byte range of every chromosome. The file is read in chunks of whole
+        lines and, from each line where the chromosome changes, the scan skips the run of consecutive lines of that
+        chromosome at once, see chromosome_run_end. A chromosome whose records are not consecutive (e.g. records
+        appended to a patched reference) gets several ranges.
+        :param chunk_size: the size of the chunks, in bytes
+        :return: list of (chr, start offset, end offset) covering the whole file, each range holds the records of one
+                 chromosome only
+        """
+        blocks = []
+        pre_chr, block_start, offset = None, 0, 0
+        with open(self.gtf_file, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                chunk += f.readline()
+                pos = 0
+                while pos < len(chunk):
+                    line_end = chunk.find(b"\n", pos) + 1 or len(chunk)
+                    tab = chunk.find(b"\t", pos, line_end)
+                    if chunk.startswith(b"#", pos) or tab < 0:
+                        pos = line_end
+                        continue
+                    chr_num = chunk[pos: tab]
+                    if chr_num != pre_chr:
+                        if pre_chr is not None:
+                            blocks.append((pre_chr.decode("utf-8"), block_start, offset + pos))
+                        pre_chr, block_start = chr_num, offset + pos
+                    pos = GtfReader.chromosome_run_end(chunk, pos, chr_num)
+                offset += len(chunk)
+        if pre_chr is not None:
+            blocks.append((pre_chr.decode("utf-8"), block_start, offset))
+        return blocks
+
+    @staticmethod
+    def chromosome_run_end(chunk, pos, chr_num):
+        """
+        find the end of the run of consecutive lines of a chromosome. The lines in chunk[a: b] all belong to the
+        chromosome when chunk[a: b] holds as many newlines as newlines followed by the chromosome name, so the run is
+        extended by windows of doubling size with two bytes.count, and the window where it stops is bisected. The cost
+        is linear in the run, whether the file is sorted by chromosome or not.
+        :param chunk: whole GTF lines, type bytes
+        :param pos: the start of a line of the chromosome
+        :param chr_num: chromosome name, type bytes
+        :return: the end offset of the last line of the run
+        """
+        prefix = b"\n" + chr_num + b"\t"
+
+        def consecutive(start, end):
+            # every line starting after a newline of chunk[start: end] belongs to the chromosome
+            return chunk.count(b"\n", start, end) == chunk.count(prefix, start, end + len(prefix) - 1)
+
+        # the last newline of the chunk starts no line
+        limit = len(chunk) - 1
+        good, step = pos + 1, 256
+        while good < limit:
+            probe = min(good + step, limit)
+            if not consecutive(good, probe):
+                while probe - good > 1:
+                    middle = (good + probe) // 2
+                    if consecutive(good, middle):
+                        good = middle
                     else:
-                        negative_strand_gene_node_list.append(gene_node)
-                        negative_strand_gene_interval_list.append(interval)
-                    trans_node_list.clear()
-                    trans_interval_list.clear()
-
-                if (chr_num != pre_chr and pre_chr is not None) or cur_line == total_line:
-                    pos_strand_tree = GtfReader.build_tree(positive_strand_gene_node_list)
-                    neg_strand_tree = GtfReader.build_tree(negative_strand_gene_node_list)
-                    pos_strand_interval = (min(positive_strand_gene_interval_list)[0], max(i[1] for i in positive_strand_gene_interval_list))
-                    neg_strand_interval = (min(negative_strand_gene_interval_list)[0], max(i[1] for i in negative_strand_gene_interval_list))
-                    positive_strand_gene_node_list.clear()
-                    positive_strand_gene_interval_list.clear()
-                    negative_strand_gene_node_list.clear()
-                    negative_strand_gene_interval_list.clear()
-                    self.gtf_tree[pre_chr]["+"], self.gtf_tree[pre_chr]["-"] = {}, {}
-                    self.gtf_tree[pre_chr]["+"]["interval"], self.gtf_tree[pre_chr]["+"]["gene_tree"] = pos_strand_interval, pos_strand_tree
-                    self.gtf_tree[pre_chr]["-"]["interval"], self.gtf_tree[pre_chr]["-"]["gene_tree"] = neg_strand_interval, neg_strand_tree
-
-                pre_trans = cur_trans
-                pre_gene = cur_gene
-                pre_chr = chr_num
-                pre_strand = strand
+                        probe = middle
+                break
+            good, step = probe, step * 2
+        last_line = chunk.rfind(b"\n", pos, good) + 1 or pos
+        return chunk.find(b"\n", last_line) + 1 or len(chunk)
+
+    @staticmethod
+    def attribute(attributes, name):
+        """
+        extract the value of an attribute from the attribute column with string slicing, any id format is accepted
+        (e.g. versioned Ensembl/GENCODE ids like ENST00000456328.2).
+        :param attributes: the 9th column of a GTF record
+        :param name: attribute name, such as gene_id
+        :return: attribute value, None if the attribute is absent
+        """
+        key = name + ' "'
+        if attributes.startswith(key):
+            start = len(key)
+        else:
+            start = attributes.find("; " + key)
+            if start >= 0:
+                start += len(key) + 2
+            else:
+                # attributes separated without space, e.g. 'gene_id "g1";transcript_id "t1";'
+                start = attributes.find(";" + key)
+                if start < 0:
+                    return None
+                start += len(key) + 1
+        return attributes[start: attributes.index('"', start)]
+
+    def load_gtf(self):
+        """
+        build interval trees of the GTF file into self.gtf_tree. With lazy, self.gtf_tree is a LazyGtfTree and the
+        trees of a chromosome are built when it is first looked up.
+        """
+        self.gene_nodes, self.transcript_nodes = None, None
+        if self.lazy:
+            self.gtf_tree = LazyGtfTree(self.chromosome_ranges(), self.load_chromosome_tree)
+        else:
+            self.gtf_tree = GtfReader.build_gtf_tree(self.records())
+        return None
+
+    def chromosome_ranges(self):
+        """
+        :return: the byte ranges of each chromosome, see chromosome_offsets, type dict
+        """
+        ranges = {}
+        for chr_num, start, end in self.chromosome_offsets():
+            ranges.setdefault(chr_num, []).append((start, end))
+        self.ranges = ranges
+        return ranges
+
+    def chromosome_records(self, chr_num):
+        """
+        :return: generator of the records of one chromosome, parsed from its byte ranges only
+        """
+        for byte_range in self.ranges.get(chr_num, []):
+            for record in self.records(byte_range):
+                if record[0] == chr_num:
+                    yield record
+
+    def load_chromosome_tree(self, chr_num):
+        """
+        :return: the trees of the strands of one chromosome, i.e. gtf_tree[chr_num]
+        """
+        with instrument_stage(self.instrument, "chromosome_load"):
+            if self.instrument is not None:
+                self.instrument.count("chromosomes_loaded")
+            return GtfReader.build_gtf_tree(self.chromosome_records(chr_num)).get(chr_num, {})
+
+    def load_chromosome_index(self, chr_num):
+        """
+        :return: the AnnotationIndex of one chromosome
+        """
+        with instrument_stage(self.instrument, "chromosome_load"):
+            if self.instrument is not None:
+                self.instrument.count("chromosomes_loaded")
+            return AnnotationIndex.from_records(self.chromosome_records(chr_num), list(self.target_element))
+
+    @staticmethod
+    def build_gtf_tree(records):
+        """
+        build the interval trees of GTF records. Elements of a transcript and transcripts of a gene are expected to be
+        consecutive records, as in the GTF files released by Ensembl and GENCODE.
+        :param records: iterable of (chr, strand, gene_id, transcript_id, element, start, end), see records
+        :return: gtf_tree, type dict
+        """
+        gtf_tree = {}
+        gene_node_list = {}
+        pre_gene, pre_trans, pre_key = None, None, None
+        trans_node_list, element_node_list = [], []
+
+        def transcript_node():
+            element_tree = GtfReader.build_tree(element_node_list)
+            interval = (min(e.interval_start for e in element_node_list),
+                        max(e.interval_end for e in element_node_list))
+            element_node_list.clear()
+            return TranscriptNode(interval, pre_trans, elements=element_tree)
+
+        def gene_node():
+            transcript_tree = GtfReader.build_tree(trans_node_list)
+            interval = (min(t.interval_start for t in trans_node_list), max(t.interval_end for t in trans_node_list))
+            trans_node_list.clear()
+            return GeneNode(interval, pre_gene, transcripts=transcript_tree)
+
+        for chr_num, strand, cur_gene, cur_trans, element, element_start, element_end in records:
+            if cur_trans != pre_trans and pre_trans is not None:
+                # when transcript change, build the element interval tree of the previous transcript
+                trans_node_list.append(transcript_node())
+            if cur_gene != pre_gene and pre_gene is not None:
+                # when gene change, build the transcript interval tree of the previous gene
+                gene_node_list.setdefault(pre_key, []).append(gene_node())
+            element_node_list.append(ElementNode((element_start, element_end), element))
+            pre_gene, pre_trans, pre_key = cur_gene, cur_trans, (chr_num, strand)
+
+        if pre_trans is not None:
+            trans_node_list.append(transcript_node())
+            gene_node_list.setdefault(pre_key, []).append(gene_node())
+
+        for (chr_num, strand), gene_nodes in gene_node_list.items():
+            interval = (min(g.interval_start for g in gene_nodes), max(g.interval_end for g in gene_nodes))
+            gtf_tree.setdefault(chr_num, {})[strand] = {"interval": interval,
+                                                        "gene_tree": GtfReader.build_tree(gene_nodes)}
+        return gtf_tree
+
+    def cache_key(self):
+        """
+        the key of the index cache. It changes with the GTF path, the GTF size and modification time (or its content
+        when cache_hash is set) and the extracted elements, so a stale cache is never loaded.
+        :return: hex digest, type string
+        """
+        gtf_path = os.path.abspath(self.gtf_file)
+        stat = os.stat(gtf_path)
+        key = {"gtf": gtf_path, "size": stat.st_size, "elements": list(self.target_element)}
+        if self.cache_hash:
+            content = hashlib.sha1()
+            with open(gtf_path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    content.update(block)
+            key["sha1"] = content.hexdigest()
+        else:
+            key["mtime"] = stat.st_mtime_ns
+        return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def cache_path(self):
+        """
+        :return: the directory of the cached index of this GTF file
+        """
+        name = "%s.%s.idx" % (os.path.basename(self.gtf_file), self.cache_key()[:16])
+        return os.path.join(self.cache_dir, name)
+
+    def load_index(self):
+        """
+        get the AnnotationIndex of the GTF file. With cache_dir set, the index is loaded memory-mapped from the cache
+        when the cache key matches, otherwise it is built from the GTF file and written into the cache.
+        :return: AnnotationIndex object
+        """
+        if self.cache_dir is None:
+            if self.lazy:
+                return LazyAnnotationIndex(list(self.target_element), self.chromosome_ranges(),
+                                           self.load_chromosome_index)
+            with instrument_stage(self.instrument, "index_build"):
+                return self.build_index()
+        path = self.cache_path()
+        if os.path.isfile(os.path.join(path, "meta.json")):
+            try:
+                with instrument_stage(self.instrument, "index_cache_load"):
+                    return AnnotationIndex.load(path)
+            except (OSError, ValueError, KeyError):
+                # a damaged cache is rebuilt below
+                shutil.rmtree(path, ignore_errors=True)
+
+        with instrument_stage(self.instrument, "index_build"):
+            annotation_index = self.build_index()
+        self.write_cache(annotation_index, path)
+        return annotation_index
+
+    def write_cache(self, annotation_index, path):
+        """
+        save an index into the cache directory path.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write into a temporary directory first, so concurrent runs never read a half written cache
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        try:
+            with instrument_stage(self.instrument, "index_cache_write"):
+                annotation_index.save(tmp_path)
+            os.rename(tmp_path, path)
+        except OSError:
+            # another run has written the same cache in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return None
+
+    def load_patched_index(self, delta_gtf=None, remove_ids=()):
+        """
+        get the AnnotationIndex of the GTF file with a delta applied, see AnnotationIndex.update. The index of the
+        GTF file comes from load_index; with cache_dir set the patched index is cached as well, keyed on both files
+        and remove_ids, so the delta is applied once. The cached patched index is a full copy of the index, not a
+        delta on top of the cached index of the GTF file.
+        :param delta_gtf: GTF file of the transcripts to insert or replace, None for no transcript
+        :param remove_ids: transcript ids or gene ids to remove
+        :return: AnnotationIndex object
+        """
+        if delta_gtf is None and not remove_ids:
+            return self.load_index()
+        path = None
+        if self.cache_dir is not None:
+            delta_key = {"delta": None if delta_gtf is None else GtfReader(delta_gtf, self.element_priority,
+                                                                           cache_hash=self.cache_hash).cache_key(),
+                         "remove": sorted(remove_ids)}
+            delta_key = hashlib.sha1(json.dumps(delta_key).encode("utf-8")).hexdigest()
+            path = "%s.%s" % (self.cache_path(), delta_key[:16])
+            if os.path.isfile(os.path.join(path, "meta.json")):
+                try:
+                    with instrument_stage(self.instrument, "index_cache_load"):
+                        return AnnotationIndex.load(path)
+                except (OSError, ValueError, KeyError):
+                    shutil.rmtree(path, ignore_errors=True)
+
+        annotation_index = self.load_index()
+        records = [] if delta_gtf is None else GtfReader(delta_gtf, self.element_priority).records()
+        with instrument_stage(self.instrument, "index_update"):
+            annotation_index = annotation_index.update(records, remove_ids)
+        if path is not None:
+            self.write_cache(annotation_index, path)
+        return annotation_index
+
+    def apply_delta(self, delta_gtf=None, remove_ids=()):
+        """
+        apply a delta to the interval trees of self.gtf_tree in place: the transcripts and genes whose id is in
+        remove_ids are removed, and each transcript of delta_gtf replaces the transcript with the same transcript_id.
+        The cost grows with the size of the delta, not of the annotation (after a first pass which maps the ids to
+        their nodes).
+        :param delta_gtf: GTF file of the transcripts to insert or replace, None for no transcript
+        :param remove_ids: transcript ids or gene ids to remove
+        :return:
+        """
+        self.node_index()
+        for node_id in remove_ids:
+            if node_id in self.transcript_nodes:
+                self.remove_transcript(node_id)
+            elif node_id in self.gene_nodes:
+                self.remove_gene(node_id)
+        if delta_gtf is None:
+            return None
+        transcripts = {}
+        for chr_num, strand, gene_id, transcript_id, element, start, end in GtfReader(
+                delta_gtf, self.element_priority).records():
+            transcript = transcripts.setdefault(transcript_id, (chr_num, strand, gene_id, []))
+            transcript[3].append((element, start, end))
+        for transcript_id, (chr_num, strand, gene_id, elements) in transcripts.items():
+            if transcript_id in self.transcript_nodes:
+                self.remove_transcript(transcript_id)
+            self.insert_transcript(chr_num, strand, gene_id, transcript_id, elements)
+        return None
+
+    def node_index(self):
+        """
+        map the gene and transcript ids to their nodes, once.
+        """
+        if self.gene_nodes is not None:
+            return None
+        if isinstance(self.gtf_tree, LazyGtfTree):
+            self.gtf_tree.load_all()
+        self.gene_nodes, self.transcript_nodes = {}, {}
+        for chr_num, strands in self.gtf_tree.items():
+            for strand, strand_tree in strands.items():
+                for gene in strand_tree["gene_tree"].inorder():
+                    self.gene_nodes[gene.name] = (chr_num, strand, gene)
+                    for transcript in gene.compose.inorder():
+                        self.transcript_nodes[transcript.name] = (gene, transcript)
+        return None
+
+    def insert_transcript(self, chr_num, strand, gene_id, transcript_id, elements):
+        """
+        insert a transcript into the interval trees, the gene is created when it does not exist.
+        :param chr_num: chromosome
+        :param strand: strand
+        :param gene_id: gene id
+        :param transcript_id: transcript id, which must not be in the trees yet
+        :param elements: (element, start, end) of the elements of the transcript, type list
+        :return: TranscriptNode object
+        """
+        self.node_index()
+        if transcript_id in self.transcript_nodes:
+            raise ValueError("transcript %s already exists" % transcript_id)
+        element_nodes = [ElementNode((start, end), sys.intern(element)) for element, start, end in elements]
+        interval = (min(e.interval_start for e in element_nodes), max(e.interval_end for e in element_nodes))
+        transcript = TranscriptNode(interval, transcript_id, elements=GtfReader.build_tree(element_nodes))
+        if gene_id in self.gene_nodes:
+            gene_chr, gene_strand, gene = self.gene_nodes[gene_id]
+            if (gene_chr, gene_strand) != (chr_num, strand):
+                raise ValueError("gene %s is on %s %s, not on %s %s" % (gene_id, gene_chr, gene_strand, chr_num,
+                                                                        strand))
+            gene.compose.insert_interval(gene.compose, transcript)
+        else:
+            gene = GeneNode(interval, gene_id, transcripts=IntervalTree())
+            gene.compose.insert_interval(gene.compose, transcript)
+            strand_tree = self.gtf_tree.setdefault(chr_num, {}).setdefault(strand, {"interval": interval,
+                                                                                    "gene_tree": IntervalTree()})
+            strand_tree["gene_tree"].insert_interval(strand_tree["gene_tree"], gene)
+            self.gene_nodes[gene_id] = (chr_num, strand, gene)
+        self.transcript_nodes[transcript_id] = (gene, transcript)
+        self.resize_gene(gene.name)
+        return transcript
+
+    def remove_transcript(self, transcript_id):
+        """
+        remove a transcript from the interval trees, a gene without transcript is removed as well.
+        """
+        self.node_index()
+        gene, transcript = self.transcript_nodes.pop(transcript_id)
+        gene.compose.delete_interval(gene.compose, transcript)
+        if gene.compose.root is None:
+            self.remove_gene(gene.name)
+        else:
+            self.resize_gene(gene.name)
+        return None
+
+    def remove_gene(self, gene_id):
+        """
+        remove a gene and all its transcripts from the interval trees.
+        """
+        self.node_index()
+        chr_num, strand, gene = self.gene_nodes.pop(gene_id)
+        for transcript in gene.compose.inorder():
+            self.transcript_nodes.pop(transcript.name, None)
+        gene_tree = self.gtf_tree[chr_num][strand]["gene_tree"]
+        gene_tree.delete_interval(gene_tree, gene)
+        self.update_strand_interval(chr_num, strand)
+        return None
+
+    def insert_element(self, transcript_id, element, start, end):
+        """
+        insert an element into an existing transcript.
+        """
+        self.node_index()
+        gene, transcript = self.transcript_nodes[transcript_id]
+        transcript.compose.insert_interval(transcript.compose, ElementNode((start, end), sys.intern(element)))
+        self.resize_transcript(transcript_id)
+        return None
+
+    def remove_element(self, transcript_id, element, start, end):
+        """
+        remove an element from a transcript, a transcript without element is removed as well.
+        """
+        self.node_index()
+        gene, transcript = self.transcript_nodes[transcript_id]
+        node = transcript.compose.find((start, end), element)
+        if node is None:
+            raise KeyError("transcript %s has no %s at %d-%d" % (transcript_id, element, start, end))
+        transcript.compose.delete_interval(transcript.compose, node)
+        if transcript.compose.root is None:
+            self.remove_transcript(transcript_id)
+        else:
+            self.resize_transcript(transcript_id)
+        return None
+
+    def resize_transcript(self, transcript_id):
+        """
+        update the interval of a transcript after its elements changed, then the interval of its gene.
+        """
+        gene, transcript = self.transcript_nodes[transcript_id]
+        GtfReader.resize_node(gene.compose, transcript, transcript.compose.interval())
+        self.resize_gene(gene.name)
+        return None
+
+    def resize_gene(self, gene_id):
+        """
+        update the interval of a gene after its transcripts changed, then the interval of its chromosome strand.
+        """
+        chr_num, strand, gene = self.gene_nodes[gene_id]
+        GtfReader.resize_node(self.gtf_tree[chr_num][strand]["gene_tree"], gene, gene.compose.interval())
+        self.update_strand_interval(chr_num, strand)
+        return None
+
+    def update_strand_interval(self, chr_num, strand):
+        strand_tree = self.gtf_tree[chr_num][strand]
+        interval = strand_tree["gene_tree"].interval()
+        if interval is None:
+            del self.gtf_tree[chr_num][strand]
+            if not self.gtf_tree[chr_num]:
+                del self.gtf_tree[chr_num]
+        else:
+            strand_tree["interval"] = interval
+        return None
+
+    @staticmethod
+    def resize_node(tree, node, interval):
+        """
+        change the interval of a node, the node is taken out of the tree and inserted again as its key changes.
+        """
+        if (node.interval_start, node.interval_end) == interval:
+            return None
+        tree.delete_interval(tree, node)
+        node.interval_start, node.interval_end = interval
+        node.center = (node.interval_start + node.interval_end) // 2
+        tree.insert_interval(tree, node)
+        return None
+
+    def build_index(self):
+        """
+        build the AnnotationIndex from the GTF file.
+        :return: AnnotationIndex object
+        """
+        if self.workers > 1 and not self.gtf_file.endswith(".gz"):
+            return self.build_index_parallel()
+        return AnnotationIndex.from_records(self.records(), list(self.target_element))
+
+    def build_index_parallel(self):
+        """
+        index the chromosomes in a process pool. Each worker parses the byte range of one chromosome and sends back an
+        AnnotationIndex, which pickles as a few NumPy arrays rather than an object graph. The largest chromosomes are
+        submitted first to keep the pool busy.
+        :return: AnnotationIndex object
+        """
+        blocks = []
+        # the ranges of interleaved chromosomes are small, consecutive ranges are indexed together up to this size
+        min_size = os.path.getsize(self.gtf_file) // (4 * self.workers)
+        for chr_num, start, end in self.chromosome_offsets():
+            if blocks and blocks[-1][2] - blocks[-1][1] < min_size and end - start < min_size:
+                blocks[-1] = (blocks[-1][0], blocks[-1][1], end)
+            else:
+                blocks.append((chr_num, start, end))
+        order = sorted(range(len(blocks)), key=lambda i: blocks[i][1] - blocks[i][2])
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {i: executor.submit(build_block_index, self.gtf_file, self.element_priority, blocks[i][1:])
+                       for i in order}
+            indexes = [futures[i].result() for i in range(len(blocks))]
+        if not indexes:
+            return AnnotationIndex.from_records([], list(self.target_element))
+        return AnnotationIndex.merge(indexes)
 
     @staticmethod
     def build_tree(compose_list):
         """
-        use the nodes in node list to build an interval tree
+        use the nodes in node list to build a balanced interval tree. Records in GTF file are nearly sorted (elements
+        on negative strand are usually listed in descending order), so the sort here costs almost linear time.
         :param compose_list: node list
         :return:
         """
-        it = IntervalTree()
-        for node in compose_list:
-            it = it.insert_interval(it, node)
+        compose_list = sorted(compose_list, key=lambda node: (node.interval_start, node.interval_end))
+        return IntervalTree.from_sorted(compose_list)
 
-        return it
+
+class LazyGtfTree(dict):
+    """
+    the gtf_tree of GtfReader.load_gtf with lazy: gtf_tree[chr_num] and gtf_tree.get(chr_num) build the trees of the
+    chromosome the first time it is looked up, iterating covers the chromosomes loaded so far.
+    """
+    def __init__(self, chromosomes, loader):
+        """
+        :param chromosomes: the chromosomes which can be loaded
+        :param loader: function building gtf_tree[chr_num] of one chromosome
+        """
+        super(LazyGtfTree, self).__init__()
+        self.chromosomes = set(chromosomes)
+        self.loader = loader
+        self.lock = threading.Lock()
+
+    def __missing__(self, chr_num):
+        with self.lock:
+            if chr_num in self:
+                # loaded by another thread in the meantime
+                return super(LazyGtfTree, self).__getitem__(chr_num)
+            if chr_num not in self.chromosomes:
+                raise KeyError(chr_num)
+            strands = self.loader(chr_num)
+            self[chr_num] = strands
+            # a chromosome is loaded once, even if an update removes it again
+            self.chromosomes.discard(chr_num)
+        return strands
+
+    def get(self, chr_num, default=None):
+        try:
+            return self[chr_num]
+        except KeyError:
+            return default
+
+    def load_all(self):
+        """
+        load the chromosomes which have not been looked up yet.
+        :return: self
+        """
+        for chr_num in sorted(self.chromosomes):
+            self.get(chr_num)
+        return self
+
+
+def build_block_index(gtf_file, element_priority, byte_range):
+    """
+    the work of one process of GtfReader.build_index_parallel.
+    :return: AnnotationIndex of the records in the byte range
+    """
+    gr = GtfReader(gtf_file, element_priority)
+    return AnnotationIndex.from_records(gr.records(byte_range), list(gr.target_element))
 
 
 if __name__ == "__main__":
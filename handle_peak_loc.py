@@ -1,18 +1,122 @@
 # -*- coding:utf-8 -*-
 import pandas as pd
+import numpy as np
+from table_io import column_names, iter_table
+import heapq
+import itertools
+import os
+import tempfile
 
 
 element_priority = {"stop_codon": 1, "three_prime_utr": 2, "CDS": 3, "five_prime_utr": 4}
 
-data = pd.read_csv("/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/peak_loc.tsv", sep="\t", header=None)
-data.columns = ["chr", "strand", "start", "end", "center", "element", "element start", "element end"]
+# the columns identifying a peak
+PEAK_KEY = ["chr", "strand", "start", "end"]
 
-data["priority"] = 0
 
-get_priority = lambda record: element_priority[record["element"]]
+def deduplicate(data, element_priority, element_column="element", sort=True, priority_column="priority"):
+    """
+    keep the record with the highest element priority for each peak. The priorities are looked up with Series.map and
+    the first record with the smallest priority of each (chr, strand, start, end) group is kept, so records of equal
+    priority keep their order.
+    :param data: peak location records, type pandas DataFrame
+    :param element_priority: element priorities, the smaller value, the higher priority, type dict
+    :param element_column: the column of element name
+    :param sort: sort the result by (chr, strand, start, end), otherwise the peaks keep the order of their first record
+    :param priority_column: the column where the priority of each record is stored, None to leave it out
+    :return:
+    """
+    priority = data[element_column].map(element_priority)
+    if priority.isna().any():
+        unknown = sorted(set(data.loc[priority.isna(), element_column].astype(str)))
+        raise KeyError("elements without priority: %s" % ", ".join(unknown))
+    if priority_column is not None:
+        data[priority_column] = priority
+    group = data.groupby(PEAK_KEY, sort=sort).ngroup().to_numpy()
+    # group-wise argmin: after a stable sort on (group, priority) the first record of each group is the best one
+    order = np.lexsort((priority.to_numpy(), group))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = group[order[1:]] != group[order[:-1]]
+    return data.iloc[order[first]]
 
-data["priority"] = data.apply(get_priority, axis=1)
 
-data.sort_values(by=["chr", "strand", "start", "end", "priority"], ascending=True, inplace=True)
-data.drop_duplicates(subset=["chr", "strand", "start", "end", "priority"], keep="first", inplace=True)
-data.to_csv("/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/peak_unique_loc.tsv", sep="\t", index=False)
+def deduplicate_sorted(chunks, element_priority, element_column="element", priority_column="priority"):
+    """
+    deduplicate a stream of DataFrame chunks sorted by position, in which the records of each (chr, start, end) are
+    consecutive whatever their strand (e.g. the mapped peaks of a BED file sorted by position, see
+    PeakReader.position_sorted). The records at the last position of each chunk are held back until the next chunk,
+    since the records of their peaks may continue there. The peaks keep the order of their first record.
+    :param chunks: iterable of peak location records, type pandas DataFrame
+    :return: generator of deduplicated DataFrame chunks
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+        chunk = deduplicate(chunk, element_priority, element_column, sort=False, priority_column=priority_column)
+        last = chunk.iloc[-1]
+        tail = ((chunk["chr"] == last["chr"]) & (chunk["start"] == last["start"])
+                & (chunk["end"] == last["end"])).to_numpy()
+        if not tail.all():
+            yield chunk[~tail]
+        carry = chunk[tail]
+    if carry is not None:
+        yield carry
+
+
+def external_deduplicate(input_file, element_priority, element_column="element_name", chunk_size=1000000,
+                         tmp_dir=None):
+    """
+    deduplicate a peak location file (with header) that does not fit in memory. The file is read in chunks, each chunk
+    is deduplicated and written as a run sorted by (chr, strand, start, end, priority), then the runs are merged with
+    heapq.merge and the first record of each peak is kept. At most chunk_size records are held in memory at a time.
+    Each line of a run starts with a sort key whose text order is the order of (chr, strand, start, end, priority,
+    run), so the merge compares plain strings.
+    :param input_file: peak location file with header, e.g. the output of PeakMapper, TSV, Parquet or Feather (see
+                       table_io)
+    :param element_priority: element priorities, the smaller value, the higher priority, type dict
+    :param element_column: the column of element name
+    :param chunk_size: the number of records of each run and of each chunk returned
+    :param tmp_dir: the directory of the runs, the system temporary directory if None
+    :return: generator of deduplicated DataFrame chunks sorted by (chr, strand, start, end), values are kept as text
+    """
+    rank = {element: i for i, element in enumerate(sorted(element_priority, key=element_priority.get))}
+    with tempfile.TemporaryDirectory(dir=tmp_dir, prefix="dedup_") as run_dir:
+        runs = []
+        columns = column_names(input_file)
+        for chunk in iter_table(input_file, chunk_size, text=True):
+            chunk[["start", "end"]] = chunk[["start", "end"]].astype(np.int64)
+            chunk = deduplicate(chunk, element_priority, element_column, priority_column=None)
+            records = chunk.to_csv(sep="\t", index=False, header=False).splitlines()
+            # start and end are zero padded, the tab ending a field sorts before any character of a longer field
+            keys = ["%s\t%s\t%020d\t%020d\x01%06d\t%06d\x02" % (key + (len(runs), )) for key in zip(
+                *(chunk[c].tolist() for c in PEAK_KEY), chunk[element_column].map(rank).tolist())]
+            run = os.path.join(run_dir, "run_%d.txt" % len(runs))
+            with open(run, "w") as f:
+                f.writelines(key + record + "\n" for key, record in zip(keys, records))
+            runs.append(run)
+
+        files = [open(run, "r") for run in runs]
+        try:
+            merged = heapq.merge(*files)
+            # ties of (peak, priority) go to the earlier run, i.e. the earlier record in the file
+            best = (next(lines) for _, lines in itertools.groupby(merged, key=lambda line: line[:line.index("\x01")]))
+            while True:
+                lines = list(itertools.islice(best, chunk_size))
+                if not lines:
+                    break
+                yield pd.DataFrame([line[line.index("\x02") + 1: -1].split("\t") for line in lines], columns=columns)
+        finally:
+            for f in files:
+                f.close()
+        if not runs:
+            yield pd.DataFrame(columns=columns)
+
+
+if __name__ == "__main__":
+    data = pd.read_csv("/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/peak_loc.tsv", sep="\t", header=None)
+    data.columns = ["chr", "strand", "start", "end", "center", "element", "element start", "element end"]
+    data = deduplicate(data, element_priority)
+    data.to_csv("/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/peak_unique_loc.tsv", sep="\t", index=False)
@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Columnar table of all the (peak, element) hits of a batch of peaks, built by PeakMapper.hit_table. Instead of one
+    row object per hit, each field is a NumPy column and the gene, transcript and element of a hit are integer codes
+    into the id arrays of the AnnotationIndex. The hits of peak i are the rows offsets[i]: offsets[i + 1], ranked
+    from the best one (element priority, then overlap fraction, then location), so the best hit of every peak is a
+    single fancy index, see HitTable.best.
+"""
+import numpy as np
+
+# the columns of every hit
+HIT_COLUMNS = ("elements", "transcripts", "genes", "element_starts", "element_ends", "locations", "fractions")
+
+
+def rank_hits(query, priority, fraction, ratio):
+    """
+    order the hits of a batch of queries: by query, then from the best hit of the query to the worst.
+    :param query: query of each hit, type numpy array
+    :param priority: element priority of each hit, the smaller value, the higher priority
+    :param fraction: the fraction of the peak overlapped by the element
+    :param ratio: the location of the peak on the metagene
+    :return: the order of the hits, type numpy array
+    """
+    return np.lexsort((-ratio, -fraction, priority, query))
+
+
+class HitTable:
+    """
+    the hits of a batch of peaks, see the module description.
+    """
+    def __init__(self, offsets, columns, element_names, transcript_ids, gene_ids):
+        """
+        :param offsets: the hits of peak i are the rows offsets[i]: offsets[i + 1], type numpy array
+        :param columns: the array of each name in HIT_COLUMNS, type dict
+        :param element_names: element names, indexed by element code
+        :param transcript_ids: transcript ids, indexed by transcript code, type numpy array
+        :param gene_ids: gene ids, indexed by gene code, type numpy array
+        """
+        self.offsets = offsets
+        self.columns = columns
+        self.element_names = list(element_names)
+        self.transcript_ids = transcript_ids
+        self.gene_ids = gene_ids
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def peak_num(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        """
+        the number of hits of each peak.
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def peaks(self):
+        """
+        the peak of each hit.
+        """
+        return np.repeat(np.arange(self.peak_num), self.counts)
+
+    @classmethod
+    def from_hits(cls, peak_num, peaks, columns, element_names, transcript_ids, gene_ids):
+        """
+        :param peak_num: the number of peaks in the batch
+        :param peaks: the peak of each hit, the hits of a peak already ranked from the best, type numpy array
+        :param columns: the array of each name in HIT_COLUMNS, in the order of peaks, type dict
+        :return: HitTable object
+        """
+        order = np.argsort(peaks, kind="stable")
+        offsets = np.zeros(peak_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(peaks, minlength=peak_num), out=offsets[1:])
+        return cls(offsets, {name: columns[name][order] for name in HIT_COLUMNS}, element_names, transcript_ids,
+                   gene_ids)
+
+    def best(self):
+        """
+        reduce the table to the best hit of each peak.
+        :return: HitTable object with at most one hit per peak
+        """
+        first = self.offsets[:-1][self.counts > 0]
+        offsets = np.zeros(len(self.offsets), dtype=np.int64)
+        np.cumsum(self.counts > 0, out=offsets[1:])
+        return HitTable(offsets, {name: column[first] for name, column in self.columns.items()}, self.element_names,
+                        self.transcript_ids, self.gene_ids)
+
+    def to_frame(self, peaks, ids=True, fraction=False):
+        """
+        expand the table into one row per hit.
+        :param peaks: the peak records of the batch, type pandas DataFrame
+        :param ids: add the transcript_id and gene_id columns
+        :param fraction: add the overlap_fraction column
+        :return: the peak columns followed by element_name, location, element_start, element_end and the optional
+                 columns, type pandas DataFrame
+        """
+        columns = self.columns
+        hits = {"element_name": np.array(self.element_names, dtype=object)[columns["elements"]],
+                "location": columns["locations"], "element_start": columns["element_starts"],
+                "element_end": columns["element_ends"]}
+        if fraction:
+            hits["overlap_fraction"] = columns["fractions"]
+        if ids:
+            hits["transcript_id"] = self.transcript_ids[columns["transcripts"]]
+            hits["gene_id"] = self.gene_ids[columns["genes"]]
+        return peaks.iloc[self.peaks].assign(**hits)
+
@@ -0,0 +1,150 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Optional instrumentation of a mapping run. An Instrumentation object is passed to PeakMapper (which hands it to
+    GtfReader), it records the wall time and peak memory of each stage and the counters of the hot paths: nodes
+    built per tree level, tree depth per chromosome strand, nodes visited per IntervalTree.search call, candidate
+    genes/transcripts/elements per peak and peaks rejected by the strand interval check.
+    Without an Instrumentation object, which is the default, the hot paths only pay for an "is not None" check.
+    The collected numbers are written as a JSON report, a run can also be profiled with cProfile.
+"""
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+def instrument_stage(instrument, name):
+    """
+    :param instrument: Instrumentation object or None
+    :param name: stage name
+    :return: the stage context of the instrument, a context doing nothing when instrument is None
+    """
+    return nullcontext() if instrument is None else instrument.stage(name)
+
+
+class Instrumentation:
+    """
+    collect the stage timings and counters of a mapping run.
+    """
+    def __init__(self, memory=False):
+        """
+        :param memory: also record the peak memory of each stage with tracemalloc, which slows Python code down
+        """
+        self.memory = memory
+        self.stages = {}
+        self.counters = {}
+        self.trees = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        record the wall time (and peak memory) of the code in the with block, repeated stages are summed up.
+        :param name: stage name
+        """
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - start
+            record = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            record["seconds"] += seconds
+            record["calls"] += 1
+            if self.memory:
+                peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                record["peak_memory_mb"] = max(record.get("peak_memory_mb", 0.0), peak_memory)
+                if tracing:
+                    tracemalloc.stop()
+
+    def count(self, name, value=1):
+        """
+        add value to a counter.
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def tree_stats(self, gtf_tree):
+        """
+        record the nodes built per level and the gene tree depth of each chromosome strand.
+        :param gtf_tree: GtfReader.gtf_tree
+        """
+        for chr_num, strands in gtf_tree.items():
+            for strand, strand_tree in strands.items():
+                gene_tree = strand_tree["gene_tree"]
+                transcript_depth, element_depth = 0, 0
+                for gene in gene_tree.inorder():
+                    self.count("gene_nodes")
+                    transcript_depth = max(transcript_depth, gene.compose.depth())
+                    for transcript in gene.compose.inorder():
+                        self.count("transcript_nodes")
+                        self.count("element_nodes", transcript.compose.size())
+                        element_depth = max(element_depth, transcript.compose.depth())
+                self.trees["%s:%s" % (chr_num, strand)] = {"gene_tree_depth": gene_tree.depth(),
+                                                           "max_transcript_tree_depth": transcript_depth,
+                                                           "max_element_tree_depth": element_depth}
+
+    def index_stats(self, annotation_index):
+        """
+        record the number of elements of each chromosome strand of an AnnotationIndex.
+        """
+        for (chr_num, strand), partition in annotation_index.partitions.items():
+            self.count("element_rows", len(partition))
+            self.trees["%s:%s" % (chr_num, strand)] = {"elements": len(partition)}
+
+    def bin_stats(self, chr_num, strand, bin_table):
+        """
+        record the size of the BinTable of a chromosome strand: its windows, the empty ones, the (window, element)
+        entries and the bytes of its arrays.
+        """
+        empty_bins = int((bin_table.offsets[1:] == bin_table.offsets[:-1]).sum())
+        self.trees.setdefault("%s:%s" % (chr_num, strand), {}).update(
+            bin_size=bin_table.bin_size, bins=bin_table.bin_num, empty_bins=empty_bins, bin_entries=bin_table.entries,
+            bin_table_bytes=int(bin_table.nbytes))
+
+    def report(self):
+        """
+        :return: the collected numbers with the per peak and per search averages, type dict
+        """
+        counters = dict(self.counters)
+        bin_table_bytes = [tree["bin_table_bytes"] for tree in self.trees.values() if "bin_table_bytes" in tree]
+        if bin_table_bytes:
+            counters["bin_table_bytes"] = sum(bin_table_bytes)
+        averages = {}
+        peaks = counters.get("peaks", 0)
+        if peaks:
+            for level in ("gene", "transcript", "element"):
+                if level + "_candidates" in counters:
+                    averages[level + "_candidates_per_peak"] = counters[level + "_candidates"] / peaks
+        if counters.get("search_calls"):
+            averages["nodes_visited_per_search"] = counters.get("nodes_visited", 0) / counters["search_calls"]
+        if counters.get("searched_peaks"):
+            averages["rows_scanned_per_peak"] = counters.get("rows_scanned", 0) / counters["searched_peaks"]
+            if "bin_rows_scanned" in counters:
+                averages["bin_rows_scanned_per_peak"] = counters["bin_rows_scanned"] / counters["searched_peaks"]
+        return {"stages": self.stages, "counters": counters, "averages": averages, "trees": self.trees}
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return None
+
+    @staticmethod
+    @contextmanager
+    def profile(path):
+        """
+        profile the code in the with block with cProfile and dump the statistics into path.
+        """
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
@@ -4,13 +4,75 @@
 @date: 2018-9-27
 description:
     区间树算法
+    区间树以红黑树为基础，节点按 (interval_start, interval_end) 排序，每个节点额外记录其子树中最大的区间终点
+    (max_end)，查找时借助 max_end 剪枝，避免遍历不可能与查询点重叠的子树。
+    节点颜色约定：0 为红色，1 为黑色。
 """
+RED = 0
+BLACK = 1
 
 
 class IntervalTree:
+    __slots__ = ("root", )
+
     def __init__(self):
         self.root = None
 
+    @classmethod
+    def from_sorted(cls, node_list):
+        """
+        由已按 (interval_start, interval_end) 排好序的节点列表直接构建平衡的区间树，时间复杂度 O(n)
+        :param node_list: 已排序的节点列表
+        :return: 区间树对象
+        """
+        tree = cls()
+        node_num = len(node_list)
+        if node_num == 0:
+            return tree
+        # 完全平衡的二叉树中，最深一层的节点染成红色，其余节点为黑色，满足红黑树的性质
+        max_depth = node_num.bit_length() - 1
+        # 栈中元素：(区间左端, 区间右端, 父节点, 是否为左子节点, 深度)
+        stack = [(0, node_num, None, False, 0)]
+        post_order = []
+        while stack:
+            low, high, parent, is_left, depth = stack.pop()
+            if low >= high:
+                continue
+            mid = (low + high) // 2
+            node = node_list[mid]
+            node.parent = parent
+            node.left_child = None
+            node.right_child = None
+            node.color = RED if depth == max_depth and depth > 0 else BLACK
+            if parent is None:
+                tree.root = node
+            elif is_left:
+                parent.left_child = node
+            else:
+                parent.right_child = node
+            post_order.append(node)
+            stack.append((low, mid, node, True, depth + 1))
+            stack.append((mid + 1, high, node, False, depth + 1))
+        # 子节点总是在父节点之后入列，逆序遍历即可自底向上计算 max_end
+        for node in reversed(post_order):
+            IntervalTree.update_max_end(node)
+        return tree
+
+    @staticmethod
+    def update_max_end(node):
+        """
+        依据左右子节点重新计算 node 的 max_end
+        :param node:
+        :return:
+        """
+        max_end = node.interval_end
+        if node.left_child is not None and node.left_child.max_end > max_end:
+            max_end = node.left_child.max_end
+        if node.right_child is not None and node.right_child.max_end > max_end:
+            max_end = node.right_child.max_end
+        node.max_end = max_end
+        return None
+
     def left_rotate(self, node):
         """
         红黑树的左旋，以node为支点向左旋转
@@ -24,6 +86,7 @@ class IntervalTree:
         if y.left_child is not None:
             y.left_child.parent = node
 
+        y.parent = node.parent
         # 如果node是根节点
         if node.parent is None:
             self.root = y
@@ -34,7 +97,11 @@ class IntervalTree:
         else:
             node.parent.right_child = y
 
+        y.left_child = node
         node.parent = y
+        # 旋转只改变 node 与 y 两个节点的子树
+        IntervalTree.update_max_end(node)
+        IntervalTree.update_max_end(y)
 
         return None
 
@@ -51,6 +118,7 @@ class IntervalTree:
         if y.right_child is not None:
             y.right_child.parent = node
 
+        y.parent = node.parent
         # 如果node是根节点
         if node.parent is None:
             self.root = y
@@ -61,7 +129,10 @@ class IntervalTree:
         else:
             node.parent.right_child = y
 
+        y.right_child = node
         node.parent = y
+        IntervalTree.update_max_end(node)
+        IntervalTree.update_max_end(y)
 
         return None
 
@@ -73,38 +144,36 @@ class IntervalTree:
         :return:
         """
         assert node is not None
+        node.parent = None
+        node.left_child = None
+        node.right_child = None
+        node.max_end = node.interval_end
         if tree.root is None:
+            node.color = BLACK
             tree.root = node
             return tree
         # tag标记用于记录最终的父节点
         tag = None
         tree_root = tree.root
+        key = (node.interval_start, node.interval_end)
         while tree_root is not None:
             tag = tree_root
-            if node.interval_end <= tree_root.interval_start:
+            # 沿途更新祖先节点的 max_end
+            if node.interval_end > tree_root.max_end:
+                tree_root.max_end = node.interval_end
+            if key < (tree_root.interval_start, tree_root.interval_end):
                 tree_root = tree_root.left_child
-            elif node.interval_start >= tree_root.interval_end:
-                tree_root = tree_root.right_child
             else:
-                if node.center < tree_root.center:
-                    tree_root = tree_root.left_child
-                else:
-                    tree_root = tree_root.right_child
+                tree_root = tree_root.right_child
 
         node.parent = tag
-
-        if node.interval_end < tag.interval_start:
+        if key < (tag.interval_start, tag.interval_end):
             tag.left_child = node
-        elif node.interval_start >= tag.interval_end:
-            tag.right_child = node
         else:
-            if node.center < tag.center:
-                tag.left_child = node
-            else:
-                tag.right_child = node
+            tag.right_child = node
 
-        node.color = 0
-        # self.insert_fix(tree, node)
+        node.color = RED
+        tree.insert_fix(tree, node)
 
         return tree
 
@@ -115,25 +184,42 @@ class IntervalTree:
         :param node: 新插入的节点
         :return:
         """
-        while node.parent is not None and node.parent.color == 0:
+        while node.parent is not None and node.parent.color == RED:
+            grandparent = node.parent.parent
             # 如果新插入节点的父节点是祖父节点的左子节点
-            if node.parent.parent is not None and node.parent == node.parent.parent.left_child:
+            if node.parent == grandparent.left_child:
                 # 记录其叔叔节点
-                uncle = node.parent.parent.right_child
-                if uncle is not None and uncle.color == 0:
-                    node.parent.color = 1
-                    node.parent.parent.color = 0
+                uncle = grandparent.right_child
+                if uncle is not None and uncle.color == RED:
+                    node.parent.color = BLACK
+                    uncle.color = BLACK
+                    grandparent.color = RED
                     # 这一步很关键
-                    node = node.parent.parent
+                    node = grandparent
+                else:
+                    if node == node.parent.right_child:
+                        node = node.parent
+                        tree.left_rotate(node)
+                    node.parent.color = BLACK
+                    node.parent.parent.color = RED
+                    tree.right_rotate(node.parent.parent)
+            # 父节点是祖父节点的右子节点，与上面的情况对称
+            else:
+                uncle = grandparent.left_child
+                if uncle is not None and uncle.color == RED:
+                    node.parent.color = BLACK
+                    uncle.color = BLACK
+                    grandparent.color = RED
+                    node = grandparent
                 else:
                     if node == node.parent.left_child:
                         node = node.parent
-                        self.right_rotate(node)
-                    node.parent.color = 1
-                    node.parent.parent.color = 0
-                    self.left_rotate(node)
+                        tree.right_rotate(node)
+                    node.parent.color = BLACK
+                    node.parent.parent.color = RED
+                    tree.left_rotate(node.parent.parent)
         # 根节点必需是黑色
-        tree.root.color = 1
+        tree.root.color = BLACK
         return tree
 
     def delete_interval(self, tree, node):
@@ -144,38 +230,234 @@ class IntervalTree:
         :return:
         """
         assert node is not None and tree is not None
-        # 这次还不需要
-        pass
+        # removed_color 为实际从树中摘除的位置原本的颜色，child 为顶替该位置的节点（可能为 None），child_parent 为其父节点
+        removed_color = node.color
+        if node.left_child is None:
+            child, child_parent = node.right_child, node.parent
+            tree.transplant(node, node.right_child)
+        elif node.right_child is None:
+            child, child_parent = node.left_child, node.parent
+            tree.transplant(node, node.left_child)
+        else:
+            # 有两个子节点时用后继节点（右子树中最小的节点）顶替 node
+            successor = IntervalTree.minimum(node.right_child)
+            removed_color = successor.color
+            child = successor.right_child
+            if successor.parent is node:
+                child_parent = successor
+            else:
+                child_parent = successor.parent
+                tree.transplant(successor, successor.right_child)
+                successor.right_child = node.right_child
+                successor.right_child.parent = successor
+            tree.transplant(node, successor)
+            successor.left_child = node.left_child
+            successor.left_child.parent = successor
+            successor.color = node.color
+        # 自结构发生变化的位置向上更新 max_end，之后的旋转只改变局部子树，会自行维护 max_end
+        ancestor = child_parent
+        while ancestor is not None:
+            IntervalTree.update_max_end(ancestor)
+            ancestor = ancestor.parent
+        if removed_color == BLACK:
+            tree.delete_and_fix(child, child_parent)
+        node.parent = node.left_child = node.right_child = None
+        node.max_end = node.interval_end
+        return tree
+
+    def delete_and_fix(self, node, parent=None):
+        """
+        删除节点后维持红黑树性质不变。空节点视为黑色，因此需要同时给出 node 的父节点
+        :param node: 顶替被删除位置的节点，可能为 None
+        :param parent: node 的父节点
+        :return:
+        """
+        def color(n):
+            return BLACK if n is None else n.color
+
+        if node is not None:
+            parent = node.parent
+        while node is not self.root and color(node) == BLACK:
+            # node 所在的一侧少了一个黑色节点，兄弟节点 sibling 一定存在
+            if node is parent.left_child:
+                sibling = parent.right_child
+                if sibling.color == RED:
+                    sibling.color = BLACK
+                    parent.color = RED
+                    self.left_rotate(parent)
+                    sibling = parent.right_child
+                if color(sibling.left_child) == BLACK and color(sibling.right_child) == BLACK:
+                    sibling.color = RED
+                    node, parent = parent, parent.parent
+                else:
+                    if color(sibling.right_child) == BLACK:
+                        sibling.left_child.color = BLACK
+                        sibling.color = RED
+                        self.right_rotate(sibling)
+                        sibling = parent.right_child
+                    sibling.color = parent.color
+                    parent.color = BLACK
+                    sibling.right_child.color = BLACK
+                    self.left_rotate(parent)
+                    node, parent = self.root, None
+            # node 是右子节点，与上面的情况对称
+            else:
+                sibling = parent.left_child
+                if sibling.color == RED:
+                    sibling.color = BLACK
+                    parent.color = RED
+                    self.right_rotate(parent)
+                    sibling = parent.left_child
+                if color(sibling.left_child) == BLACK and color(sibling.right_child) == BLACK:
+                    sibling.color = RED
+                    node, parent = parent, parent.parent
+                else:
+                    if color(sibling.left_child) == BLACK:
+                        sibling.right_child.color = BLACK
+                        sibling.color = RED
+                        self.left_rotate(sibling)
+                        sibling = parent.left_child
+                    sibling.color = parent.color
+                    parent.color = BLACK
+                    sibling.left_child.color = BLACK
+                    self.right_rotate(parent)
+                    node, parent = self.root, None
+        if node is not None:
+            node.color = BLACK
+        return None
 
-    def delete_and_fix(self, node):
+    def transplant(self, node, child):
         """
-        删除节点后位置红黑树性质不变
+        用 child 替换 node 在树中的位置（不处理 node 的子节点）
         :param node:
+        :param child: 可能为 None
         :return:
         """
-        pass
+        if node.parent is None:
+            self.root = child
+        elif node is node.parent.left_child:
+            node.parent.left_child = child
+        else:
+            node.parent.right_child = child
+        if child is not None:
+            child.parent = node.parent
+        return None
+
+    @staticmethod
+    def minimum(node):
+        """
+        以 node 为根的子树中起点最小的节点
+        :param node:
+        :return:
+        """
+        while node.left_child is not None:
+            node = node.left_child
+        return node
+
+    def interval(self):
+        """
+        区间树覆盖的范围：最小的起点与最大的终点
+        :return: (start, end)，空树返回 None
+        """
+        if self.root is None:
+            return None
+        return IntervalTree.minimum(self.root).interval_start, self.root.max_end
+
+    def find(self, interval, name):
+        """
+        查找区间与名称都相同的节点
+        :param interval: (start, end)
+        :param name: 节点名称
+        :return: 节点对象，不存在时返回 None
+        """
+        for node in self.search(self.root, interval[0]):
+            if node.interval_start == interval[0] and node.interval_end == interval[1] and node.name == name:
+                return node
+        return None
 
     def search(self, tree_root, node_center):
         """
-        红黑树中查找区间
+        红黑树中查找所有包含 node_center 的区间（闭区间），使用显式栈代替递归
         :param tree_root: 区间树对象的根节点
         :param node_center:
-        :return:
+        :return: 与查询点重叠的全部节点
         """
         search_res = []
-        if tree_root is not None:
-            tree_root_start = tree_root.interval_start
-            tree_root_end = tree_root.interval_end
+        if tree_root is None:
+            return search_res
+        stack = [tree_root]
+        while stack:
+            node = stack.pop()
+            # 子树中所有区间的终点都在查询点之前，整棵子树都可以跳过
+            if node.max_end < node_center:
+                continue
+            # 节点按起点排序，起点大于查询点时右子树不可能包含查询点
+            if node.interval_start <= node_center:
+                if node.right_child is not None:
+                    stack.append(node.right_child)
+                if node_center <= node.interval_end:
+                    search_res.append(node)
+            if node.left_child is not None:
+                stack.append(node.left_child)
+        return search_res
 
-            if node_center in range(tree_root_start, tree_root_end+1):
-                search_res.append(tree_root)
+    def count_visits(self, tree_root, node_center):
+        """
+        与 search 相同的遍历过程，只统计访问的节点数，用于性能统计
+        :param tree_root: 区间树对象的根节点
+        :param node_center:
+        :return: 访问的节点数
+        """
+        visits = 0
+        stack = [tree_root] if tree_root is not None else []
+        while stack:
+            node = stack.pop()
+            visits += 1
+            if node.max_end < node_center:
+                continue
+            if node.interval_start <= node_center and node.right_child is not None:
+                stack.append(node.right_child)
+            if node.left_child is not None:
+                stack.append(node.left_child)
+        return visits
 
-            if node_center < tree_root.center:
-                search_res += self.search(tree_root.left_child, node_center)
-            else:
-                res = self.search(tree_root.right_child, node_center)
-                search_res += res
-        return search_res
+    def depth(self):
+        """
+        区间树的深度（根节点深度为1）
+        :return:
+        """
+        max_depth = 0
+        stack = [(self.root, 1)] if self.root is not None else []
+        while stack:
+            node, node_depth = stack.pop()
+            max_depth = max(max_depth, node_depth)
+            for child in (node.left_child, node.right_child):
+                if child is not None:
+                    stack.append((child, node_depth + 1))
+        return max_depth
+
+    def size(self):
+        """
+        区间树的节点数
+        :return:
+        """
+        return sum(1 for _ in self.inorder())
+
+    def inorder(self, tree_root=None):
+        """
+        按区间起点顺序遍历区间树中的全部节点
+        :param tree_root: 遍历的起始节点，默认为整棵树的根节点
+        :return: 节点生成器
+        """
+        node = self.root if tree_root is None else tree_root
+        stack = []
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left_child
+            node = stack.pop()
+            yield node
+            node = node.right_child
 
     def is_overlap(self, interval1, interval2):
         """
@@ -195,5 +477,3 @@ class IntervalTree:
         elif not (interval1[0] > interval2[1] or interval1[1] < interval2[0]):
             overlapped = True
         return overlapped
-
-
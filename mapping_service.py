@@ -0,0 +1,211 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    A long running mapping service. The annotation is loaded once by PeakMapper.build_gtf_tree, then batches of BED
+    lines sent over a local Unix socket (or a localhost TCP port) are mapped against it, so a small request costs
+    milliseconds instead of the whole annotation startup.
+    The protocol is one JSON object per line in both directions. A request is {"bed": "<BED lines>", "format": "tsv"}
+    ("format" is "tsv" or "json", "tsv" by default) or {"ping": true}. The response is {"ok": true, "mapped": n,
+    "tsv": "<PeakMapper output with header>"} or {"ok": true, "mapped": n, "records": [...]}, and {"ok": false,
+    "error": "..."} when the request fails. A connection may send any number of requests, connections are served
+    concurrently by asyncio and the mapping itself runs in a thread pool.
+"""
+from peak_mapping import PeakMapper
+from cli import mapping_argument
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import argparse
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import warnings
+
+# the longest request line accepted, in bytes
+REQUEST_LIMIT = 1 << 30
+
+
+class MappingService:
+    """
+    serve mapping requests against an annotation loaded once.
+    """
+    def __init__(self, mapper, gtf_tree, threads=4):
+        """
+        :param mapper: PeakMapper object holding the settings (priorities, distances, dedup) of the service
+        :param gtf_tree: the result of mapper.build_gtf_tree()
+        :param threads: the number of requests mapped at the same time
+        """
+        self.mapper = mapper
+        self.gtf_tree = gtf_tree
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def map_bed(self, bed, output_format="tsv"):
+        """
+        map BED lines.
+        :param bed: BED format records, type string
+        :param output_format: "tsv" or "json"
+        :return: the response, type dict
+        """
+        mapper = self.mapper.sample_mapper(io.StringIO(bed))
+        # the requests are already served in parallel
+        mapper.workers = 1
+        peaks = mapper.peak_mapping(self.gtf_tree, mapper.load_peak_data())
+        if output_format == "json":
+            return {"ok": True, "mapped": len(peaks), "records": json.loads(peaks.to_json(orient="records"))}
+        if output_format == "tsv":
+            return {"ok": True, "mapped": len(peaks), "tsv": peaks.to_csv(sep="\t", index=False)}
+        raise ValueError("unknown format %s" % output_format)
+
+    def handle_request(self, line):
+        """
+        :param line: one request line, type bytes
+        :return: one response line, type bytes
+        """
+        try:
+            request = json.loads(line)
+            if request.get("ping"):
+                response = {"ok": True}
+            else:
+                response = self.map_bed(request["bed"], request.get("format", "tsv"))
+        except Exception as e:
+            response = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        return json.dumps(response).encode("utf-8") + b"\n"
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(await loop.run_in_executor(self.executor, self.handle_request, line))
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host="127.0.0.1", port=None):
+        """
+        serve until SIGINT or SIGTERM, on socket_path if given, otherwise on host:port.
+        """
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path, limit=REQUEST_LIMIT)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port, limit=REQUEST_LIMIT)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, server.close)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.executor.shutdown(wait=False)
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+class MappingClient:
+    """
+    a thin blocking client of MappingService, the connection is kept open between requests.
+    """
+    def __init__(self, socket_path=None, host="127.0.0.1", port=None):
+        if socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.stream = self.sock.makefile("rb")
+
+    def request(self, request):
+        """
+        :param request: type dict, see the module description
+        :return: the response, type dict
+        """
+        self.sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("the mapping service closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response
+
+    def map_bed(self, bed, output_format="tsv"):
+        """
+        :param bed: BED format records, type string or list of lines
+        :param output_format: "tsv" or "json"
+        :return: PeakMapper output as TSV text, or a list of records for "json"
+        """
+        if not isinstance(bed, str):
+            bed = "".join(line if line.endswith("\n") else line + "\n" for line in bed)
+        response = self.request({"bed": bed, "format": output_format})
+        return response["records"] if output_format == "json" else response["tsv"]
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+    parser = argparse.ArgumentParser(prog="mapping_service", description="map peaks against an annotation loaded "
+                                                                         "once")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="load the annotation and serve mapping requests")
+    serve_parser.add_argument("-g", "--gtf", action="store", type=str, required=True,
+                              help="file path of GTF format file")
+    serve_parser.add_argument("-p", "--priority", action="store", type=mapping_argument, required=True,
+                              help="element priorities, a JSON object or key=value pairs. Key is element, value "
+                                   "represent priority.")
+    serve_parser.add_argument("-d", "--distance", action="store", type=mapping_argument, required=True,
+                              help="the offset of each element for figuring, a JSON object or key=value pairs")
+    serve_parser.add_argument("-b", "--backend", action="store", choices=("tree", "array"), default="array",
+                              help="search the interval trees or the array index")
+    serve_parser.add_argument("-c", "--cache-dir", action="store", type=str, default=None,
+                              help="directory where the annotation index is cached between runs")
+    serve_parser.add_argument("--dedup", action="store_true",
+                              help="keep only the record with the highest element priority of each peak")
+    serve_parser.add_argument("-t", "--threads", action="store", type=int, default=4,
+                              help="number of requests mapped at the same time")
+    for sub in (serve_parser, subparsers.add_parser("map", help="send a BED file to a running service")):
+        sub.add_argument("--socket", action="store", type=str, default=None, help="path of the Unix socket")
+        sub.add_argument("--host", action="store", type=str, default="127.0.0.1",
+                         help="host of the TCP service, used without --socket")
+        sub.add_argument("--port", action="store", type=int, default=None,
+                         help="port of the TCP service, used without --socket")
+    map_parser = subparsers.choices["map"]
+    map_parser.add_argument("peak", action="store", type=str, help="BED format peak file, - for stdin")
+    map_parser.add_argument("-f", "--format", action="store", choices=("tsv", "json"), default="tsv",
+                            help="output format")
+    args = parser.parse_args()
+    if args.socket is None and args.port is None:
+        parser.error("either --socket or --port is required")
+
+    if args.command == "serve":
+        pm = PeakMapper(args.gtf, args.priority, args.distance, None, backend=args.backend, cache_dir=args.cache_dir,
+                        dedup=args.dedup)
+        service = MappingService(pm, pm.build_gtf_tree(), threads=args.threads)
+        print("mapping service ready on %s" % (args.socket or "%s:%d" % (args.host, args.port)), file=sys.stderr)
+        asyncio.run(service.serve(args.socket, args.host, args.port))
+    else:
+        bed = sys.stdin.read() if args.peak == "-" else open(args.peak, "r").read()
+        with MappingClient(args.socket, args.host, args.port) as client:
+            res = client.map_bed(bed, args.format)
+        sys.stdout.write(res if args.format == "tsv" else json.dumps(res) + "\n")
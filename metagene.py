@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Metagene histograms of the peak locations. The location of a mapped peak is its relative position in the element
+    plus the offset of the element (element_distance), so all the peaks lie on one 0 - 300 metagene axis.
+    PeakMapper accumulates the histograms chunk by chunk while mapping and writes them into a small JSON sidecar file,
+    draw_fig plots the distribution from the sidecar without reading the whole peak location file again.
+"""
+import json
+import numpy as np
+
+
+class MetageneHistogram:
+    """
+    the histogram of peak locations on the metagene axis, overall and for each element.
+    """
+    def __init__(self, element_names, low=0.0, high=300.0, bin_width=0.1):
+        """
+        :param element_names: the elements which are counted, type list
+        :param low: the lower edge of the metagene axis
+        :param high: the upper edge of the metagene axis
+        :param bin_width: the width of each bin, the histograms can be merged into wider bins when plotting
+        """
+        self.element_names = list(element_names)
+        self.low, self.high, self.bin_width = float(low), float(high), float(bin_width)
+        self.bins_num = int(round((self.high - self.low) / self.bin_width))
+        self.counts = np.zeros((len(self.element_names), self.bins_num), dtype=np.int64)
+        # locations outside [low, high) are counted here, so that the totals still match the number of peaks
+        self.outside = np.zeros(len(self.element_names), dtype=np.int64)
+
+    @property
+    def edges(self):
+        return self.low + np.arange(self.bins_num + 1) * self.bin_width
+
+    @property
+    def total(self):
+        return self.counts.sum(axis=0)
+
+    def add(self, element_name, location):
+        """
+        count the locations of a chunk of mapped peaks.
+        :param element_name: element name of each peak, type pandas Series or numpy array
+        :param location: location of each peak, type pandas Series or numpy array
+        :return:
+        """
+        codes = {name: code for code, name in enumerate(self.element_names)}
+        element_code = np.array([codes[name] for name in element_name], dtype=np.int64)
+        location = np.asarray(location, dtype=np.float64)
+        bins = np.floor((location - self.low) / self.bin_width)
+        inside = (bins >= 0) & (bins < self.bins_num)
+        self.outside += np.bincount(element_code[~inside], minlength=len(self.element_names))
+        index = element_code[inside] * self.bins_num + bins[inside].astype(np.int64)
+        self.counts += np.bincount(index, minlength=self.counts.size).reshape(self.counts.shape)
+        return None
+
+    def merge(self, other):
+        """
+        add the counts of another histogram with the same elements and bins, e.g. from another sample or worker.
+        """
+        if (self.element_names, self.low, self.high, self.bin_width) != \
+                (other.element_names, other.low, other.high, other.bin_width):
+            raise ValueError("histograms with different elements or bins can not be merged")
+        self.counts += other.counts
+        self.outside += other.outside
+        return None
+
+    def save(self, path):
+        """
+        write the histograms into a JSON sidecar file.
+        """
+        histogram = {"low": self.low, "high": self.high, "bin_width": self.bin_width,
+                     "peaks": int(self.counts.sum() + self.outside.sum()),
+                     "total": self.total.tolist(), "outside": int(self.outside.sum()),
+                     "elements": {name: {"counts": self.counts[i].tolist(), "outside": int(self.outside[i])}
+                                  for i, name in enumerate(self.element_names)}}
+        with open(path, "w") as f:
+            json.dump(histogram, f)
+        return None
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: the sidecar file written by save
+        :return: MetageneHistogram object
+        """
+        with open(path, "r") as f:
+            histogram = json.load(f)
+        element_names = list(histogram["elements"])
+        metagene = cls(element_names, histogram["low"], histogram["high"], histogram["bin_width"])
+        for i, name in enumerate(element_names):
+            metagene.counts[i] = histogram["elements"][name]["counts"]
+            metagene.outside[i] = histogram["elements"][name]["outside"]
+        return metagene
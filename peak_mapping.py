@@ -11,57 +11,548 @@ description:
     Finally, each peak got only one record, it may not matches with RNA elements, or it matches one or a few elements.
     The match result with highest priority remains at last.
 """
+import numpy as np
 import pandas as pd
-from peak_reader import PeakReader
-from gtf_handler import GtfReader
+from collections import OrderedDict
+from peak_reader import PeakReader, PEAK_COLUMNS
+from gtf_handler import GtfReader, LazyGtfTree
 from interval_tree import IntervalTree
-import warnings
-import argparse
+from annotation_index import AnnotationIndex, LazyAnnotationIndex, expand_ranges, unique_positions
+from hit_table import HitTable, HIT_COLUMNS, rank_hits
+from instrumentation import instrument_stage
+from metagene import MetageneHistogram
+from handle_peak_loc import deduplicate, deduplicate_sorted, external_deduplicate
+from table_io import TableWriter, infer_types, write_table
+import multiprocessing as mp
+import copy
+import os
 import sys
-# avoid throwing out RecursiveError
-sys.setrecursionlimit(1000000)
+import tempfile
+import time
+
+# the state shared with forked mapping workers, see PeakMapper.map_shards
+SHARED_STATE = {}
 
 
 class PeakMapper:
     """
     mapping the peaks to the genome element.
     """
-    def __init__(self, gtf_file, element_priority, element_distance, peak_file):
-        self.gr = GtfReader(gtf_file, element_priority)
+    def __init__(self, gtf_file, element_priority, element_distance, peak_file, backend="tree", cache_dir=None,
+                 workers=1, instrument=None, histogram=False, dedup=False, overlap="center", delta_gtf=None,
+                 remove_ids=(), cache_size=100000, lazy=False, hits="best", bin_size=None, mapped_hook=None):
+        """
+        :param gtf_file: the path of GTF file, type string.
+        :param element_priority: element priorities, the smaller value, the higher priority, type dict.
+        :param element_distance: the offset added to the location of each element for figuring, type dict.
+        :param peak_file: the path of BED format peak file, type string.
+        :param backend: "tree" searches the nested interval trees of GtfReader, "array" searches the flattened
+                        AnnotationIndex.
+        :param cache_dir: the directory where the AnnotationIndex is cached between runs (backend "array" only).
+        :param workers: the number of processes used to build the index and to map the peaks (backend "array" only).
+        :param instrument: Instrumentation object collecting stage timings and search counters, None to disable.
+        :param histogram: accumulate the metagene histograms of the mapped peaks into self.histogram, see
+                          MetageneHistogram.
+        :param dedup: keep only the record with the highest element priority of each (chr, strand, start, end) peak,
+                      see handle_peak_loc.deduplicate.
+        :param overlap: "center" matches the elements containing the peak center, "interval" the elements overlapping
+                        any part of the peak (backend "array" only). With "interval" the candidates are ranked by
+                        priority, then by the fraction of the peak they overlap, which is reported in the
+                        overlap_fraction column, and the location is taken at the peak center clipped to the element.
+        :param delta_gtf: GTF file of transcripts inserted into the annotation, replacing the transcripts with the same
+                          transcript_id, see GtfReader.apply_delta and GtfReader.load_patched_index.
+        :param remove_ids: transcript ids or gene ids removed from the annotation.
+        :param cache_size: the number of (chr, strand, peak_center) results kept by the LRU cache of the tree backend,
+                           so that repeated positions of later chunks and samples are not searched again, 0 to disable.
+                           Within a chunk every distinct position is searched once in any case.
+        :param lazy: build the trees or the index of a chromosome only when a peak is mapped on it, see GtfReader.
+        :param hits: "best" keeps the best element of each peak, "all" keeps every element a peak matches, one row
+                     each with its transcript_id and gene_id, ranked from the best (backend "array" only, not with
+                     dedup). See hit_table for the columnar table behind both.
+        :param bin_size: look the peaks up in a BinTable with windows of this many bases instead of the sorted
+                         arrays (backend "array" only), see StrandIndex.binned. None to disable.
+        :param mapped_hook: function called with the mapper after each chunk of peaks is mapped, e.g. to record the
+                            time of the first mapped peak. The mappers of sample_mapper call it too; with a process
+                            pool, map_samples calls it in this process as the samples come back.
+        """
+        assert backend in ("tree", "array")
+        assert overlap == "center" or (overlap == "interval" and backend == "array")
+        assert hits == "best" or (hits == "all" and backend == "array" and not dedup)
+        assert bin_size is None or (bin_size > 0 and backend == "array")
+        self.gr = GtfReader(gtf_file, element_priority, cache_dir=cache_dir, workers=workers, instrument=instrument,
+                            lazy=lazy)
         self.pr = PeakReader(peak_file)
         self.it = IntervalTree()
         self.priority = element_priority
         self.distance = element_distance
+        self.backend = backend
+        self.workers = workers
+        self.instrument = instrument
+        self.histogram = MetageneHistogram(element_priority.keys()) if histogram else None
+        self.dedup = dedup
+        self.overlap = overlap
+        self.hits = hits
+        self.bin_size = bin_size
+        self.delta_gtf = delta_gtf
+        self.remove_ids = tuple(remove_ids)
+        self.mapped_hook = mapped_hook
+        # the number of peaks passed to peak_mapping, mapped or not, and the number of them matched with an element
+        self.peaks_read = 0
+        self.peaks_mapped = 0
+        # LRU cache of location_lookup, shared by the mappers of sample_mapper; it belongs to one gtf_tree
+        self.cache_size = cache_size
+        self.location_cache = OrderedDict()
+        self.cache_owner = None
 
     def build_gtf_tree(self):
-        self.gr.load_gtf()
+        """
+        :return: the nested interval trees (backend "tree") or an AnnotationIndex (backend "array")
+        """
+        if self.backend == "array":
+            annotation_index = self.gr.load_patched_index(self.delta_gtf, self.remove_ids)
+            if self.instrument is not None:
+                self.instrument.index_stats(annotation_index)
+            return annotation_index
+        with instrument_stage(self.instrument, "gtf_tree_build"):
+            self.gr.load_gtf()
+        if self.delta_gtf is not None or self.remove_ids:
+            with instrument_stage(self.instrument, "gtf_tree_update"):
+                self.gr.apply_delta(self.delta_gtf, self.remove_ids)
+        if self.instrument is not None:
+            self.instrument.tree_stats(self.gr.gtf_tree)
         return self.gr.gtf_tree
 
     def load_peak_data(self):
-        self.pr.peak_info()
+        with instrument_stage(self.instrument, "load_peak_data"):
+            self.pr.peak_info()
         return self.pr.peaks
 
+    def stream_mapping(self, gtf_tree, output, chunk_size=100000):
+        """
+        read, map and write the peaks chunk by chunk, the memory used stays flat however large the peak file is.
+        With dedup the duplicates of a peak in different chunks are removed as well, see stream_dedup_mapping.
+        :param gtf_tree: the result of build_gtf_tree
+        :param output: file path of output file
+        :param chunk_size: the number of peaks mapped at a time
+        :return: the number of peaks written
+        """
+        if self.dedup:
+            return self.stream_dedup_mapping(gtf_tree, output, chunk_size)
+        return self.write_mapping(gtf_tree, output, chunk_size)
+
+    def write_mapping(self, gtf_tree, output, chunk_size):
+        """
+        map the chunks of the peak file and write them one after another into output.
+        """
+        return self.write_chunks((self.peak_mapping(gtf_tree, peaks) for peaks in self.pr.iter_peaks(chunk_size)),
+                                 output)
+
+    def write_chunks(self, chunks, output, histogram=None):
+        """
+        write mapped chunks one after another into output.
+        :param chunks: iterable of mapped peaks, type pandas DataFrame
+        :param output: file path of output file
+        :param histogram: MetageneHistogram the written peaks are added into, None when peak_mapping added them
+        :return: the number of records written
+        """
+        with TableWriter(output) as writer:
+            for peaks in chunks:
+                writer.write(peaks)
+                if histogram is not None:
+                    histogram.add(peaks["element_name"], peaks["location"])
+            if writer.chunks == 0:
+                # empty peak file, still write the header
+                writer.write(pd.DataFrame(columns=PEAK_COLUMNS + ["element_name", "location", "element_start",
+                                                                  "element_end"]))
+        return writer.rows
+
+    def stream_dedup_mapping(self, gtf_tree, output, chunk_size):
+        """
+        stream_mapping with dedup, the duplicates of a peak may be in different chunks. When the peak file is sorted
+        by position (see PeakReader.position_sorted) the duplicates are next to each other, so the mapped chunks are
+        deduplicated as they come (see deduplicate_sorted) and keep the order of the file. Otherwise the mapped chunks
+        go into a temporary file first, which is deduplicated by an external sort.
+        """
+        # the histogram is filled after the duplicates across chunks are removed
+        histogram, self.histogram = self.histogram, None
+        if self.pr.position_sorted(chunk_size):
+            try:
+                mapped = (self.peak_mapping(gtf_tree, peaks) for peaks in self.pr.iter_peaks(chunk_size))
+                mapped = deduplicate_sorted(mapped, self.priority, "element_name", priority_column=None)
+                return self.write_chunks(mapped, output, histogram)
+            finally:
+                self.histogram = histogram
+        fd, mapped_file = tempfile.mkstemp(suffix=".tsv", dir=os.path.dirname(os.path.abspath(output)))
+        os.close(fd)
+        try:
+            self.write_mapping(gtf_tree, mapped_file, chunk_size)
+            with instrument_stage(self.instrument, "dedup"), TableWriter(output) as writer:
+                for peaks in external_deduplicate(mapped_file, self.priority, chunk_size=chunk_size):
+                    # the deduplicated records are text, the columnar formats store them typed
+                    writer.write(peaks if writer.format == "tsv" else infer_types(peaks))
+                    if histogram is not None:
+                        histogram.add(peaks["element_name"], peaks["location"])
+        finally:
+            self.histogram = histogram
+            os.remove(mapped_file)
+        return writer.rows
+
+    def sample_mapper(self, peak_file):
+        """
+        a mapper of another peak file sharing the settings of this one, with its own histogram and counters.
+        :param peak_file: the path of BED format peak file
+        :return: PeakMapper object
+        """
+        mapper = copy.copy(self)
+        mapper.pr = PeakReader(peak_file)
+        mapper.histogram = MetageneHistogram(self.priority.keys())
+        mapper.peaks_read = 0
+        mapper.peaks_mapped = 0
+        return mapper
+
+    def map_sample(self, gtf_tree, output, chunk_size=None):
+        """
+        map the peak file of this mapper into output and the metagene histogram next to it.
+        :param gtf_tree: the result of build_gtf_tree
+        :param output: file path of output file, the histogram goes into output + ".hist.json"
+        :param chunk_size: stream the peak file in chunks of this size, None to load it at once
+        :return: the summary of the sample, type dict
+        """
+        start = time.perf_counter()
+        if chunk_size:
+            self.stream_mapping(gtf_tree, output, chunk_size)
+        else:
+            write_table(self.peak_mapping(gtf_tree, self.load_peak_data()), output)
+        self.histogram.save(output + ".hist.json")
+        # the peaks matched with an element, whatever the number of rows written for them (hits, dedup)
+        mapped = self.peaks_mapped
+        summary = {"peak_file": self.pr.peak_file, "output": output, "peaks": self.peaks_read, "mapped": mapped,
+                   "mapped_ratio": mapped / self.peaks_read if self.peaks_read else 0.0}
+        for i, element in enumerate(self.histogram.element_names):
+            summary[element] = int(self.histogram.counts[i].sum() + self.histogram.outside[i])
+        summary["seconds"] = time.perf_counter() - start
+        return summary
+
+    def map_samples(self, gtf_tree, peak_files, output_dir, chunk_size=None, output_format="tsv"):
+        """
+        map many peak files against the annotation loaded once. With workers > 1 the files are mapped in a forked
+        process pool which shares gtf_tree copy-on-write, the largest files first; each file is then mapped by a
+        single process.
+        :param gtf_tree: the result of build_gtf_tree
+        :param peak_files: paths of BED format peak files, type list
+        :param output_dir: one "<sample>.peak_loc.<output_format>" and its histogram for each peak file and
+                           "summary.tsv" are written here. The sample name is the file name without the .bed(.gz)
+                           extension
+        :param chunk_size: stream each peak file in chunks of this size, None to load each file at once
+        :param output_format: "tsv", "parquet" or "feather", the format (and extension) of the output files
+        :return: the summary table, type pandas DataFrame. With histogram, the histograms of all the samples are
+                 added into self.histogram
+        """
+        samples = [os.path.basename(f).split(".bed")[0] for f in peak_files]
+        if len(set(samples)) < len(samples):
+            raise ValueError("peak files with the same sample name: %s" % ", ".join(
+                sorted(s for s in set(samples) if samples.count(s) > 1)))
+        os.makedirs(output_dir, exist_ok=True)
+        jobs = [(peak_file, os.path.join(output_dir, "%s.peak_loc.%s" % (sample, output_format)))
+                for sample, peak_file in zip(samples, peak_files)]
+        order = sorted(range(len(jobs)), key=lambda i: -os.path.getsize(jobs[i][0]))
+
+        if self.workers <= 1 or len(jobs) <= 1 or "fork" not in mp.get_all_start_methods():
+            results = {i: map_sample_job(self, gtf_tree, jobs[i], chunk_size) for i in order}
+        else:
+            if isinstance(gtf_tree, (LazyGtfTree, LazyAnnotationIndex)):
+                # what a forked worker loads is not seen by the others
+                gtf_tree.load_all()
+            if self.bin_size is not None:
+                for partition in gtf_tree.partitions.values():
+                    self.bin_table(partition)
+            SHARED_STATE.update(mapper=self, gtf_tree=gtf_tree, jobs=jobs, chunk_size=chunk_size)
+            try:
+                results = {}
+                with mp.get_context("fork").Pool(min(self.workers, len(jobs))) as pool:
+                    for i, result in zip(order, pool.imap(map_sample_worker, order, chunksize=1)):
+                        results[i] = result
+                        # the hook calls of the workers are lost with them
+                        if self.mapped_hook is not None:
+                            self.mapped_hook(self)
+            finally:
+                SHARED_STATE.clear()
+        summaries = {i: summary for i, (summary, _) in results.items()}
+        if self.histogram is not None:
+            # the histogram of the run is the sum of the histograms of the samples
+            for i in range(len(jobs)):
+                self.histogram.merge(results[i][1])
+
+        summary = pd.DataFrame([dict(sample=samples[i], **summaries[i]) for i in range(len(jobs))])
+        summary.to_csv(os.path.join(output_dir, "summary.tsv"), sep="\t", index=False, encoding="utf-8")
+        return summary
+
     def peak_mapping(self, gtf_tree, peaks):
         """
         match one peak to the best transcript element
-        :param gtf_tree: interval tree object which generated by gtf_file, type IntervalTree object
+        :param gtf_tree: interval tree object which generated by gtf_file, type IntervalTree object. When it is an
+                         AnnotationIndex the peaks are mapped in batch, see hit_table.
         :param peaks: peak records load from bed file, type pandas DataFrame
-        :return:
+        :return: the peaks matched with an element in their original order. With hits "all" a peak has one row for
+                 each element it matches, ranked from the best, followed by transcript_id and gene_id
         """
-        peaks["element_name"], peaks["location"], peaks["element_start"], peaks["element_end"] = None, None, None, None
-        res = peaks.apply(self.peak_location, axis=1, args=(gtf_tree, )).values
-        s1, s2, s3, s4 = pd.Series([i[0] for i in res]), pd.Series([i[1] for i in res]), pd.Series([i[2] for i in res]), pd.Series([i[3] for i in res])
-        peaks["element_name"], peaks["location"], peaks["element_start"], peaks["element_end"] = s4, s1, s2, s3
-        peaks.dropna(inplace=True)
+        self.peaks_read += len(peaks)
+        # the best hit of each peak when hits is "all", the histogram and peaks_mapped count each peak once
+        best = None
+        if self.instrument is not None:
+            # the counters are collected in a separate pass, the mapping itself is not slowed down
+            with instrument_stage(self.instrument, "search_stats"):
+                self.search_stats(gtf_tree, peaks)
+        with instrument_stage(self.instrument, "peak_mapping"):
+            if isinstance(gtf_tree, AnnotationIndex):
+                table = self.hit_table(gtf_tree, peaks)
+                if self.hits == "all":
+                    best = table.best().to_frame(peaks, ids=False)
+                peaks = table.to_frame(peaks, ids=self.hits == "all", fraction=self.overlap == "interval")
+            else:
+                # each distinct (chr, strand, peak_center) is looked up once and the result is broadcast to its peaks
+                keys = peaks[["chr", "strand", "peak_center"]]
+                inverse = keys.groupby(list(keys.columns), sort=False, dropna=False).ngroup().to_numpy()
+                res = [self.location_lookup(chr_num, strand, peak_center, gtf_tree)
+                       for chr_num, strand, peak_center in keys.drop_duplicates().itertuples(index=False)]
+                if self.instrument is not None:
+                    self.instrument.count("unique_positions", len(res))
+                    self.instrument.count("repeated_positions", len(peaks) - len(res))
+                res = pd.DataFrame(res, columns=["location", "element_start", "element_end", "element_name"])
+                res = res.iloc[inverse]
+                peaks["element_name"], peaks["location"] = res["element_name"].values, res["location"].values
+                peaks["element_start"], peaks["element_end"] = res["element_start"].values, res["element_end"].values
+                peaks.dropna(inplace=True)
+        if best is None:
+            best = peaks
+        self.peaks_mapped += len(best)
+        if self.dedup:
+            with instrument_stage(self.instrument, "dedup"):
+                peaks = best = deduplicate(peaks, self.priority, "element_name", sort=False, priority_column=None)
+        if self.histogram is not None:
+            with instrument_stage(self.instrument, "histogram"):
+                self.histogram.add(best["element_name"], best["location"])
+        if self.mapped_hook is not None:
+            self.mapped_hook(self)
         return peaks
 
+    def search_stats(self, gtf_tree, peaks):
+        """
+        count the candidates of every search level, the peaks rejected early and the work of the searches into
+        self.instrument.
+        :param gtf_tree: the result of build_gtf_tree
+        :param peaks: peak records load from bed file, type pandas DataFrame
+        :return:
+        """
+        instrument = self.instrument
+        instrument.count("peaks", len(peaks))
+        if isinstance(gtf_tree, AnnotationIndex):
+            centers = peaks["peak_center"].to_numpy(dtype=np.int64)
+            starts, ends = peaks["start"].to_numpy(dtype=np.int64) + 1, peaks["end"].to_numpy(dtype=np.int64)
+            for (chr_num, strand), rows in peaks.groupby(["chr", "strand"], sort=False).indices.items():
+                partition = gtf_tree.get(chr_num, strand)
+                if partition is None:
+                    instrument.count("rejected_no_annotation", len(rows))
+                    continue
+                group_centers = centers[rows]
+                inside = (group_centers >= partition.interval[0]) & (group_centers <= partition.interval[1])
+                instrument.count("rejected_by_strand_interval", int((~inside).sum()))
+                group_centers = group_centers[inside]
+                if self.overlap == "interval":
+                    group_positions = (starts[rows][inside], ends[rows][inside], group_centers)
+                else:
+                    group_positions = (group_centers, )
+                unique_num = len(unique_positions(*group_positions)[0][0])
+                instrument.count("unique_positions", unique_num)
+                instrument.count("repeated_positions", len(group_centers) - unique_num)
+                low = np.searchsorted(partition.max_ends, group_centers, side="left")
+                high = np.searchsorted(partition.starts, group_centers, side="right")
+                instrument.count("searched_peaks", len(group_centers))
+                instrument.count("rows_scanned", int(np.maximum(high - low, 0).sum()))
+                if self.bin_size is not None:
+                    bins = self.bin_table(partition)
+                    instrument.bin_stats(chr_num, strand, bins)
+                    occupied = bins.occupied(group_centers)
+                    instrument.count("rejected_by_empty_bin", int((~occupied).sum()))
+                    windows = bins.bin_of(group_centers[occupied])
+                    instrument.count("bin_rows_scanned", int((bins.offsets[windows + 1] - bins.offsets[windows]).sum()))
+                query, hit = partition.search(group_centers)
+                instrument.count("element_candidates", len(hit))
+                instrument.count("transcript_candidates", len(np.unique(np.stack([query, partition.transcripts[hit]]),
+                                                                        axis=1).T))
+                instrument.count("gene_candidates", len(np.unique(np.stack([query, partition.genes[hit]]), axis=1).T))
+            return None
+
+        def search(tree, peak_center):
+            instrument.count("search_calls")
+            instrument.count("nodes_visited", self.it.count_visits(tree.root, peak_center))
+            return self.it.search(tree.root, peak_center)
+
+        for chr_num, strand, peak_center in zip(peaks["chr"], peaks["strand"], peaks["peak_center"]):
+            strand_tree = gtf_tree.get(chr_num, {}).get(strand)
+            if strand_tree is None:
+                instrument.count("rejected_no_annotation")
+                continue
+            interval = strand_tree["interval"]
+            if not interval[0] <= peak_center <= interval[1]:
+                instrument.count("rejected_by_strand_interval")
+                continue
+            genes = search(strand_tree["gene_tree"], peak_center)
+            transcripts = [t for g in genes for t in search(g.compose, peak_center)]
+            elements = [e for t in transcripts for e in search(t.compose, peak_center)]
+            instrument.count("gene_candidates", len(genes))
+            instrument.count("transcript_candidates", len(transcripts))
+            instrument.count("element_candidates", len(elements))
+        return None
+
+    def hit_table(self, annotation_index, peaks):
+        """
+        find the hits of a batch of peaks. Peaks are grouped by (chr, strand), all the elements containing the peak
+        centers (or overlapping the peaks, see overlap) of a group are found at once by a sweep over the peaks, see
+        StrandIndex.sweep, and the hits are ranked by sorting them on (peak, priority, -fraction, -ratio) with
+        element_priority and element_distance turned into lookup arrays indexed by element code. With hits "best" the
+        table is reduced to the first hit of each peak by HitTable.best. With workers > 1 the groups are split into
+        shards which are mapped in a forked process pool.
+        :param annotation_index: AnnotationIndex object
+        :param peaks: peak records load from bed file, type pandas DataFrame
+        :return: HitTable object
+        """
+        peak_num = len(peaks)
+        # BED starts are 0-based, the peak is [start + 1, end] in the 1-based closed coordinates of GTF
+        positions = (peaks["peak_center"].to_numpy(dtype=np.int64), peaks["start"].to_numpy(dtype=np.int64) + 1,
+                     peaks["end"].to_numpy(dtype=np.int64))
+
+        shards = []
+        # a shard is at most 1/(4 * workers) of all the peaks, so that one large chromosome does not hold up the pool
+        shard_size = max(peak_num // (4 * self.workers), 1) if self.workers > 1 else max(peak_num, 1)
+        for (chr_num, strand), rows in peaks.groupby(["chr", "strand"], sort=False).indices.items():
+            # the partition is looked up here, so that a lazy index loads it (and its bin table is built) once before
+            # the workers are forked
+            partition = annotation_index.get(chr_num, strand)
+            if partition is None:
+                continue
+            if self.bin_size is not None:
+                self.bin_table(partition)
+            for i in range(0, len(rows), shard_size):
+                shards.append((chr_num, strand, rows[i: i + shard_size]))
+        hits = list(self.map_shards(annotation_index, shards, positions))
+        if hits:
+            hit_peaks = np.concatenate([shard[0] for shard in hits])
+            columns = {name: np.concatenate([shard[i + 1] for shard in hits]) for i, name in enumerate(HIT_COLUMNS)}
+        else:
+            hit_peaks = np.empty(0, dtype=np.int64)
+            columns = {name: np.empty(0, dtype=np.int64) for name in HIT_COLUMNS}
+        table = HitTable.from_hits(peak_num, hit_peaks, columns, annotation_index.element_names,
+                                   annotation_index.transcript_ids, annotation_index.gene_ids)
+        return table.best() if self.hits == "best" else table
+
+    def map_shards(self, annotation_index, shards, positions):
+        """
+        map the shards serially, or in a process pool when workers > 1 and fork is available. Forked workers share
+        the annotation index and peak centers with this process copy-on-write (the index is not pickled), only the
+        shard number goes to a worker and only the matched peaks come back.
+        :return: iterator of map_shard results
+        """
+        if self.workers <= 1 or len(shards) <= 1 or "fork" not in mp.get_all_start_methods():
+            return (self.map_shard(annotation_index, chr_num, strand, rows, positions)
+                    for chr_num, strand, rows in shards)
+        SHARED_STATE.update(mapper=self, annotation_index=annotation_index, shards=shards, positions=positions)
+        try:
+            with mp.get_context("fork").Pool(self.workers) as pool:
+                return pool.map(map_shard_worker, range(len(shards)))
+        finally:
+            SHARED_STATE.clear()
+
+    def map_shard(self, annotation_index, chr_num, strand, rows, positions):
+        """
+        find the hits of the peaks of one shard, all on the same chromosome strand.
+        :param annotation_index: AnnotationIndex object
+        :param chr_num: chromosome of the shard
+        :param strand: strand of the shard
+        :param rows: positions of the peaks of this shard in the peak DataFrame, type numpy array
+        :param positions: peak centers, peak starts and peak ends (1-based, closed) of the whole peak DataFrame, type
+                          tuple of numpy array
+        :return: the position of the peak of each hit in the peak DataFrame and the columns of HIT_COLUMNS, the hits
+                 of a peak ranked from the best
+        """
+        partition = annotation_index.get(chr_num, strand)
+        if partition is None:
+            return (rows[:0], ) + (np.empty(0, dtype=np.int64), ) * len(HIT_COLUMNS)
+        element_names = annotation_index.element_names
+        priority = np.array([self.priority[e] for e in element_names])
+        distance = np.array([self.distance[e] for e in element_names], dtype=np.float64)
+
+        centers, starts, ends = positions
+        # peaks at the same position (e.g. pooled replicates) are searched once, the distinct positions come sorted
+        # for the sweep
+        if self.overlap == "interval":
+            (shard_starts, shard_ends, shard_centers), inverse = unique_positions(starts[rows], ends[rows],
+                                                                                  centers[rows])
+            query, hit = self.shard_search(partition, shard_starts, shard_ends)
+        else:
+            (shard_centers, ), inverse = unique_positions(centers[rows])
+            query, hit = self.shard_search(partition, shard_centers, shard_centers)
+        hit_center, hit_start, hit_end = shard_centers[query], partition.starts[hit], partition.ends[hit]
+        hit_element = partition.elements[hit]
+        if self.overlap == "interval":
+            hit_peak_start, hit_peak_end = shard_starts[query], shard_ends[query]
+            overlap_length = np.minimum(hit_peak_end, hit_end) - np.maximum(hit_peak_start, hit_start) + 1
+            fraction = overlap_length / np.maximum(hit_peak_end - hit_peak_start + 1, 1)
+            hit_center = np.clip(hit_center, hit_start, hit_end)
+        else:
+            fraction = np.ones(len(hit))
+        if strand == "-":
+            hit_distance = hit_end - hit_center + 1
+        else:
+            hit_distance = hit_center - hit_start + 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = hit_distance / (hit_end - hit_start) * 100 + distance[hit_element]
+        # the first hit of each peak after ranking is the one with the highest priority, then the largest overlap
+        # and then the largest ratio
+        order = rank_hits(query, priority[hit_element], fraction, ratio)
+        query, hit = query[order], hit[order]
+        # broadcast the hits of each distinct position back to its peaks
+        offsets = np.searchsorted(query, np.arange(len(shard_centers) + 1))
+        peak, best = expand_ranges(offsets[inverse], offsets[inverse + 1])
+        order, hit = order[best], hit[best]
+        return (rows[peak], hit_element[order], partition.transcripts[hit], partition.genes[hit], hit_start[order],
+                hit_end[order], ratio[order], fraction[order])
+
+    def bin_table(self, partition):
+        """
+        :param partition: StrandIndex object
+        :return: the BinTable of the partition with windows of bin_size, built if the partition has none yet
+        """
+        if partition.bins is not None and partition.bins.bin_size == self.bin_size:
+            return partition.bins
+        with instrument_stage(self.instrument, "bin_table_build"):
+            return partition.binned(self.bin_size)
+
+    def shard_search(self, partition, starts, ends):
+        """
+        find the elements overlapping the sorted distinct queries of a shard, in the bin table when bin_size is set,
+        otherwise by a sweep over the partition.
+        :return: see StrandIndex.overlap
+        """
+        if self.bin_size is not None:
+            return partition.binned(self.bin_size).overlap(starts, ends)
+        return partition.sweep(starts, ends)
+
     def peak_location(self, peak_record, gtf_tree):
+        """
+        match one peak to the best transcript element.
+        :param peak_record: one row of the peak DataFrame
+        :param gtf_tree: the nested interval trees or an AnnotationIndex, see build_gtf_tree
+        :return: location, element start, element end and element name, all None if no element matched
+        """
+        if isinstance(gtf_tree, AnnotationIndex):
+            return self.index_location(peak_record, gtf_tree)
         chr_num = peak_record["chr"]
         strand = peak_record["strand"]
         peak_center = peak_record["peak_center"]
         try:
             interval = gtf_tree[chr_num][strand]["interval"]
-            if peak_center not in range(int(interval[0]), interval[1]+1):
+            if not interval[0] <= peak_center <= interval[1]:
                 return None, None, None, None
             gene_tree = gtf_tree[chr_num][strand]["gene_tree"]
             gene_tree_search = self.it.search(gene_tree.root, peak_center)
@@ -86,65 +577,120 @@ class PeakMapper:
             # the place where peak center locates matchs no element
             if not element_tree_search:
                 return None, None, None, None
-            best_priority = float("inf")
-            best_ratio = -1 * float("inf")
-            element_start, element_end = 0, 0
-            locate_element = None
-            for e in element_tree_search:
-                element_name = e.name
-                element_priority = self.priority[element_name]
-                if best_priority >= element_priority:
-                    best_priority = element_priority
-                    if strand == "+":
-                        distance = peak_center - e.interval_start + 1
-                    elif strand == "-":
-                        distance = e.interval_end - peak_center + 1
-                    ratio = distance / (e.interval_end - e.interval_start) * 100 + self.distance[element_name]
-                    if best_ratio < ratio:
-                        element_start = e.interval_start
-                        element_end = e.interval_end
-                        locate_element = element_name
-                        best_ratio = ratio
-            return best_ratio, element_start, element_end, locate_element
+            candidates = [(e.name, e.interval_start, e.interval_end) for e in element_tree_search]
+            return self.best_element(candidates, strand, peak_center)
 
         except KeyError:
-            return None, None, None
+            return None, None, None, None
+
+    def location_lookup(self, chr_num, strand, peak_center, gtf_tree):
+        """
+        peak_location behind a bounded LRU cache keyed on the peak position.
+        :return: see peak_location
+        """
+        if self.cache_size <= 0:
+            return self.peak_location({"chr": chr_num, "strand": strand, "peak_center": peak_center}, gtf_tree)
+        if self.cache_owner is not gtf_tree:
+            self.location_cache.clear()
+            self.cache_owner = gtf_tree
+        key = (chr_num, strand, peak_center)
+        result = self.location_cache.pop(key, None)
+        if result is None:
+            if self.instrument is not None:
+                self.instrument.count("location_cache_misses")
+            result = self.peak_location({"chr": chr_num, "strand": strand, "peak_center": peak_center}, gtf_tree)
+            if len(self.location_cache) >= self.cache_size:
+                self.location_cache.popitem(last=False)
+        elif self.instrument is not None:
+            self.instrument.count("location_cache_hits")
+        self.location_cache[key] = result
+        return result
+
+    def index_location(self, peak_record, annotation_index):
+        """
+        the same as peak_location but search the AnnotationIndex.
+        """
+        strand = peak_record["strand"]
+        peak_center = peak_record["peak_center"]
+        partition = annotation_index.get(peak_record["chr"], strand)
+        if partition is None:
+            return None, None, None, None
+        if self.bin_size is not None:
+            hit = partition.binned(self.bin_size).lookup(peak_center)
+        else:
+            _, hit = partition.search([peak_center])
+        if len(hit) == 0:
+            return None, None, None, None
+        element_names = annotation_index.element_names
+        candidates = [(element_names[partition.elements[i]], int(partition.starts[i]), int(partition.ends[i]))
+                      for i in hit]
+        return self.best_element(candidates, strand, peak_center)
 
+    def best_element(self, candidates, strand, peak_center):
+        """
+        choose the element with the highest priority among the candidates.
+        :param candidates: element name, element start and element end of the elements where peak center locates
+        :param strand: strand of the peak
+        :param peak_center: peak center
+        :return: location, element start, element end and element name
+        """
+        best_priority = float("inf")
+        best_ratio = -1 * float("inf")
+        element_start, element_end = 0, 0
+        locate_element = None
+        for element_name, start, end in candidates:
+            element_priority = self.priority[element_name]
+            if element_priority > best_priority:
+                continue
+            if strand == "-":
+                distance = end - peak_center + 1
+            else:
+                distance = peak_center - start + 1
+            ratio = distance / (end - start) * 100 + self.distance[element_name]
+            # an element with higher priority always wins, the ratio only breaks ties between equal priorities
+            if element_priority < best_priority or best_ratio < ratio:
+                element_start = start
+                element_end = end
+                locate_element = element_name
+                best_priority = element_priority
+                best_ratio = ratio
+        return best_ratio, element_start, element_end, locate_element
 
-if __name__ == "__main__":
-    warnings.filterwarnings("ignore")
-    # parser = argparse.ArgumentParser(prog="peak_mapping", description="map the merip-seq, medip-seq peaks on "
-    #                                                                   "genome elements")
-    # parser.add_argument("-g", "--gtf", action="store", type=str, required=True, help="file path of GTF format file")
-    # parser.add_argument("-p", "--priority", action="store", type=dict, required=True,
-    #                     help="element priorities, type python dict. Key is element, value represent priority.")
-    # parser.add_argument("-d", "--distance", action="store", type=dict, required=True, help="for future figuring")
-    # parser.add_argument("-pk", "--peak",  action="store", type=str, required=True,
-    #                     help="file path of BED format peak file")
-    # parser.add_argument("-o", "--output", action="store", type=str, required=True, help="file path of output file")
-    # args = parser.parse_args()
-    # gtf = args.gtf
-    # priority = args.priority
-    # distance = args.distance
-    # peak = args.peak
-    # output = args.output
-    #
-    # pm = PeakMapper(gtf, priority, distance, peak)
-    # tree = pm.build_gtf_tree()
-    # peak = pm.load_peak_data()
-    # peak = pm.peak_mapping(tree, peak)
-    # peak.to_csv(output, sep="\t", index=False, mode="w", encoding="utf-8")
-
-    # just test code
-    pm = PeakMapper("/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/reference_files/simple.gtf",
-                    {"stop_codon": 1, "three_prime_utr": 2, "CDS": 3, "five_prime_utr": 4},
-                    {"stop_codon": 200, "three_prime_utr": 200, "CDS": 100, "five_prime_utr": 0},
-                    "/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/reference_files/peak.bed")
-    tree = pm.build_gtf_tree()
-    peak = pm.load_peak_data()
-    peak = pm.peak_mapping(tree, peak)
-    peak.to_csv("/data/nanopore/merip_seq_data/metpeak_calling_res/peak_location/reference_files/peak_loc.tsv",
-                sep="\t", index=False, mode="w", encoding="utf-8")
+
+def map_shard_worker(shard_id):
+    """
+    the work of one process of PeakMapper.map_shards, the state is inherited from the parent process by fork.
+    """
+    chr_num, strand, rows = SHARED_STATE["shards"][shard_id]
+    return SHARED_STATE["mapper"].map_shard(SHARED_STATE["annotation_index"], chr_num, strand, rows,
+                                            SHARED_STATE["positions"])
+
+
+def map_sample_worker(job_id):
+    """
+    the work of one process of PeakMapper.map_samples, the state is inherited from the parent process by fork.
+    """
+    # the pool processes are daemonic and can not start a pool of their own
+    return map_sample_job(SHARED_STATE["mapper"], SHARED_STATE["gtf_tree"], SHARED_STATE["jobs"][job_id],
+                          SHARED_STATE["chunk_size"], workers=1)
 
 
+def map_sample_job(mapper, gtf_tree, job, chunk_size, workers=None):
+    """
+    map one peak file of PeakMapper.map_samples.
+    :param mapper: the PeakMapper of map_samples
+    :param job: peak file and output path
+    :param workers: the workers of the sample mapper, those of mapper if None
+    :return: the summary of the sample and its histogram
+    """
+    peak_file, output = job
+    sample_mapper = mapper.sample_mapper(peak_file)
+    if workers is not None:
+        sample_mapper.workers = workers
+    return sample_mapper.map_sample(gtf_tree, output, chunk_size), sample_mapper.histogram
 
+
+if __name__ == "__main__":
+    # the command line lives in cli.py ("python cli.py map ..."), this keeps "python peak_mapping.py ..." working
+    from cli import main
+    sys.exit(main(["map"] + sys.argv[1:]))
@@ -5,8 +5,17 @@
 Description:
     Load and extract useful informations from the BED format output file of peak calling software, such as MACS and
     MeTPeak etc.
+    The file is loaded with pandas.read_csv and the peak centers are computed with NumPy on whole columns. For BED12
+    records with several blocks (spliced peaks), the center is found with prefix sums over blockSizes.
+    A Parquet or Feather peak file (see table_io) holds the BED columns in the same order, whatever their names.
 """
+from contextlib import nullcontext
+from table_io import file_format, column_names, read_table, iter_table
+import numpy as np
 import pandas as pd
+import gzip
+
+PEAK_COLUMNS = ["chr", "start", "end", "strand", "peak_center", "peak_length"]
 
 
 class PeakReader:
@@ -14,6 +23,10 @@ class PeakReader:
     handling for bed format file generated by MeTPeak、MACS etc.
     """
     def __init__(self, peak_file):
+        """
+        :param peak_file: the path of BED format file, possibly gzip compressed (or of a Parquet / Feather file with
+                          the BED columns), or a text buffer (e.g. io.StringIO) holding BED lines
+        """
         self.peak_file = peak_file
         self.peaks = []
 
@@ -22,69 +35,193 @@ class PeakReader:
         extract peak information from bed format file.
         :return:
         """
-        with open(self.peak_file, "r") as f:
+        self.peaks = PeakReader.peak_frame(self.read_bed(), self.block_columns())
+        return None
+
+    def iter_peaks(self, chunk_size=100000):
+        """
+        read the bed format file in chunks, so that the memory used does not grow with the size of the file.
+        :param chunk_size: the number of peaks in each chunk
+        :return: generator of peak DataFrames with the same columns as peak_info
+        """
+        block_columns = self.block_columns()
+        for bed in self.read_bed(chunk_size):
+            yield PeakReader.peak_frame(bed, block_columns)
+
+    def position_sorted(self, chunk_size=100000):
+        """
+        check that the records of each chromosome are consecutive and sorted by start, then end, as in a BED file
+        sorted with "sort -k1,1 -k2,2n -k3,3n" or "bedtools sort". The file is read in chunks and the check stops at
+        the first record out of order.
+        :param chunk_size: the number of records read at a time
+        :return: type bool
+        """
+        finished, last = set(), None
+        for bed in self.read_bed(chunk_size):
+            if len(bed) == 0:
+                continue
+            chrs = bed[0].to_numpy(dtype=object)
+            starts, ends = bed[1].to_numpy(dtype=np.int64), bed[2].to_numpy(dtype=np.int64)
+            if last is not None:
+                # the last record of the previous chunk goes first
+                chrs = np.concatenate([np.array([last[0]], dtype=object), chrs])
+                starts, ends = np.concatenate([[last[1]], starts]), np.concatenate([[last[2]], ends])
+            same = chrs[1:] == chrs[:-1]
+            if (same & ((starts[1:] < starts[:-1]) | ((starts[1:] == starts[:-1]) & (ends[1:] < ends[:-1])))).any():
+                return False
+            # a chromosome is finished when the next record is on another one, it must not come back
+            for i in np.flatnonzero(~same):
+                finished.add(chrs[i])
+                if chrs[i + 1] in finished:
+                    return False
+            last = (chrs[-1], starts[-1], ends[-1])
+        return True
+
+    def column_number(self):
+        """
+        :return: the number of columns of the first record
+        """
+        if file_format(self.peak_file) != "tsv":
+            return len(column_names(self.peak_file))
+        with self.open_peak() as f:
             for line in f:
-                if line.startswith("#"):
-                    continue
-                info = line.split("\t")
-                if len(info) >= 10:
-                    try:
-                        chr_num, start, end, strand, peak_center, peak_length = PeakReader.peak_with_block(info)
-                    except:
-                        print(line)
-                        exit()
-                else:
-                    chr_num, start, end, strand, peak_center, peak_length = PeakReader.peak_without_block(info)
-                self.peaks.append([chr_num, start, end, strand, peak_center, peak_length])
-        self.peaks = pd.DataFrame(self.peaks, columns=["chr", "start", "end", "strand", "peak_center", "peak_length"])
+                if not line.startswith("#") and line.strip():
+                    return len(line.rstrip("\n").split("\t"))
+        return 0
+
+    def open_peak(self):
+        """
+        open the peak file, files ending with ".gz" are decompressed on the fly, a text buffer is rewound instead.
+        """
+        if isinstance(self.peak_file, str):
+            if self.peak_file.endswith(".gz"):
+                return gzip.open(self.peak_file, "rt")
+            return open(self.peak_file, "r")
+        self.peak_file.seek(0)
+        return nullcontext(self.peak_file)
+
+    def block_columns(self):
+        """
+        block count, block sizes and block starts are the last three columns of a BED file with at least 10 columns.
+        :return: column numbers of block count, block sizes and block starts, None if the file has no blocks
+        """
+        column_number = self.column_number()
+        if column_number >= 10:
+            return column_number - 3, column_number - 2, column_number - 1
         return None
 
+    def read_bed(self, chunk_size=None):
+        """
+        load the columns needed from the bed format file with explicit dtypes. Records with less columns than the
+        first record (e.g. BED6 records in a BED12 file) get NaN in the missing columns.
+        :param chunk_size: None to read the whole file, otherwise the number of records in each chunk
+        :return: DataFrame, or an iterator of DataFrame when chunk_size is given
+        """
+        column_number = self.column_number()
+        if column_number == 0:
+            # no record at all
+            bed = pd.DataFrame({0: pd.Series(dtype=object), 1: pd.Series(dtype=np.int64),
+                                2: pd.Series(dtype=np.int64)})
+            return bed if chunk_size is None else iter([bed])
+        usecols = [0, 1, 2] + ([5] if column_number >= 6 else [])
+        dtype = {0: object, 1: np.int64, 2: np.int64, 5: object}
+        block_columns = self.block_columns()
+        if block_columns is not None:
+            block_count, block_sizes, block_starts = block_columns
+            usecols += [block_count, block_sizes, block_starts]
+            dtype.update({block_count: np.float64, block_sizes: object, block_starts: object})
+        if file_format(self.peak_file) != "tsv":
+            return self.read_columnar(usecols, chunk_size)
+        if not isinstance(self.peak_file, str):
+            self.peak_file.seek(0)
+        return pd.read_csv(self.peak_file, sep="\t", header=None, names=list(range(column_number)), comment="#",
+                           usecols=usecols, dtype={i: dtype[i] for i in usecols}, chunksize=chunk_size)
+
+    def read_columnar(self, usecols, chunk_size=None):
+        """
+        read_bed for a Parquet or Feather peak file, the columns are numbered by their position.
+        """
+        names = column_names(self.peak_file)
+        columns = [names[i] for i in usecols]
+
+        def numbered(bed):
+            # categorical chr / strand columns are turned back into plain strings
+            bed = bed.astype({name: object for name in columns if isinstance(bed[name].dtype, pd.CategoricalDtype)})
+            return bed.rename(columns={name: i for i, name in zip(usecols, columns)})
+
+        if chunk_size is None:
+            return numbered(read_table(self.peak_file, columns))
+        return (numbered(bed) for bed in iter_table(self.peak_file, chunk_size, columns))
+
     @staticmethod
-    def peak_with_block(info):
+    def peak_frame(bed, block_columns):
         """
-        bed file has at least 10 columns, if the number in the teenth column is greater than 1 represent that blocks
-        exist in this area.
-        :return:
+        compute the peak center and peak length of every record.
+        :param bed: records loaded by read_bed, type pandas DataFrame
+        :param block_columns: see block_columns
+        :return: DataFrame with PEAK_COLUMNS
         """
-        chr_num, start, end, strand, count, block_size, block_start = info[0], int(info[1]), info[2], info[5], info[-3], info[-2], info[-1]
-        if int(count) > 1:
-            sizes = list(map(int, block_size.split(",")[:-1]))
-            start_sites = list(map(int, block_start.split(",")))
-            peak_length = sum(sizes)
-            if sizes[0] > peak_length // 2 + 1:
-                peak_center = start + peak_length // 2 + 1
-            else:
-                for i in range(1, len(sizes)):
-                    if sum(sizes[:i]) <= peak_length // 2 + 1 < sum(sizes[:i+1]):
-                        peak_center = start + start_sites[i] + peak_length // 2 + 1 - sum(sizes[:i])
-                        break
-                    else:
-                        continue
-
-        else:
-            block_size = block_size.split(",")[0]
-            peak_length = int(block_size)
-            peak_center = int(start) + peak_length // 2 + 1
-
-        return chr_num, start, end, strand, peak_center, peak_length
+        starts = bed[1].to_numpy(dtype=np.int64)
+        ends = bed[2].to_numpy(dtype=np.int64)
+        # without blocks the whole record is a single block
+        peak_length = ends - starts
+        peak_center = starts + peak_length // 2 + 1
+
+        if block_columns is not None:
+            block_count, block_sizes, block_starts = block_columns
+            with_block = bed[block_count].notna().to_numpy()
+        if block_columns is not None and with_block.any():
+            center, length = PeakReader.block_center(starts[with_block],
+                                                     bed[block_count].to_numpy()[with_block].astype(np.int64),
+                                                     bed[block_sizes].to_numpy(dtype=object)[with_block],
+                                                     bed[block_starts].to_numpy(dtype=object)[with_block])
+            peak_center[with_block] = center
+            peak_length[with_block] = length
+
+        strand = bed[5].fillna("+").to_numpy() if 5 in bed.columns else np.full(len(bed), "+", dtype=object)
+        return pd.DataFrame({"chr": bed[0].to_numpy(), "start": starts, "end": ends,
+                             "strand": strand, "peak_center": peak_center,
+                             "peak_length": peak_length}, columns=PEAK_COLUMNS)
 
     @staticmethod
-    def peak_without_block(info):
+    def block_center(starts, counts, block_sizes, block_starts):
         """
-        bed file has less than 10 columns or the number in the teenth column equals 1 represent no existed blocks
-        in this area.
-        :return:
+        the center of a spliced peak is the position where half of the block length (peak_length // 2 + 1) is
+        reached, walking through the blocks. With the prefix sums of the block sizes of all records, the block which
+        holds the center of each record is found by one np.searchsorted.
+        :param starts: record starts, type numpy array
+        :param counts: blockCount column, type numpy array
+        :param block_sizes: blockSizes column, comma separated, type numpy array of string
+        :param block_starts: blockStarts column, comma separated, type numpy array of string
+        :return: peak centers and peak lengths, type numpy array
         """
-        try:
-            strand = info[5]
-        except IndexError:
-            strand = "+"
+        sizes = PeakReader.join_integers(block_sizes)
+        offsets = PeakReader.join_integers(block_starts)
+        if len(sizes) != counts.sum() or len(offsets) != counts.sum():
+            raise ValueError("blockCount does not match the number of blockSizes or blockStarts")
+        last = np.cumsum(counts) - 1
+        first = last - counts + 1
 
-        chr_num, start, end = info[0], info[1], info[2]
-        peak_length = end - start + 1
-        peak_center = start + (start - end) // 2
+        cum_sizes = np.cumsum(sizes)
+        # the total block size before each record
+        base = cum_sizes[first] - sizes[first]
+        peak_length = cum_sizes[last] - base
+        half = peak_length // 2 + 1
+        # the first block whose prefix sum exceeds half of the peak length holds the center
+        block = np.clip(np.searchsorted(cum_sizes, base + half, side="right"), first, last)
+        before = cum_sizes[block] - sizes[block] - base
+        peak_center = starts + offsets[block] + half - before
+        return peak_center, peak_length
 
-        return chr_num, start, end, strand, peak_center, peak_length
+    @staticmethod
+    def join_integers(values):
+        """
+        parse the comma separated integer lists of all records into one flat array, with or without trailing commas.
+        :param values: type numpy array of string
+        :return: type numpy array
+        """
+        joined = ",".join(values).replace(",,", ",").strip(",")
+        return np.fromstring(joined, dtype=np.int64, sep=",")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Reading and writing peak tables (the output of PeakMapper, and peak files) as tab separated text or as typed
+    columnar files. The format follows the file extension: ".parquet" / ".pq" for Parquet, ".feather" / ".arrow" for
+    Feather (Arrow IPC), anything else is TSV. The columnar formats need the optional pyarrow package.
+    chr, strand, element_name, transcript_id and gene_id are stored as dictionary (categorical) columns whose
+    categories grow from chunk to chunk, so a file written chunk by chunk keeps one consistent dictionary. Feather
+    files are written uncompressed, so that reading a column maps the file instead of parsing or decompressing it.
+"""
+import pandas as pd
+
+# pyarrow is imported by require_pyarrow on first use, a TSV run does not pay for its import
+pa, feather, pq = None, None, None
+
+# the text columns stored as dictionary columns
+CATEGORICAL_COLUMNS = ("chr", "strand", "element_name", "transcript_id", "gene_id")
+
+
+def file_format(path):
+    """
+    :param path: file path, or a text buffer which is always TSV
+    :return: "parquet", "feather" or "tsv"
+    """
+    if not isinstance(path, str):
+        return "tsv"
+    name = path.lower()
+    if name.endswith((".parquet", ".pq")):
+        return "parquet"
+    if name.endswith((".feather", ".arrow")):
+        return "feather"
+    return "tsv"
+
+
+def require_pyarrow(path):
+    """
+    import pyarrow, raise ImportError naming the file when it is not installed.
+    """
+    global pa, feather, pq
+    if pa is not None:
+        return None
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required to read or write %s" % path)
+    pa, feather, pq = pyarrow, pyarrow.feather, pyarrow.parquet
+    return None
+
+
+def column_names(path):
+    """
+    :return: the column names of a peak table, type list
+    """
+    fmt = file_format(path)
+    if fmt == "tsv":
+        return pd.read_csv(path, sep="\t", nrows=0).columns.tolist()
+    require_pyarrow(path)
+    if fmt == "parquet":
+        return pq.read_schema(path).names
+    return feather.read_table(path, memory_map=True).schema.names
+
+
+def read_table(path, columns=None):
+    """
+    read a whole peak table.
+    :param path: file path
+    :param columns: the names of the columns read, None for all
+    :return: type pandas DataFrame
+    """
+    fmt = file_format(path)
+    if fmt == "tsv":
+        return pd.read_csv(path, sep="\t", usecols=columns)
+    require_pyarrow(path)
+    if fmt == "parquet":
+        return pq.read_table(path, columns=columns).to_pandas()
+    return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+
+def read_column(path, name):
+    """
+    read one column of a peak table. From a Feather file written at once the array is a view of the memory-mapped
+    file, from a Parquet file only the pages of this column are decoded.
+    :param path: file path
+    :param name: column name
+    :return: type numpy array
+    """
+    fmt = file_format(path)
+    if fmt == "tsv":
+        return pd.read_csv(path, sep="\t", usecols=[name])[name].to_numpy()
+    require_pyarrow(path)
+    if fmt == "parquet":
+        column = pq.read_table(path, columns=[name]).column(name)
+    else:
+        column = feather.read_table(path, columns=[name], memory_map=True).column(name)
+    if column.num_chunks == 1:
+        return column.chunk(0).to_numpy(zero_copy_only=False)
+    return column.to_numpy()
+
+
+def iter_table(path, chunk_size, columns=None, text=False):
+    """
+    read a peak table chunk by chunk.
+    :param path: file path
+    :param chunk_size: the number of records in each chunk (for Feather, the record batches of the file are taken
+                       as they are)
+    :param columns: the names of the columns read, None for all
+    :param text: return every value as text, as read from a TSV file
+    :return: generator of pandas DataFrame
+    """
+    fmt = file_format(path)
+    if fmt == "tsv":
+        options = {"dtype": str, "keep_default_na": False} if text else {}
+        yield from pd.read_csv(path, sep="\t", usecols=columns, chunksize=chunk_size, **options)
+        return
+    require_pyarrow(path)
+    if fmt == "parquet":
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns)
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        if columns is not None:
+            batches = (batch.select(columns) for batch in batches)
+    for batch in batches:
+        frame = batch.to_pandas()
+        if text:
+            frame = frame.astype(str)
+        yield frame
+
+
+def infer_types(frame):
+    """
+    turn the text columns holding numbers back into numbers, e.g. for the text chunks of
+    handle_peak_loc.external_deduplicate.
+    :param frame: type pandas DataFrame
+    :return: type pandas DataFrame
+    """
+    frame = frame.copy()
+    for column in frame.columns:
+        if pd.api.types.is_string_dtype(frame[column]) and column not in CATEGORICAL_COLUMNS:
+            try:
+                frame[column] = pd.to_numeric(frame[column])
+            except (ValueError, TypeError):
+                pass
+    return frame
+
+
+class TableWriter:
+    """
+    write a peak table chunk by chunk, in the format given by the file extension.
+    """
+    def __init__(self, path):
+        """
+        :param path: file path
+        """
+        self.path = path
+        self.format = file_format(path)
+        if self.format != "tsv":
+            require_pyarrow(path)
+        self.writer = None
+        self.schema = None
+        # the last empty frame written before any record, see write
+        self.empty = None
+        self.categories = {}
+        self.rows = 0
+        self.chunks = 0
+
+    def write(self, frame):
+        """
+        append the records of a DataFrame, the first frame decides the columns.
+        """
+        if self.format == "tsv":
+            frame.to_csv(self.path, sep="\t", index=False, header=self.chunks == 0,
+                         mode="w" if self.chunks == 0 else "a", encoding="utf-8")
+        elif self.writer is None and len(frame) == 0:
+            # the object columns of an empty frame would be typed null, the schema is taken from the first non-empty
+            # frame and an empty file is only written by close when no record came at all
+            self.empty = frame
+        else:
+            self.write_arrow(frame)
+        self.rows += len(frame)
+        self.chunks += 1
+        return None
+
+    def write_arrow(self, frame):
+        """
+        append a frame to the Parquet or Feather file, the writer is opened with the schema of the first frame.
+        """
+        table = pa.Table.from_pandas(self.categorical(frame), schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            # the categories grow with the chunks, the dictionary indices are fixed to int32 for all of them
+            self.schema = pa.schema([field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+                                     if pa.types.is_dictionary(field.type) else field for field in table.schema],
+                                    metadata=table.schema.metadata)
+            table = table.cast(self.schema)
+            if self.format == "parquet":
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                # a later chunk extends the dictionaries of the earlier ones, which the IPC file format takes
+                # as dictionary deltas
+                options = pa.ipc.IpcWriteOptions(compression=None, emit_dictionary_deltas=True)
+                self.writer = pa.ipc.new_file(self.path, self.schema, options=options)
+        self.writer.write_table(table)
+        return None
+
+    def categorical(self, frame):
+        """
+        turn the text columns of CATEGORICAL_COLUMNS into categoricals, the categories of earlier chunks come first.
+        """
+        columns = {}
+        for column in CATEGORICAL_COLUMNS:
+            if column not in frame.columns:
+                continue
+            values = frame[column].astype(object)
+            known = self.categories.setdefault(column, [])
+            new = pd.unique(values[~values.isin(known) & values.notna()])
+            known.extend(new.tolist())
+            columns[column] = pd.Categorical(values, categories=known)
+        return frame.assign(**columns)
+
+    def close(self):
+        if self.writer is None and self.empty is not None:
+            empty, self.empty = self.empty, None
+            self.write_arrow(empty.astype({column: str for column in empty.columns if empty[column].dtype == object}))
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_table(frame, path):
+    """
+    write a whole peak table.
+    :param frame: type pandas DataFrame
+    :param path: file path
+    :return:
+    """
+    with TableWriter(path) as writer:
+        writer.write(frame)
+    return None
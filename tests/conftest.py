@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+"""
+@author: hbs
+@date: 2026-10-18
+Description:
+    Shared fixtures of the tests: the modules of the repository are imported from its root, GTF and BED files are
+    written into the temporary directory of each test.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interval_tree import RED, BLACK
+
+PRIORITY = {"stop_codon": 1, "three_prime_utr": 2, "CDS": 3, "five_prime_utr": 4}
+DISTANCE = {"stop_codon": 200, "three_prime_utr": 200, "CDS": 100, "five_prime_utr": 0}
+
+
+def gtf_line(chr_num, element, start, end, strand, gene_id, transcript_id):
+    return '%s\ttest\t%s\t%d\t%d\t.\t%s\t.\tgene_id "%s"; transcript_id "%s";\n' % (
+        chr_num, element, start, end, strand, gene_id, transcript_id)
+
+
+def check_red_black(tree):
+    """
+    assert the red-black properties of an IntervalTree, the (start, end) order of its nodes, their parent links and
+    their max_end.
+    :return: the nodes in order, type list
+    """
+    assert tree.root is None or (tree.root.color == BLACK and tree.root.parent is None)
+    black_heights = set()
+    stack = [(tree.root, 0)]
+    while stack:
+        node, black_height = stack.pop()
+        if node is None:
+            black_heights.add(black_height)
+            continue
+        assert node.color in (RED, BLACK)
+        max_end = node.interval_end
+        for child in (node.left_child, node.right_child):
+            if child is not None:
+                assert child.parent is node
+                assert not (node.color == RED and child.color == RED)
+                max_end = max(max_end, child.max_end)
+            stack.append((child, black_height + (node.color == BLACK)))
+        assert node.max_end == max_end
+    assert len(black_heights) <= 1
+    nodes = list(tree.inorder())
+    keys = [(node.interval_start, node.interval_end) for node in nodes]
+    assert keys == sorted(keys)
+    return nodes
+
+
+def random_annotation(rand, genes=60, chromosomes=("chr1", "chr2")):
+    """
+    GTF records of random genes with 1-3 transcripts of 1-4 elements each, the records of a gene are consecutive.
+    :param rand: random.Random object
+    :return: list of (chr, element, start, end, strand, gene_id, transcript_id)
+    """
+    records = []
+    for gene in range(genes):
+        chr_num, strand, gene_start = rand.choice(chromosomes), rand.choice("+-"), rand.randrange(1, 50000)
+        for transcript in range(rand.randint(1, 3)):
+            for _ in range(rand.randint(1, 4)):
+                start = gene_start + rand.randrange(0, 3000)
+                records.append((chr_num, rand.choice(list(PRIORITY)), start, start + rand.randrange(0, 400), strand,
+                                "g%d" % gene, "g%d.t%d" % (gene, transcript)))
+    return records
+
+
+def random_delta(rand, records):
+    """
+    a random delta of an annotation: removed transcripts and genes, replaced transcripts, new transcripts of existing
+    (possibly removed) genes and new genes, one of them on a new chromosome.
+    :param rand: random.Random object
+    :param records: records of the annotation, see random_annotation
+    :return: delta records, remove_ids and the records of the annotation with the delta applied
+    """
+    genes = {record[5]: (record[0], record[4]) for record in records}
+    transcripts = {record[6]: record[5] for record in records}
+    remove_ids = rand.sample(sorted(transcripts), 8) + rand.sample(sorted(genes), 4)
+    delta_transcripts = [(transcript_id, transcripts[transcript_id]) for transcript_id in
+                         rand.sample(sorted(transcripts), 10)]
+    delta_transcripts += [("%s.new" % gene_id, gene_id) for gene_id in rand.sample(sorted(genes), 6)]
+    delta_transcripts += [("n%d.t0" % i, "n%d" % i) for i in range(4)]
+    genes.update({"n%d" % i: (rand.choice(["chr1", "chr3"]), rand.choice("+-")) for i in range(4)})
+    delta = []
+    for transcript_id, gene_id in delta_transcripts:
+        chr_num, strand = genes[gene_id]
+        for _ in range(rand.randint(1, 4)):
+            start = rand.randrange(1, 50000)
+            delta.append((chr_num, rand.choice(list(PRIORITY)), start, start + rand.randrange(0, 400), strand, gene_id,
+                          transcript_id))
+    replaced = set(remove_ids) | {transcript_id for transcript_id, _ in delta_transcripts}
+    patched = [record for record in records if record[5] not in replaced and record[6] not in replaced]
+    return delta, remove_ids, patched + delta
+
+
+def index_records(annotation_index):
+    """
+    the records of an AnnotationIndex, checking that each partition is sorted with its running max end.
+    :return: sorted list of (chr, element, start, end, strand, gene_id, transcript_id)
+    """
+    records = []
+    for (chr_num, strand), partition in annotation_index.partitions.items():
+        assert len(partition) > 0
+        assert list(zip(partition.starts, partition.ends)) == sorted(zip(partition.starts, partition.ends))
+        assert (partition.max_ends == np.maximum.accumulate(partition.ends)).all()
+        for start, end, element, transcript, gene in zip(partition.starts, partition.ends, partition.elements,
+                                                         partition.transcripts, partition.genes):
+            records.append((chr_num, annotation_index.element_names[element], int(start), int(end), strand,
+                            str(annotation_index.gene_ids[gene]), str(annotation_index.transcript_ids[transcript])))
+    return sorted(records)
+
+
+@pytest.fixture
+def write_gtf(tmp_path):
+    """
+    :return: function writing (chr, element, start, end, strand, gene_id, transcript_id) records into a GTF file in
+             the given order and returning its path
+    """
+    def write(records, name="test.gtf"):
+        path = tmp_path / name
+        with open(path, "w") as f:
+            f.writelines(gtf_line(*record) for record in records)
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def write_bed(tmp_path):
+    """
+    :return: function writing (chr, start, end, strand) peaks into a BED6 file and returning its path
+    """
+    def write(peaks, name="test.bed"):
+        path = tmp_path / name
+        with open(path, "w") as f:
+            for i, (chr_num, start, end, strand) in enumerate(peaks):
+                f.write("%s\t%d\t%d\tpeak%d\t0\t%s\n" % (chr_num, start, end, i, strand))
+        return str(path)
+    return write
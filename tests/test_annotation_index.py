@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+import random
+import numpy as np
+import pytest
+from conftest import PRIORITY, random_annotation, random_delta, index_records
+from annotation_index import StrandIndex
+from gtf_handler import GtfReader
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_update_against_rebuilt_index(write_gtf, seed):
+    rand = random.Random(seed)
+    records = random_annotation(rand)
+    delta, remove_ids, patched = random_delta(rand, records)
+    annotation_index = GtfReader(write_gtf(records), PRIORITY).build_index()
+    base = index_records(annotation_index)
+    updated = annotation_index.update(GtfReader(write_gtf(delta, "delta.gtf"), PRIORITY).records(), remove_ids)
+    expected = GtfReader(write_gtf(patched, "patched.gtf"), PRIORITY).build_index()
+    assert sorted(updated.partitions) == sorted(expected.partitions)
+    assert index_records(updated) == index_records(expected) == sorted(patched)
+    # the partitions shared with the updated index are left as they were
+    assert index_records(annotation_index) == base == sorted(records)
+
+
+def test_update_shares_untouched_partitions(write_gtf):
+    records = random_annotation(random.Random(5))
+    annotation_index = GtfReader(write_gtf(records), PRIORITY).build_index()
+    chr_num, _, _, _, strand, _, transcript_id = records[0]
+    updated = annotation_index.update([("chr3", "+", "n0", "n0.t0", "CDS", 100, 200)], [transcript_id])
+    for key, partition in annotation_index.partitions.items():
+        assert (updated.partitions[key] is partition) == (key != (chr_num, strand))
+    # the existing ids keep their codes, the new ones are appended
+    assert updated.transcript_ids.tolist() == annotation_index.transcript_ids.tolist() + ["n0.t0"]
+    assert updated.gene_ids.tolist() == annotation_index.gene_ids.tolist() + ["n0"]
+
+
+def random_partition(rand, size=500):
+    """
+    a StrandIndex of elements of random length, a few of them long enough to span many others.
+    """
+    starts = [rand.randrange(0, 100000) for _ in range(size)]
+    ends = [start + (rand.randrange(0, 20000) if rand.random() < 0.02 else rand.randrange(0, 500)) for start in starts]
+    return StrandIndex(starts, ends, [0] * size, list(range(size)), list(range(size)))
+
+
+def random_queries(rand, size=2000):
+    starts = np.array([rand.randrange(-1000, 121000) for _ in range(size)], dtype=np.int64)
+    return starts, starts + np.array([rand.randrange(0, 2000) for _ in range(size)], dtype=np.int64)
+
+
+def hit_pairs(query, hit):
+    return sorted(zip(query.tolist(), hit.tolist()))
+
+
+def brute_force_overlap(partition, starts, ends):
+    query, hit = np.nonzero((partition.starts[None, :] <= ends[:, None]) & (partition.ends[None, :] >= starts[:, None]))
+    return hit_pairs(query, hit)
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 100, 1000])
+def test_sweep_against_overlap(block_size):
+    rand = random.Random(block_size)
+    partition = random_partition(rand)
+    starts, ends = random_queries(rand)
+    order = np.argsort(starts, kind="stable")
+    for query_starts, query_ends in ((starts[order], ends[order]), (starts, ends), (starts[order], starts[order])):
+        expected = brute_force_overlap(partition, query_starts, query_ends)
+        assert expected and hit_pairs(*partition.overlap(query_starts, query_ends)) == expected
+        assert hit_pairs(*partition.sweep(query_starts, query_ends, block_size)) == expected
+
+
+@pytest.mark.parametrize("bin_size", [1, 64, 1000, 200000])
+def test_bin_table_against_overlap(bin_size):
+    rand = random.Random(bin_size)
+    partition = random_partition(rand)
+    bins = partition.binned(bin_size)
+    starts, ends = random_queries(rand)
+    # hits come once each, ordered by query and then by element row as with StrandIndex.overlap
+    query, hit = bins.overlap(starts, ends)
+    assert list(zip(query.tolist(), hit.tolist())) == brute_force_overlap(partition, starts, ends)
+    assert hit_pairs(*bins.search(starts)) == brute_force_overlap(partition, starts, starts)
+    contained = brute_force_overlap(partition, starts[:200], starts[:200])
+    for i, position in enumerate(starts[:200]):
+        assert sorted(bins.lookup(position).tolist()) == [row for query, row in contained if query == i]
+        assert not bins.lookup(position).size or bins.occupied([position])[0]
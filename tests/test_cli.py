@@ -0,0 +1,36 @@
+# -*- coding:utf-8 -*-
+import json
+import pandas as pd
+import pytest
+from conftest import PRIORITY, DISTANCE
+from cli import main
+
+
+def mapping_option(mapping):
+    return ",".join("%s=%s" % item for item in mapping.items())
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_report(write_gtf, write_bed, tmp_path, workers):
+    gtf = write_gtf([("chr1", "CDS", 200, 800, "+", "g1", "t1"), ("chr2", "CDS", 100, 900, "-", "g2", "t2")])
+    beds = [write_bed([("chr1", 300, 400, "+"), ("chr2", 200, 260, "-")], "s1.bed"),
+            write_bed([("chr1", 500, 600, "+"), ("chr3", 10, 20, "+")], "s2.bed")]
+    out, report = tmp_path / "out", tmp_path / "report.json"
+    assert main(["map", "-g", gtf, "-p", mapping_option(PRIORITY), "-d", mapping_option(DISTANCE), "-pk"] + beds +
+                ["--output-dir", str(out), "--histogram", str(tmp_path / "h.json"), "--report", str(report),
+                 "-w", str(workers)]) == 0
+    summary = pd.read_csv(out / "summary.tsv", sep="\t")
+    assert summary["peaks"].tolist() == [2, 2] and summary["mapped"].tolist() == [2, 1]
+    assert summary["CDS"].tolist() == [2, 1]
+    assert [json.load(open(out / ("%s.peak_loc.tsv.hist.json" % sample)))["peaks"] for sample in ("s1", "s2")] == [2, 1]
+    assert json.load(open(tmp_path / "h.json"))["peaks"] == 3
+    assert json.load(open(report))["counters"]["startup"] > 0
+
+
+def test_memory_requires_report(write_gtf, write_bed, tmp_path, capsys):
+    gtf = write_gtf([("chr1", "CDS", 200, 800, "+", "g1", "t1")])
+    with pytest.raises(SystemExit):
+        main(["map", "-g", gtf, "-p", mapping_option(PRIORITY), "-d", mapping_option(DISTANCE), "-pk",
+              write_bed([("chr1", 300, 400, "+")]), "-o", str(tmp_path / "out.tsv"), "--memory"])
+    assert "--memory" in capsys.readouterr().err
+    assert not (tmp_path / "out.tsv").exists()
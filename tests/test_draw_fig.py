@@ -0,0 +1,26 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+import pytest
+from draw_fig import PeakVisulizer
+
+
+@pytest.mark.parametrize("options", [{"bandwidth": 0}, {"bandwidth": -1.0}, {"bandwidth_test_range": (0.0, 1.0)},
+                                     {"bandwidth": "silverman"}])
+def test_bandwidth_must_be_positive(options):
+    # the rule of thumb of peaks all at one location is 0 as well
+    with pytest.raises(ValueError, match="bandwidth must be positive"):
+        PeakVisulizer.get_distribution(np.full(20, 150.0), **options)
+
+
+@pytest.mark.parametrize("weights", [None, np.ones(2)])
+def test_empty_peak_locations(weights):
+    with pytest.raises(ValueError, match="no peak location"):
+        PeakVisulizer.get_distribution(np.array([np.nan, np.inf]), weights=weights)
+    with pytest.raises(ValueError, match="no peak location"):
+        PeakVisulizer.get_distribution(np.array([]), bandwidth=1.0)
+
+
+def test_distribution_density():
+    kde_plots, parameters = PeakVisulizer.get_distribution(np.random.RandomState(0).normal(150, 20, 500))
+    assert kde_plots.shape == (301, 2) and 0.1 <= parameters["bandwidth"] <= 1.0
+    assert abs(kde_plots[:, 1].sum() - 1) < 0.01
@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+import random
+import pytest
+from conftest import PRIORITY, DISTANCE, check_red_black, random_annotation, random_delta, index_records
+from annotation_index import AnnotationIndex
+from gtf_handler import GtfReader
+from peak_mapping import PeakMapper
+
+
+def interleaved_records(seed=0, chromosomes=("chr1", "chr2", "chr3"), genes=40):
+    """
+    records of one CDS transcript per gene, the genes of the chromosomes in random order as in a patched reference
+    with records appended at the end.
+    """
+    rand = random.Random(seed)
+    records = []
+    for i in range(genes):
+        chr_num = rand.choice(chromosomes)
+        start = rand.randrange(1, 100000)
+        records.append((chr_num, "CDS", start, start + rand.randrange(50, 2000), rand.choice("+-"), "g%d" % i,
+                        "t%d" % i))
+    return records
+
+
+@pytest.mark.parametrize("chunk_size", [64, 1 << 23])
+def test_chromosome_offsets_interleaved(write_gtf, chunk_size):
+    records = interleaved_records()
+    gr = GtfReader(write_gtf(records), PRIORITY)
+    blocks = gr.chromosome_offsets(chunk_size)
+    with open(gr.gtf_file, "rb") as f:
+        data = f.read()
+    assert blocks[0][1] == 0 and blocks[-1][2] == len(data)
+    assert all(blocks[i][2] == blocks[i + 1][1] for i in range(len(blocks) - 1))
+    seen = []
+    for chr_num, start, end in blocks:
+        lines = data[start: end].decode().splitlines()
+        assert all(line.split("\t")[0] == chr_num for line in lines)
+        seen += [line.split("\t")[0] for line in lines]
+    assert seen == [record[0] for record in records]
+
+
+@pytest.mark.parametrize("backend", ["tree", "array"])
+def test_lazy_interleaved_gtf(write_gtf, write_bed, backend):
+    gtf = write_gtf([("chr1", "CDS", 100, 500, "+", "g1", "t1"), ("chr2", "CDS", 100, 500, "+", "g2", "t2"),
+                     ("chr1", "CDS", 1000, 1500, "+", "g3", "t3")])
+    bed = write_bed([("chr1", 200, 300, "+"), ("chr2", 200, 300, "+"), ("chr1", 1200, 1300, "+")])
+    results = []
+    for lazy in (False, True):
+        pm = PeakMapper(gtf, PRIORITY, DISTANCE, bed, backend=backend, lazy=lazy)
+        results.append(pm.peak_mapping(pm.build_gtf_tree(), pm.load_peak_data()).reset_index(drop=True))
+    assert len(results[0]) == 3
+    assert results[1].equals(results[0])
+
+
+@pytest.mark.parametrize("backend", ["tree", "array"])
+def test_lazy_appended_records(write_gtf, write_bed, backend):
+    records = sorted(interleaved_records(genes=60), key=lambda record: (record[0], record[2]))
+    records += [("chr1", "CDS", 200000 + i * 1000, 200500 + i * 1000, "+", "a%d" % i, "ta%d" % i) for i in range(3)]
+    gtf = write_gtf(records)
+    bed = write_bed([(chr_num, start, end, strand) for chr_num, _, start, end, strand, _, _ in records])
+    results = []
+    for lazy in (False, True):
+        pm = PeakMapper(gtf, PRIORITY, DISTANCE, bed, backend=backend, lazy=lazy)
+        results.append(pm.peak_mapping(pm.build_gtf_tree(), pm.load_peak_data()).reset_index(drop=True))
+    assert len(results[0]) == len(records)
+    assert results[1].equals(results[0])
+
+
+def test_build_index_parallel_interleaved(write_gtf):
+    gtf = write_gtf(interleaved_records(genes=200))
+    serial = GtfReader(gtf, PRIORITY).build_index()
+    parallel = GtfReader(gtf, PRIORITY, workers=3).build_index()
+    assert sorted(serial.partitions) == sorted(parallel.partitions)
+    for key, partition in serial.partitions.items():
+        other = parallel.partitions[key]
+        assert (partition.starts == other.starts).all() and (partition.ends == other.ends).all()
+        assert (serial.transcript_ids[partition.transcripts] == parallel.transcript_ids[other.transcripts]).all()
+
+
+def check_gtf_tree(gtf_tree):
+    """
+    assert that every tree of gtf_tree is a valid interval tree and that each node spans its children.
+    """
+    for strands in gtf_tree.values():
+        assert strands
+        for strand_tree in strands.values():
+            genes = check_red_black(strand_tree["gene_tree"])
+            assert genes and strand_tree["interval"] == strand_tree["gene_tree"].interval()
+            for gene in genes:
+                transcripts = check_red_black(gene.compose)
+                assert (gene.interval_start, gene.interval_end) == gene.compose.interval()
+                for transcript in transcripts:
+                    check_red_black(transcript.compose)
+                    assert (transcript.interval_start, transcript.interval_end) == transcript.compose.interval()
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_apply_delta_against_rebuilt_tree(write_gtf, seed):
+    rand = random.Random(seed)
+    records = random_annotation(rand)
+    delta, remove_ids, patched = random_delta(rand, records)
+    gr = GtfReader(write_gtf(records), PRIORITY)
+    gr.load_gtf()
+    gr.apply_delta(write_gtf(delta, "delta.gtf"), remove_ids)
+    check_gtf_tree(gr.gtf_tree)
+    expected = GtfReader(write_gtf(patched, "patched.gtf"), PRIORITY)
+    expected.load_gtf()
+    assert {chr_num: sorted(strands) for chr_num, strands in gr.gtf_tree.items()} == {
+        chr_num: sorted(strands) for chr_num, strands in expected.gtf_tree.items()}
+    assert index_records(AnnotationIndex.from_gtf_tree(gr.gtf_tree, list(PRIORITY))) == sorted(patched)
+
+
+@pytest.mark.parametrize("backend", ["tree", "array"])
+def test_delta_mapping_against_rebuilt_gtf(write_gtf, write_bed, tmp_path, backend):
+    rand = random.Random(4)
+    records = random_annotation(rand)
+    delta, remove_ids, patched = random_delta(rand, records)
+    peaks = []
+    for _ in range(400):
+        start = rand.randrange(0, 53000)
+        peaks.append((rand.choice(["chr1", "chr2", "chr3"]), start, start + rand.randrange(1, 400), rand.choice("+-")))
+    bed = write_bed(peaks)
+    # every hit of each peak on the array backend, the best hit of each peak center on the tree backend
+    mode = {"overlap": "interval", "hits": "all"} if backend == "array" else {}
+    results = []
+    for gtf, options in ((write_gtf(records), {"delta_gtf": write_gtf(delta, "delta.gtf"), "remove_ids": remove_ids,
+                                               "cache_dir": str(tmp_path / "cache")}),
+                         (write_gtf(patched, "patched.gtf"), {})):
+        pm = PeakMapper(gtf, PRIORITY, DISTANCE, bed, backend=backend, **mode, **options)
+        result = pm.peak_mapping(pm.build_gtf_tree(), pm.load_peak_data())
+        results.append(result.sort_values(list(result.columns)).reset_index(drop=True))
+    assert len(results[0]) > 0
+    assert results[0].equals(results[1])
+
+
+def test_attributes_without_space(tmp_path):
+    path = tmp_path / "test.gtf"
+    path.write_text('chr1\ttest\tCDS\t100\t500\t.\t+\t.\tgene_id "g1";transcript_id "t1";\n')
+    assert list(GtfReader(str(path), PRIORITY).records()) == [("chr1", "+", "g1", "t1", "CDS", 100, 500)]
+
+
+def test_record_without_transcript_id(tmp_path):
+    path = tmp_path / "test.gtf"
+    path.write_text('chr1\ttest\tgene\t100\t500\t.\t+\t.\tgene_id "g1";\n'
+                    'chr1\ttest\tCDS\t100\t500\t.\t+\t.\tgene_id "g1"; gene_name "G1";\n')
+    # the gene record is not a target element, the CDS record is
+    with pytest.raises(ValueError, match='CDS.*gene_name "G1"'):
+        list(GtfReader(str(path), PRIORITY).records())
@@ -0,0 +1,41 @@
+# -*- coding:utf-8 -*-
+import random
+import pandas as pd
+import pytest
+from conftest import PRIORITY
+from handle_peak_loc import deduplicate, deduplicate_sorted, external_deduplicate
+
+
+@pytest.mark.parametrize("chunk_size", [3, 50, 10000])
+def test_external_deduplicate_against_deduplicate(tmp_path, chunk_size):
+    rand = random.Random(chunk_size)
+    peaks = [(rand.choice(["chr1", "chr2", "chr10", "chrX"]), rand.choice("+-"), start, start + rand.randrange(1, 5))
+             for start in (rand.choice([rand.randrange(0, 20), rand.randrange(999999990, 1000000010)])
+                           for _ in range(150))]
+    # each peak comes several times, in any order, with elements of equal priority told apart by the record column
+    records = [peak + (rand.choice(list(PRIORITY)), i) for i, peak in enumerate(rand.choices(peaks, k=600))]
+    path = str(tmp_path / "peak_loc.tsv")
+    pd.DataFrame(records, columns=["chr", "strand", "start", "end", "element_name", "record"]).to_csv(path, sep="\t",
+                                                                                                   index=False)
+    chunks = list(external_deduplicate(path, PRIORITY, chunk_size=chunk_size, tmp_dir=str(tmp_path)))
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    expected = deduplicate(pd.read_csv(path, sep="\t"), PRIORITY, "element_name", priority_column=None)
+    assert pd.concat(chunks, ignore_index=True).equals(expected.astype(str).reset_index(drop=True))
+    assert [name for name in tmp_path.iterdir() if name.name.startswith("dedup_")] == []
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_deduplicate_sorted_against_deduplicate(seed):
+    rand = random.Random(seed)
+    # sorted by position only: the records of the two strands of a position are mixed
+    positions = sorted({(rand.choice(["chr1", "chr2"]), start, start + rand.randrange(1, 3))
+                        for start in (rand.randrange(0, 60) for _ in range(40))})
+    records = [(chr_num, rand.choice("+-"), start, end, rand.choice(list(PRIORITY)), i)
+               for i, (chr_num, start, end) in enumerate(sorted(rand.choices(positions, k=300)))]
+    data = pd.DataFrame(records, columns=["chr", "strand", "start", "end", "element_name", "record"])
+    expected = deduplicate(data.copy(), PRIORITY, "element_name", sort=False, priority_column=None)
+    for _ in range(10):
+        cuts = sorted(rand.sample(range(1, len(data)), rand.randrange(1, 15)))
+        chunks = [data.iloc[low: high] for low, high in zip([0] + cuts, cuts + [len(data)])]
+        deduplicated = pd.concat(deduplicate_sorted(chunks, PRIORITY, "element_name", priority_column=None))
+        assert deduplicated.reset_index(drop=True).equals(expected.reset_index(drop=True))
@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+import random
+import pytest
+from conftest import PRIORITY, DISTANCE
+from peak_mapping import PeakMapper
+
+
+def brute_force_hits(records, peak, overlap):
+    """
+    the (element, transcript, start, end) of every element matched by a peak, ranked as PeakMapper ranks them.
+    """
+    chr_num, start, end, strand = peak
+    center = start + (end - start) // 2 + 1
+    low, high = (start + 1, end) if overlap == "interval" else (center, center)
+    hits = []
+    for record_chr, element, element_start, element_end, record_strand, _, transcript_id in records:
+        if record_chr != chr_num or record_strand != strand or element_end < low or element_start > high:
+            continue
+        fraction = (min(high, element_end) - max(low, element_start) + 1) / (high - low + 1)
+        position = min(max(center, element_start), element_end)
+        distance = element_end - position + 1 if strand == "-" else position - element_start + 1
+        ratio = distance / (element_end - element_start) * 100 + DISTANCE[element]
+        hits.append(((PRIORITY[element], -fraction, -ratio), (element, transcript_id, element_start, element_end)))
+    return [hit for _, hit in sorted(hits, key=lambda hit: hit[0])]
+
+
+@pytest.mark.parametrize("overlap", ["center", "interval"])
+def test_hits_against_brute_force(write_gtf, write_bed, overlap):
+    rand = random.Random(3)
+    records = []
+    for i in range(120):
+        start = rand.randrange(1, 20000)
+        records.append((rand.choice(["chr1", "chr2"]), rand.choice(list(PRIORITY)), start,
+                        start + rand.randrange(1, 800), rand.choice("+-"), "g%d" % (i // 3), "t%d" % (i // 2)))
+    peaks = []
+    for _ in range(300):
+        start = rand.randrange(0, 21000)
+        peaks.append((rand.choice(["chr1", "chr2", "chr3"]), start, start + rand.randrange(1, 400), rand.choice("+-")))
+    gtf, bed = write_gtf(records), write_bed(peaks)
+
+    all_mapper = PeakMapper(gtf, PRIORITY, DISTANCE, bed, backend="array", overlap=overlap, hits="all")
+    annotation_index = all_mapper.build_gtf_tree()
+    peak_frame = all_mapper.load_peak_data()
+    table = all_mapper.hit_table(annotation_index, peak_frame)
+    best = PeakMapper(gtf, PRIORITY, DISTANCE, bed, backend="array", overlap=overlap).hit_table(annotation_index,
+                                                                                                peak_frame)
+    rows = table.to_frame(peak_frame, ids=True)
+    best_rows = best.to_frame(peak_frame, ids=True)
+    for i, peak in enumerate(peaks):
+        expected = brute_force_hits(records, peak, overlap)
+        got = rows.iloc[table.offsets[i]: table.offsets[i + 1]]
+        got_hits = zip(got["element_name"], got["transcript_id"], got["element_start"], got["element_end"])
+        assert sorted(got_hits) == sorted(expected)
+        assert best.counts[i] == min(len(expected), 1)
+        if expected:
+            first = got.iloc[0]
+            assert (first["element_name"], first["transcript_id"]) == expected[0][:2]
+            assert best_rows.iloc[best.offsets[i]]["location"] == first["location"]
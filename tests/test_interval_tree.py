@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+import random
+import pytest
+from conftest import check_red_black
+from interval_tree import IntervalTree
+from tree_node import ElementNode
+
+
+def brute_force_search(nodes, position):
+    return sorted(id(node) for node in nodes if node.interval_start <= position <= node.interval_end)
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_insert_delete_against_brute_force(seed):
+    rand = random.Random(seed)
+    tree = IntervalTree.from_sorted(sorted((ElementNode((start, start + rand.randrange(0, 300)), "e")
+                                            for start in (rand.randrange(0, 5000) for _ in range(200))),
+                                           key=lambda node: (node.interval_start, node.interval_end)))
+    nodes = list(tree.inorder())
+    check_red_black(tree)
+    for step in range(3000):
+        # mostly inserts at first, mostly deletes at the end, so the tree grows and then shrinks down to a few nodes
+        if nodes and rand.random() < 0.3 + 0.5 * step / 3000:
+            node = nodes.pop(rand.randrange(len(nodes)))
+            tree.delete_interval(tree, node)
+            assert node.parent is None and node.left_child is None and node.right_child is None
+        else:
+            start = rand.randrange(0, 5000)
+            # duplicated intervals share one key and must all be kept
+            if nodes and rand.random() < 0.1:
+                start = rand.choice(nodes).interval_start
+            node = ElementNode((start, start + rand.randrange(0, 300)), "e")
+            tree.insert_interval(tree, node)
+            nodes.append(node)
+        if step % 50 == 0 or len(nodes) < 5:
+            assert sorted(map(id, check_red_black(tree))) == sorted(map(id, nodes))
+            for position in [rand.randrange(-10, 5400) for _ in range(20)]:
+                assert sorted(map(id, tree.search(tree.root, position))) == brute_force_search(nodes, position)
+    assert sorted(map(id, check_red_black(tree))) == sorted(map(id, nodes))
+    for node in list(nodes):
+        tree.delete_interval(tree, node)
+    assert tree.root is None and tree.interval() is None
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 8, 100])
+def test_from_sorted(size):
+    nodes = [ElementNode((i * 10, i * 10 + 25), "e") for i in range(size)]
+    tree = IntervalTree.from_sorted(nodes)
+    assert check_red_black(tree) == nodes
+    assert tree.interval() == (0, (size - 1) * 10 + 25)
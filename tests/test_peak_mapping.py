@@ -0,0 +1,92 @@
+# -*- coding:utf-8 -*-
+import gzip
+import json
+import shutil
+import pandas as pd
+import pytest
+from conftest import PRIORITY, DISTANCE
+from peak_mapping import PeakMapper
+from peak_reader import PeakReader
+
+
+@pytest.fixture
+def annotation(write_gtf):
+    return write_gtf([("chr1", "five_prime_utr", 100, 199, "+", "g1", "t1"), ("chr1", "CDS", 200, 800, "+", "g1", "t1"),
+                      ("chr1", "stop_codon", 798, 800, "+", "g1", "t1"),
+                      ("chr1", "three_prime_utr", 801, 1200, "+", "g1", "t1"),
+                      ("chr2", "CDS", 100, 900, "-", "g2", "t2")])
+
+
+@pytest.fixture
+def samples(write_bed, tmp_path):
+    first = write_bed([("chr1", 120, 160, "+"), ("chr1", 300, 400, "+"), ("chr2", 200, 260, "-")], "a.bed")
+    second = write_bed([("chr1", 900, 1000, "+"), ("chr3", 10, 20, "+")], "b.bed")
+    # the second sample is gzip compressed
+    with open(second, "rb") as f, gzip.open(str(tmp_path / "b.bed.gz"), "wb") as g:
+        shutil.copyfileobj(f, g)
+    return [first, str(tmp_path / "b.bed.gz")]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_map_samples_histogram(annotation, samples, tmp_path, workers):
+    pm = PeakMapper(annotation, PRIORITY, DISTANCE, None, backend="array", workers=workers, histogram=True)
+    summary = pm.map_samples(pm.build_gtf_tree(), samples, str(tmp_path / "out"))
+    assert summary["sample"].tolist() == ["a", "b"]
+    assert summary["mapped"].tolist() == [3, 1]
+    per_sample = [json.load(open(output + ".hist.json"))["peaks"] for output in summary["output"]]
+    assert per_sample == [3, 1]
+    assert int(pm.histogram.counts.sum() + pm.histogram.outside.sum()) == 4
+
+
+def test_gzip_peak_file(annotation, samples):
+    plain = PeakMapper(annotation, PRIORITY, DISTANCE, samples[1][:-len(".gz")])
+    compressed = PeakMapper(annotation, PRIORITY, DISTANCE, samples[1])
+    tree = plain.build_gtf_tree()
+    expected = plain.peak_mapping(tree, plain.load_peak_data()).reset_index(drop=True)
+    assert compressed.peak_mapping(tree, compressed.load_peak_data()).reset_index(drop=True).equals(expected)
+    streamed = pd.concat(compressed.peak_mapping(tree, peaks) for peaks in compressed.pr.iter_peaks(1))
+    pd.testing.assert_frame_equal(streamed.reset_index(drop=True), expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1])
+def test_map_sample_all_hits(annotation, write_bed, tmp_path, chunk_size):
+    # the first peak overlaps the CDS, the stop codon and the 3'UTR of t1
+    bed = write_bed([("chr1", 700, 900, "+"), ("chr2", 200, 260, "-"), ("chr3", 10, 20, "+")])
+    pm = PeakMapper(annotation, PRIORITY, DISTANCE, None, backend="array", histogram=True, overlap="interval",
+                    hits="all")
+    summary = pm.map_samples(pm.build_gtf_tree(), [bed], str(tmp_path / "out"), chunk_size)
+    assert len(pd.read_csv(summary["output"][0], sep="\t")) == 4
+    assert summary["mapped"].tolist() == [2] and summary["mapped_ratio"].tolist() == [2 / 3]
+    # each peak counts once in the histogram, with its best element
+    assert summary[["stop_codon", "three_prime_utr", "CDS"]].values.tolist() == [[1, 0, 1]]
+    assert json.load(open(summary["output"][0] + ".hist.json"))["peaks"] == 2
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 100])
+def test_position_sorted(write_bed, chunk_size):
+    cases = [([("chr2", 10, 20, "+"), ("chr2", 10, 20, "-"), ("chr2", 10, 30, "+"), ("chr1", 5, 6, "+")], True),
+             ([("chr1", 10, 20, "+"), ("chr2", 5, 6, "+"), ("chr1", 30, 40, "+")], False),
+             ([("chr1", 10, 20, "+"), ("chr1", 10, 15, "+")], False),
+             ([("chr1", 10, 20, "+"), ("chr1", 5, 30, "+")], False), ([], True)]
+    for peaks, expected in cases:
+        assert PeakReader(write_bed(peaks)).position_sorted(chunk_size) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 100])
+@pytest.mark.parametrize("position_sorted", [True, False])
+def test_stream_dedup(annotation, write_bed, tmp_path, chunk_size, position_sorted):
+    # duplicated peaks, those at 300-400 on both strands, sorted by position with chr2 first
+    peaks = [("chr2", 200, 260, "-"), ("chr2", 200, 260, "-"), ("chr1", 120, 160, "+"), ("chr1", 120, 160, "+"),
+             ("chr1", 300, 400, "+"), ("chr1", 300, 400, "-"), ("chr1", 300, 400, "+"), ("chr1", 790, 810, "+")]
+    bed = write_bed(peaks if position_sorted else peaks[::-1])
+    pm = PeakMapper(annotation, PRIORITY, DISTANCE, bed, backend="array", dedup=True, histogram=True)
+    tree = pm.build_gtf_tree()
+    expected = pm.peak_mapping(tree, pm.load_peak_data())
+    streamed = PeakMapper(annotation, PRIORITY, DISTANCE, bed, backend="array", dedup=True, histogram=True)
+    assert streamed.stream_mapping(tree, str(tmp_path / "out.tsv"), chunk_size) == len(expected) == 4
+    # a sorted file keeps its order, as without chunks, the external sort orders the peaks by key
+    if not position_sorted:
+        expected = expected.sort_values(["chr", "strand", "start", "end"])
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "out.tsv", sep="\t"), expected.reset_index(drop=True),
+                                  check_dtype=False)
+    assert (streamed.histogram.counts == pm.histogram.counts).all()
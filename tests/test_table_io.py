@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+import pandas as pd
+import pytest
+from conftest import PRIORITY, DISTANCE
+from peak_mapping import PeakMapper
+from table_io import TableWriter, read_table
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def annotation(write_gtf):
+    return write_gtf([("chr1", "CDS", 100, 500, "+", "g1", "t1"), ("chr1", "stop_codon", 498, 500, "+", "g1", "t1"),
+                      ("chr2", "CDS", 100, 900, "-", "g2", "t2")])
+
+
+@pytest.mark.parametrize("extension", ["parquet", "feather"])
+@pytest.mark.parametrize("backend", ["tree", "array"])
+def test_stream_first_chunk_unmapped(annotation, write_bed, tmp_path, extension, backend):
+    # the first chunk lies on a contig without annotation, no peak of it is mapped
+    bed = write_bed([("chrUn", 10, 20, "+"), ("chrUn", 30, 40, "+"), ("chr1", 200, 300, "+"),
+                     ("chr2", 400, 500, "-"), ("chr2", 950, 990, "-")])
+    pm = PeakMapper(annotation, PRIORITY, DISTANCE, bed, backend=backend)
+    tree = pm.build_gtf_tree()
+    output = str(tmp_path / ("out." + extension))
+    pm.stream_mapping(tree, output, chunk_size=2)
+    expected = pm.peak_mapping(tree, pm.load_peak_data()).reset_index(drop=True)
+    written = read_table(output)
+    assert len(written) == 2
+    assert written.astype(object).equals(expected.astype(object))
+
+
+@pytest.mark.parametrize("extension", ["parquet", "feather"])
+def test_write_only_empty_frames(tmp_path, extension):
+    output = str(tmp_path / ("empty." + extension))
+    frame = pd.DataFrame({"chr": pd.Series(dtype=object), "start": pd.Series(dtype="int64"),
+                          "element_name": pd.Series(dtype=object)})
+    with TableWriter(output) as writer:
+        writer.write(frame)
+        writer.write(frame)
+    written = read_table(output)
+    assert list(written.columns) == ["chr", "start", "element_name"] and len(written) == 0
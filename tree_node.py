@@ -8,6 +8,7 @@ description:
     1) one gene may has several transcript.
     2) a transcript consists of a group of element
     3) element on transcript is the smallest part which we take it into account
+    A full GTF file produces millions of nodes, so the nodes use __slots__ instead of an instance __dict__.
 """
 
 
@@ -15,6 +16,9 @@ class Node:
     """
     the node of gene on interval tree.
     """
+    __slots__ = ("parent", "left_child", "right_child", "interval_start", "interval_end", "center", "max_end", "name",
+                 "compose", "color")
+
     def __init__(self, interval, name, compose, color=None):
         assert interval[0] <= interval[1]
         self.parent = None
@@ -23,6 +27,8 @@ class Node:
         self.interval_start = int(interval[0])
         self.interval_end = int(interval[1])
         self.center = (self.interval_start + self.interval_end) // 2
+        # the largest interval end in the subtree rooted at this node, maintained by IntervalTree
+        self.max_end = self.interval_end
         self.name = name
         self.compose = compose
         self.color = color
@@ -32,6 +38,8 @@ class GeneNode(Node):
     """
     the node of gene on interval tree.
     """
+    __slots__ = ()
+
     def __init__(self, interval, gene_id, transcripts, color=None):
         """
         :param interval: interval of this node, type tuple
@@ -46,6 +54,8 @@ class TranscriptNode(Node):
     """
     the node of transcript on interval tree
     """
+    __slots__ = ()
+
     def __init__(self, interval, transcript_id, elements, color=None):
         """
         :param interval: interval: interval of this node, type tuple
@@ -60,5 +70,7 @@ class ElementNode(Node):
     """
     the node of element on interval tree
     """
+    __slots__ = ()
+
     def __init__(self, interval, element_name, compose=None, color=None):
         super(ElementNode, self).__init__(interval, element_name, compose, color)